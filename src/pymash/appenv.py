@@ -1,3 +1,7 @@
+import functools
+import os
+import typing as tp
+
 import aiohttp_jinja2
 import jinja2
 import pygments
@@ -5,16 +9,48 @@ import pygments.lexers
 from aiohttp import web
 from pygments.formatters import html as pygments_html
 
+from pymash import cfg
+from pymash import loggers
+from pymash import static
+
 
 def setup_jinja2(app: web.Application) -> None:
-    aiohttp_jinja2.setup(
+    env = aiohttp_jinja2.setup(
         app,
         loader=jinja2.PackageLoader('pymash', 'templates'),
         context_processors=[aiohttp_jinja2.request_processor],
-        filters={'highlight': _highlight})
+        **get_jinja2_options(app['config']))
+    env.globals['static_url'] = functools.partial(_get_static_url, app)
+    # templates are compiled (or loaded from the bytecode cache) on startup, not on the first requests
+    for a_name in env.list_templates(extensions=['html']):
+        env.get_template(a_name)
+
+
+def get_jinja2_options(config: cfg.Config) -> dict:
+    options = {
+        # without auto reload every render stats the template files to check if they've changed
+        'auto_reload': config.templates_auto_reload,
+    }
+    if config.templates_bytecode_cache_dir:
+        os.makedirs(config.templates_bytecode_cache_dir, exist_ok=True)
+        options['bytecode_cache'] = jinja2.FileSystemBytecodeCache(config.templates_bytecode_cache_dir)
+    return options
+
+
+def _get_static_url(app: web.Application, name: str) -> tp.Optional[str]:
+    # None when static files aren't built or the build is stale
+    assets = app.get('static_assets')
+    if assets is None:
+        return None
+    try:
+        hashed_name = assets.get_hashed_name(name)
+    except static.AssetNotFound:
+        loggers.web.warning('%s is not in the static build manifest, falling back', name)
+        return None
+    return str(app.router['asset'].url_for(hashed_name=hashed_name))
 
 
-def _highlight(fn_text, language='python3'):
+def highlight(fn_text, language='python3'):
     return _highlight_with_css_class(
         fn_text,
         language=language,
@@ -13,6 +13,41 @@ class _EnvKey:
     GITHUB_TOKEN = 'PYMASH_GITHUB_TOKEN'
     CSS_URL = 'PYMASH_CSS_URL'
     ENABLE_ANTIFRAUD = 'PYMASH_ENABLE_ANTIFRAUD'
+    GAMES_QUEUE_BACKEND = 'PYMASH_GAMES_QUEUE_BACKEND'
+    SQLITE_GAMES_QUEUE_PATH = 'PYMASH_SQLITE_GAMES_QUEUE_PATH'
+    ENABLE_GAMES_COMPACTION = 'PYMASH_ENABLE_GAMES_COMPACTION'
+    WATCHMAN_BACKEND = 'PYMASH_WATCHMAN_BACKEND'
+    WATCHMAN_SQLITE_DIR = 'PYMASH_WATCHMAN_SQLITE_DIR'
+    WATCHMAN_SNAPSHOT_PATH = 'PYMASH_WATCHMAN_SNAPSHOT_PATH'
+    BAN_LIST_PATH = 'PYMASH_BAN_LIST_PATH'
+    MATCHMAKING = 'PYMASH_MATCHMAKING'
+    GAMES_PREFETCH_SIZE = 'PYMASH_GAMES_PREFETCH_SIZE'
+    TEMPLATES_AUTO_RELOAD = 'PYMASH_TEMPLATES_AUTO_RELOAD'
+    TEMPLATES_BYTECODE_CACHE_DIR = 'PYMASH_TEMPLATES_BYTECODE_CACHE_DIR'
+    STATIC_BUILD_DIR = 'PYMASH_STATIC_BUILD_DIR'
+
+
+class GamesQueueBackend:
+    SQS = 'sqs'
+    SQLITE = 'sqlite'
+    POSTGRES = 'postgres'
+
+    ALL = [SQS, SQLITE, POSTGRES]
+
+
+class WatchmanBackend:
+    MEMORY = 'memory'
+    SQLITE = 'sqlite'
+    SUBNET = 'subnet'
+
+    ALL = [MEMORY, SQLITE, SUBNET]
+
+
+class Matchmaking:
+    UNIFORM = 'uniform'
+    STRATIFIED = 'stratified'
+
+    ALL = [UNIFORM, STRATIFIED]
 
 
 class BaseError(Exception):
@@ -34,6 +69,26 @@ _ENV_CONFIG_SCHEMA = vol.Schema(
         _EnvKey.GITHUB_TOKEN: str,
         _EnvKey.CSS_URL: str,
         _EnvKey.ENABLE_ANTIFRAUD: vol.Boolean(),
+        vol.Optional(_EnvKey.GAMES_QUEUE_BACKEND, default=GamesQueueBackend.SQS):
+            vol.In(GamesQueueBackend.ALL),
+        vol.Optional(_EnvKey.SQLITE_GAMES_QUEUE_PATH, default='pymash_games_queue.sqlite'): str,
+        vol.Optional(_EnvKey.ENABLE_GAMES_COMPACTION, default=False): vol.Boolean(),
+        vol.Optional(_EnvKey.WATCHMAN_BACKEND, default=WatchmanBackend.MEMORY):
+            vol.In(WatchmanBackend.ALL),
+        vol.Optional(_EnvKey.WATCHMAN_SQLITE_DIR, default='.'): str,
+        # empty path disables snapshots of the in-memory watchman
+        vol.Optional(_EnvKey.WATCHMAN_SNAPSHOT_PATH, default=''): str,
+        # empty path disables publishing bans of the in-memory watchman to the web tier
+        vol.Optional(_EnvKey.BAN_LIST_PATH, default=''): str,
+        vol.Optional(_EnvKey.MATCHMAKING, default=Matchmaking.UNIFORM): vol.In(Matchmaking.ALL),
+        # zero disables prefetching of games by web workers
+        vol.Optional(_EnvKey.GAMES_PREFETCH_SIZE, default=0): vol.All(vol.Coerce(int), vol.Range(min=0)),
+        # production disables it: templates don't change without a deploy
+        vol.Optional(_EnvKey.TEMPLATES_AUTO_RELOAD, default=True): vol.Boolean(),
+        # empty dir disables the bytecode cache of compiled templates
+        vol.Optional(_EnvKey.TEMPLATES_BYTECODE_CACHE_DIR, default=''): str,
+        # output of scripts/build_static.py, empty dir means that css is served from CSS_URL
+        vol.Optional(_EnvKey.STATIC_BUILD_DIR, default=''): str,
     },
     required=True, extra=vol.ALLOW_EXTRA)
 
@@ -42,7 +97,11 @@ class Config:
     def __init__(
             self, dsn: str, game_hash_salt: str, aws_region_name: str, aws_access_key_id: str,
             aws_secret_access_key: str, sqs_games_queue_name: str, github_token: str, css_url: str,
-            enable_antifraud: bool) -> None:
+            enable_antifraud: bool, games_queue_backend: str, sqlite_games_queue_path: str,
+            enable_games_compaction: bool, watchman_backend: str, watchman_sqlite_dir: str,
+            watchman_snapshot_path: str, ban_list_path: str, matchmaking: str,
+            games_prefetch_size: int, templates_auto_reload: bool, templates_bytecode_cache_dir: str,
+            static_build_dir: str) -> None:
         self.dsn = dsn
         self.game_hash_salt = game_hash_salt
         self.aws_region_name = aws_region_name
@@ -52,6 +111,18 @@ class Config:
         self.github_token = github_token
         self.css_url = css_url
         self.enable_antifraud = enable_antifraud
+        self.games_queue_backend = games_queue_backend
+        self.sqlite_games_queue_path = sqlite_games_queue_path
+        self.enable_games_compaction = enable_games_compaction
+        self.watchman_backend = watchman_backend
+        self.watchman_sqlite_dir = watchman_sqlite_dir
+        self.watchman_snapshot_path = watchman_snapshot_path
+        self.ban_list_path = ban_list_path
+        self.matchmaking = matchmaking
+        self.games_prefetch_size = games_prefetch_size
+        self.templates_auto_reload = templates_auto_reload
+        self.templates_bytecode_cache_dir = templates_bytecode_cache_dir
+        self.static_build_dir = static_build_dir
 
 
 def get_config() -> Config:
@@ -68,4 +139,16 @@ def get_config() -> Config:
         sqs_games_queue_name=parsed_config[_EnvKey.SQS_GAMES_QUEUE_NAME],
         github_token=parsed_config[_EnvKey.GITHUB_TOKEN],
         css_url=parsed_config[_EnvKey.CSS_URL],
-        enable_antifraud=parsed_config[_EnvKey.ENABLE_ANTIFRAUD])
+        enable_antifraud=parsed_config[_EnvKey.ENABLE_ANTIFRAUD],
+        games_queue_backend=parsed_config[_EnvKey.GAMES_QUEUE_BACKEND],
+        sqlite_games_queue_path=parsed_config[_EnvKey.SQLITE_GAMES_QUEUE_PATH],
+        enable_games_compaction=parsed_config[_EnvKey.ENABLE_GAMES_COMPACTION],
+        watchman_backend=parsed_config[_EnvKey.WATCHMAN_BACKEND],
+        watchman_sqlite_dir=parsed_config[_EnvKey.WATCHMAN_SQLITE_DIR],
+        watchman_snapshot_path=parsed_config[_EnvKey.WATCHMAN_SNAPSHOT_PATH],
+        ban_list_path=parsed_config[_EnvKey.BAN_LIST_PATH],
+        matchmaking=parsed_config[_EnvKey.MATCHMAKING],
+        games_prefetch_size=parsed_config[_EnvKey.GAMES_PREFETCH_SIZE],
+        templates_auto_reload=parsed_config[_EnvKey.TEMPLATES_AUTO_RELOAD],
+        templates_bytecode_cache_dir=parsed_config[_EnvKey.TEMPLATES_BYTECODE_CACHE_DIR],
+        static_build_dir=parsed_config[_EnvKey.STATIC_BUILD_DIR])
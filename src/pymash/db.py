@@ -1,9 +1,9 @@
+import datetime as dt
 import random
+import typing as tp
 
 import sqlalchemy as sa
 import sqlalchemy.dialects.postgresql as postgresql
-import sqlalchemy.exc as sa_exc
-from psycopg2 import errorcodes
 
 from pymash import loggers
 from pymash import models
@@ -14,6 +14,12 @@ from pymash import utils
 from pymash.tables import *
 
 
+GAME_EVENTS_CHANNEL = 'game_events'
+_MAX_NUM_IDS_PER_QUERY = 10_000
+# columns used by make_function_from_db_row
+_FUNCTION_COLUMNS = [Functions.c.function_id, Functions.c.repo_id, Functions.c.is_active, Functions.c.text]
+
+
 class BaseError(Exception):
     pass
 
@@ -26,6 +32,10 @@ class GameResultChanged(BaseError):
     pass
 
 
+class GamesAlreadySaved(BaseError):
+    pass
+
+
 @utils.log_time(loggers.web)
 async def find_active_repos_order_by_rating(engine: ta.AsyncEngine) -> ta.Repos:
     repos = []
@@ -48,6 +58,51 @@ def deactivate_all_other_repos(engine: ta.Engine, repos: ta.Repos) -> None:
                         repos_result.rowcount, functions_result.rowcount)
 
 
+def iter_active_functions_ids_and_texts(engine: ta.Engine) -> tp.Iterator[tp.Tuple[int, str]]:
+    # functions of older repos go first: copies in newer repos are more likely to be vendored
+    query = sa.select([Functions.c.function_id, Functions.c.text]).select_from(
+        Functions.join(Repos, Functions.c.repo_id == Repos.c.repo_id)).where(
+        Functions.c.is_active.is_(True)).order_by(Repos.c.github_id, Functions.c.function_id)
+    with engine.connect() as conn:
+        for a_row in conn.execution_options(stream_results=True).execute(query):
+            yield a_row[Functions.c.function_id], a_row[Functions.c.text]
+
+
+@utils.log_time(loggers.loader, lambda engine, function_ids: f'{len(function_ids)} functions')
+def deactivate_many_functions(engine: ta.Engine, function_ids: ta.Integers) -> None:
+    update_data = {
+        Functions.c.is_active.key: False,
+    }
+    with engine.begin() as conn:
+        for i in range(0, len(function_ids), _MAX_NUM_IDS_PER_QUERY):
+            chunk = function_ids[i:i + _MAX_NUM_IDS_PER_QUERY]
+            conn.execute(Functions.update().where(Functions.c.function_id.in_(chunk)).values(update_data))
+
+
+@utils.log_time(loggers.loader)
+def deactivate_repos_with_few_active_functions(engine: ta.Engine, min_num_functions: int) -> None:
+    # repos left without functions can't be picked for games, but they would stay on the leaders page
+    num_active_functions = sa.select([sa.func.count()]).where(sa.and_(
+        Functions.c.repo_id == Repos.c.repo_id,
+        Functions.c.is_active.is_(True))).correlate(Repos).as_scalar()
+    deactivate_repos = Repos.update().where(sa.and_(
+        Repos.c.is_active.is_(True),
+        num_active_functions < min_num_functions)).values({
+            Repos.c.is_active.key: False,
+        }).returning(Repos.c.repo_id)
+    with engine.begin() as conn:
+        repo_ids = [a_row[Repos.c.repo_id] for a_row in conn.execute(deactivate_repos)]
+        num_functions = 0
+        if repo_ids:
+            num_functions = conn.execute(Functions.update().where(sa.and_(
+                Functions.c.repo_id.in_(repo_ids),
+                Functions.c.is_active.is_(True))).values({
+                    Functions.c.is_active.key: False,
+                })).rowcount
+    loggers.loader.info('deactivated %d repos with less than %d active functions and their %d functions',
+                        len(repo_ids), min_num_functions, num_functions)
+
+
 def make_repo_from_db_row(row: dict) -> models.Repo:
     return models.Repo(
         repo_id=row[Repos.c.repo_id],
@@ -68,14 +123,44 @@ def make_function_from_db_row(row: dict) -> models.Function:
 
 @utils.log_time(loggers.web)
 async def try_to_find_two_random_functions(engine: ta.AsyncEngine) -> ta.Functions:
-    select_first = _make_query_to_find_random_function()
-    select_second = _make_query_to_find_random_function()
-    select_both = select_first.union_all(select_second)
     async with engine.acquire() as conn:
-        rows = await conn.execute(select_both)
+        rows = await conn.execute(_make_query_to_find_two_random_functions())
+        return list(map(make_function_from_db_row, rows))
+
+
+@utils.log_time(loggers.web)
+async def try_to_find_two_random_functions_of_repos(
+        engine: ta.AsyncEngine, white_repo_id: int, black_repo_id: int) -> ta.Functions:
+    query = _make_query_to_find_two_random_functions_of_repos(white_repo_id, black_repo_id)
+    async with engine.acquire() as conn:
+        rows = await conn.execute(query)
         return list(map(make_function_from_db_row, rows))
 
 
+@utils.log_time(loggers.loader)
+def renumber_function_slots(engine: ta.Engine) -> None:
+    # Functions deactivated since the last renumbering keep their slots until the next one,
+    # so they are skipped by is_active check when picked, without leaving holes in the middle of the load.
+    # Slots of one repo are contiguous, so a random function of the repo is a random slot in its range.
+    numbered = sa.select([
+        Functions.c.function_id,
+        (sa.func.row_number().over(order_by=[Functions.c.repo_id, Functions.c.function_id]) - 1).label('slot'),
+    ]).where(Functions.c.is_active.is_(True)).alias('numbered')
+    clear_inactive = Functions.update().where(
+        sa.and_(Functions.c.slot.isnot(None), Functions.c.is_active.is_(False))).values({
+            Functions.c.slot.key: None,
+        })
+    set_active = Functions.update().where(
+        sa.and_(Functions.c.function_id == numbered.c.function_id,
+                Functions.c.slot.is_distinct_from(numbered.c.slot))).values({
+            Functions.c.slot.key: numbered.c.slot,
+        })
+    with engine.begin() as conn:
+        cleared_result = conn.execute(clear_inactive)
+        set_result = conn.execute(set_active)
+    loggers.loader.info('cleared %d slots and set %d slots', cleared_result.rowcount, set_result.rowcount)
+
+
 @utils.log_time(loggers.games_queue)
 def find_many_repos_by_function_ids(engine, white_fn_id: int, black_fn_id: int) -> ta.Repos:
     with engine.connect() as conn:
@@ -117,14 +202,84 @@ def find_game_by_id(engine: ta.Engine, game_id: str) -> models.Game:
 @utils.log_time(loggers.games_queue)
 def save_game_and_match(engine: ta.Engine, game: models.Game, match: models.Match) -> None:
     with engine.connect().execution_options(isolation_level='SERIALIZABLE') as conn:
-        try:
-            _insert_game_and_change_repo_ratings(conn, game, match)
-        except sa_exc.IntegrityError as exc:
-            assert Games.c.game_id.name in exc.params
-            assert exc.orig.pgcode == errorcodes.UNIQUE_VIOLATION
-            game_from_db = find_game_by_id(engine, game.game_id)
-            if game_from_db.result != game.result:
-                raise GameResultChanged
+        _insert_game_and_change_repo_ratings(conn, game, match)
+
+
+@utils.log_time(loggers.games_queue, lambda engine, game_ids: f'{len(game_ids)} game ids')
+def find_many_games_by_ids(engine: ta.Engine, game_ids: tp.List[str]) -> tp.Dict[str, models.Game]:
+    query = Games.select().where(Games.c.game_id.in_(game_ids))
+    with engine.connect() as conn:
+        games = list(map(_make_game_from_db_row, conn.execute(query)))
+    return {a_game.game_id: a_game for a_game in games}
+
+
+@utils.log_time(loggers.games_queue, lambda engine, function_ids: f'{len(function_ids)} function ids')
+def find_repos_by_function_ids(engine: ta.Engine, function_ids: ta.Integers) -> tp.Dict[int, models.Repo]:
+    # functions from the same repo share the same Repo object, so rating changes accumulate
+    query = sa.select([Functions.c.function_id, Repos]).select_from(
+        Functions.join(Repos, Functions.c.repo_id == Repos.c.repo_id)).where(
+        Functions.c.function_id.in_(function_ids))
+    repo_by_id = {}
+    repo_by_function_id = {}
+    with engine.connect() as conn:
+        for a_row in conn.execute(query):
+            repo_id = a_row[Repos.c.repo_id]
+            if repo_id not in repo_by_id:
+                repo_by_id[repo_id] = make_repo_from_db_row(a_row)
+            repo_by_function_id[a_row[Functions.c.function_id]] = repo_by_id[repo_id]
+    return repo_by_function_id
+
+
+@utils.log_time(loggers.games_queue, lambda engine, games, repos: f'{len(games)} games, {len(repos)} repos')
+def save_many_games_and_ratings(engine: ta.Engine, games: tp.List[models.Game], repos: ta.Repos) -> None:
+    if not games:
+        return
+    # ON CONFLICT DO NOTHING doesn't abort the transaction on duplicates, unlike UNIQUE_VIOLATION
+    insert_games = postgresql.insert(Games).values([
+        _make_game_insert_data(a_game)
+        for a_game in games
+    ]).on_conflict_do_nothing(index_elements=[Games.c.game_id]).returning(Games.c.game_id)
+    with engine.connect().execution_options(isolation_level='SERIALIZABLE') as conn:
+        with conn.begin():
+            inserted_game_ids = {a_row[Games.c.game_id] for a_row in conn.execute(insert_games)}
+            already_saved_game_ids = {a_game.game_id for a_game in games} - inserted_game_ids
+            if already_saved_game_ids:
+                # ratings include games saved by someone else after they were looked up, transaction is rolled back
+                raise GamesAlreadySaved(f'games {sorted(already_saved_game_ids)} are already saved')
+            for a_repo in repos:
+                conn.execute(_make_query_to_update_rating(a_repo))
+
+
+@utils.log_time(loggers.web)
+async def send_game_event(engine: ta.AsyncEngine, body: str) -> None:
+    async with engine.acquire() as conn:
+        async with conn.begin():
+            await conn.execute(_make_query_to_insert_game_event(body))
+            await conn.execute(_make_query_to_notify_about_game_events())
+
+
+def save_game_event(engine: ta.Engine, body: str) -> None:
+    with engine.begin() as conn:
+        conn.execute(_make_query_to_insert_game_event(body))
+        conn.execute(_make_query_to_notify_about_game_events())
+
+
+def claim_game_events(engine: ta.Engine, limit: int, visibility_timeout: dt.timedelta) -> list:
+    now = sa.func.current_timestamp()
+    claimable_ids = sa.select([GameEvents.c.event_id]).where(
+        GameEvents.c.visible_after <= now).order_by(
+        GameEvents.c.event_id).limit(limit).with_for_update(skip_locked=True)
+    query = GameEvents.update().where(GameEvents.c.event_id.in_(claimable_ids)).values({
+        GameEvents.c.visible_after: now + visibility_timeout,
+    }).returning(GameEvents.c.event_id, GameEvents.c.body, GameEvents.c.created)
+    with engine.begin() as conn:
+        rows = list(conn.execute(query))
+    return sorted(rows, key=lambda a_row: a_row[GameEvents.c.event_id])
+
+
+def delete_game_event(engine: ta.Engine, event_id: int) -> None:
+    with engine.begin() as conn:
+        conn.execute(GameEvents.delete().where(GameEvents.c.event_id == event_id))
 
 
 @utils.log_time(loggers.loader, lambda engine, github_repo, functions: f'{github_repo.url}')
@@ -209,19 +364,29 @@ def _deactivate_other_only_functions(conn, repo_ids):
 
 @utils.log_time(loggers.games_queue)
 def _insert_game_and_change_repo_ratings(conn, game: models.Game, match: models.Match) -> None:
-    insert_game = Games.insert().values({
-        Games.c.game_id: game.game_id,
-        Games.c.white_id: game.white_id,
-        Games.c.black_id: game.black_id,
-        Games.c.white_score: game.result.white_score,
-        Games.c.black_score: game.result.black_score,
-    })
+    # ON CONFLICT DO NOTHING doesn't abort the transaction on duplicates, unlike UNIQUE_VIOLATION
+    insert_game = postgresql.insert(Games).values(_make_game_insert_data(game)).on_conflict_do_nothing(
+        index_elements=[Games.c.game_id]).returning(Games.c.game_id)
     with conn.begin():
-        conn.execute(insert_game)
+        if conn.execute(insert_game).first() is None:
+            game_from_db = _make_game_from_db_row(_find_many_by_ids(conn, Games, [game.game_id])[0])
+            if game_from_db.result != game.result:
+                raise GameResultChanged
+            return
         conn.execute(_make_query_to_update_rating(match.white))
         conn.execute(_make_query_to_update_rating(match.black))
 
 
+def _make_game_insert_data(game: models.Game) -> dict:
+    return {
+        Games.c.game_id.key: game.game_id,
+        Games.c.white_id.key: game.white_id,
+        Games.c.black_id.key: game.black_id,
+        Games.c.white_score.key: game.result.white_score,
+        Games.c.black_score.key: game.result.black_score,
+    }
+
+
 def _find_many_by_ids(conn, table, ids):
     id_column = _get_id_column(table)
     query = table.select().where(id_column.in_(ids))
@@ -244,15 +409,41 @@ def _make_query_to_update_rating(repo: models.Repo):
         {Repos.c.rating: repo.rating})
 
 
-def _make_query_to_find_random_function():
-    is_active = Functions.c.is_active.is_(True)
-    x = random.random()
-    select_max_random = Functions.select().where(is_active).with_only_columns(
-        [sa.func.max(Functions.c.random)]).as_scalar()
-    gte_than_random = Functions.c.random >= sa.func.least(x, select_max_random)
-    result = Functions.select().where(
-        sa.and_(gte_than_random, is_active)).order_by(Functions.c.random).limit(1)
-    return result
+def _make_query_to_find_two_random_functions():
+    num_slots = sa.select([sa.func.max(Functions.c.slot) + 1]).as_scalar()
+    return _make_query_to_find_functions_by_slots(_make_random_slot(num_slots), _make_random_slot(num_slots))
+
+
+def _make_query_to_find_two_random_functions_of_repos(white_repo_id: int, black_repo_id: int):
+    return _make_query_to_find_functions_by_slots(
+        _make_random_slot_of_repo(white_repo_id), _make_random_slot_of_repo(black_repo_id))
+
+
+def _make_query_to_find_functions_by_slots(first_slot, second_slot):
+    is_picked = sa.and_(Functions.c.slot.in_([first_slot, second_slot]), Functions.c.is_active.is_(True))
+    # rows are in the order of picks, otherwise the function with the lower slot would always be white
+    return sa.select(_FUNCTION_COLUMNS).where(is_picked).order_by((Functions.c.slot == first_slot).desc())
+
+
+def _make_random_slot(num_slots):
+    return sa.cast(sa.func.floor(random.random() * num_slots), sa.BigInteger)
+
+
+def _make_random_slot_of_repo(repo_id: int):
+    of_repo = sa.and_(Functions.c.repo_id == repo_id, Functions.c.slot.isnot(None))
+    min_slot = sa.select([sa.func.min(Functions.c.slot)]).where(of_repo).as_scalar()
+    max_slot = sa.select([sa.func.max(Functions.c.slot)]).where(of_repo).as_scalar()
+    return min_slot + _make_random_slot(max_slot - min_slot + 1)
+
+
+def _make_query_to_insert_game_event(body: str):
+    return GameEvents.insert().values({
+        GameEvents.c.body: body,
+    })
+
+
+def _make_query_to_notify_about_game_events():
+    return sa.select([sa.func.pg_notify(GAME_EVENTS_CHANNEL, '')])
 
 
 def _make_game_from_db_row(row: dict) -> models.Game:
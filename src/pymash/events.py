@@ -1,14 +1,30 @@
+import base64
 import datetime as dt
 import json
+import socket
+import struct
+import typing as tp
 
 from aiohttp import web
 
+from pymash import cfg
 from pymash import db
+from pymash import ledger
 from pymash import loggers
 from pymash import models
+from pymash import queues
 from pymash import type_aliases as ta
 from pymash import utils
 
+# version, flags, game_id as uuid bytes, white_id, black_id, occurred_at as unix timestamp;
+# packed ip address (4 or 16 bytes) follows
+_COMPACT_EVENT_HEADER = struct.Struct('>BB16sqqq')
+_COMPACT_EVENT_VERSION = 1
+_WHITE_WINS_FLAG = 0b01
+_IPV6_FLAG = 0b10
+# batch is recomputed when some of its games were saved concurrently
+_MAX_NUM_SAVE_ATTEMPTS = 3
+
 
 class BaseError(Exception):
     pass
@@ -18,23 +34,46 @@ class DeletedFromDb(BaseError):
     pass
 
 
+class UnknownEventVersion(BaseError):
+    pass
+
+
 @utils.log_time(loggers.web)
 async def post_game_finished_event(request: web.Request, game: models.Game) -> None:
     app = request.app
-    event = make_game_finished_event(game, _get_user_ip(request))
+    ip = get_user_ip(request)
+    body = encode_game_finished_event(game, ip, dt.datetime.utcnow())
     await _ensure_games_queue_is_ready(app)
-    loggers.web.info('sending game_finished event %r', event)
-    await app['games_queue'].send_message(MessageBody=json.dumps(event))
+    loggers.web.info('sending game_finished event for %r from %s', game, ip)
+    await app['games_queue'].send(body)
+
+
+def encode_game_finished_event(game: models.Game, ip: str, occurred_at: dt.datetime) -> str:
+    try:
+        return _encode_compact_game_finished_event(game, ip, occurred_at)
+    except (ValueError, struct.error):
+        # game_id is not a uuid or ip is garbage: fall back to json, we can always decode it
+        return json.dumps(make_game_finished_event(game, ip, occurred_at))
+
+
+def decode_game_finished_event(body: str) -> tp.Tuple[models.Game, models.GameAttempt]:
+    if body.startswith('{'):
+        data = json.loads(body)
+        return parse_game_finished_event_as_game(data), parse_game_finished_event_as_game_attempt(data)
+    return _decode_compact_game_finished_event(body)
 
 
-def make_game_finished_event(game: models.Game, ip: str) -> dict:
+def make_game_finished_event(
+        game: models.Game, ip: str, occurred_at: tp.Optional[dt.datetime] = None) -> dict:
+    if occurred_at is None:
+        occurred_at = dt.datetime.utcnow()
     return {
         'game_id': game.game_id,
         'white_id': game.white_id,
         'black_id': game.black_id,
         'white_score': game.result.white_score,
         'black_score': game.result.black_score,
-        'occurred_at': dt.datetime.utcnow().isoformat(timespec='seconds'),
+        'occurred_at': occurred_at.isoformat(timespec='seconds'),
         'ip': ip,
     }
 
@@ -54,17 +93,71 @@ def parse_game_finished_event_as_game_attempt(data: dict) -> models.GameAttempt:
         at=dt.datetime.strptime(data['occurred_at'], '%Y-%m-%dT%H:%M:%S'))
 
 
+def _encode_compact_game_finished_event(game: models.Game, ip: str, occurred_at: dt.datetime) -> str:
+    flags = 0
+    if game.result.white_score:
+        flags |= _WHITE_WINS_FLAG
+    packed_ip = _pack_ip(ip)
+    if len(packed_ip) == 16:
+        flags |= _IPV6_FLAG
+    header = _COMPACT_EVENT_HEADER.pack(
+        _COMPACT_EVENT_VERSION, flags, _pack_game_id(game.game_id),
+        game.white_id, game.black_id, utils.convert_to_unix_ts(occurred_at))
+    return base64.b64encode(header + packed_ip).decode('ascii')
+
+
+def _decode_compact_game_finished_event(body: str) -> tp.Tuple[models.Game, models.GameAttempt]:
+    data = base64.b64decode(body)
+    version, flags, game_id, white_id, black_id, occurred_at = _COMPACT_EVENT_HEADER.unpack_from(data)
+    if version != _COMPACT_EVENT_VERSION:
+        raise UnknownEventVersion(f'unknown game_finished event version {version}')
+    if flags & _WHITE_WINS_FLAG:
+        result = models.WHITE_WINS_RESULT
+    else:
+        result = models.BLACK_WINS_RESULT
+    family = socket.AF_INET6 if flags & _IPV6_FLAG else socket.AF_INET
+    ip = socket.inet_ntop(family, data[_COMPACT_EVENT_HEADER.size:])
+    game = models.Game(game_id=game_id.hex(), white_id=white_id, black_id=black_id, result=result)
+    attempt = models.GameAttempt(ip=ip, at=dt.datetime.utcfromtimestamp(occurred_at))
+    return game, attempt
+
+
+def _pack_game_id(game_id: str) -> bytes:
+    packed = bytes.fromhex(game_id)
+    # bytes.fromhex is lenient (uppercase, whitespace), but decoding should give the same game_id
+    if len(packed) != 16 or packed.hex() != game_id:
+        raise ValueError(f'{game_id!a} is not a uuid hex')
+    return packed
+
+
+def _pack_ip(ip: str) -> bytes:
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            return socket.inet_pton(family, ip)
+        except OSError:
+            pass
+    raise ValueError(f'{ip!a} is not an ip address')
+
+
 @utils.log_time(loggers.web)
 async def _ensure_games_queue_is_ready(app):
     if 'games_queue' in app:
         return
-    queue_name = app['config'].sqs_games_queue_name
-    app['games_queue'] = await app['sqs_resource'].get_queue_by_name(QueueName=queue_name)
+    config = app['config']
+    if config.games_queue_backend == cfg.GamesQueueBackend.SQLITE:
+        app['games_queue'] = queues.AsyncSqliteGamesQueue(config.sqlite_games_queue_path)
+    elif config.games_queue_backend == cfg.GamesQueueBackend.POSTGRES:
+        app['games_queue'] = queues.AsyncPostgresGamesQueue(app['db_engine'])
+    else:
+        sqs_queue = await app['sqs_resource'].get_queue_by_name(QueueName=config.sqs_games_queue_name)
+        app['games_queue'] = queues.AsyncSqsGamesQueue(sqs_queue)
 
 
 @utils.log_time(loggers.games_queue)
-def process_game_finished_event(engine: ta.Engine, game: models.Game) -> None:
+def process_game_finished_event(engine: ta.Engine, game: models.Game, games_ledger: ledger.GamesLedger) -> None:
     loggers.games_queue.info('processing game %s', game)
+    if _is_already_processed(game, games_ledger):
+        return
     try:
         white_repo, black_repo = db.find_many_repos_by_function_ids(
             engine, game.white_id, game.black_id)
@@ -82,7 +175,81 @@ def process_game_finished_event(engine: ta.Engine, game: models.Game) -> None:
         raise DeletedFromDb(str(exc)) from exc
     else:
         loggers.games_queue.info('after: white is %s; black is %s', white_repo, black_repo)
+        games_ledger.add(game)
+
+
+@utils.log_time(loggers.games_queue, lambda engine, games, games_ledger: f'{len(games)} games')
+def process_many_game_finished_events(
+        engine: ta.Engine, games: tp.List[models.Game], games_ledger: ledger.GamesLedger) -> None:
+    # same ratings as processing games one by one, but with a single db commit
+    games = [a_game for a_game in games if not _is_already_processed(a_game, games_ledger)]
+    if not games:
+        return
+    for attempt in range(1, _MAX_NUM_SAVE_ATTEMPTS + 1):
+        try:
+            _try_to_process_many_game_finished_events(engine, games, games_ledger)
+            return
+        except db.GamesAlreadySaved:
+            if attempt == _MAX_NUM_SAVE_ATTEMPTS:
+                raise
+            # games saved concurrently are found on the next attempt, ratings are recomputed without them
+            loggers.games_queue.info('recomputing ratings of %d games', len(games), exc_info=True)
+
+
+def _try_to_process_many_game_finished_events(
+        engine: ta.Engine, games: tp.List[models.Game], games_ledger: ledger.GamesLedger) -> None:
+    game_by_id = db.find_many_games_by_ids(engine, [a_game.game_id for a_game in games])
+    function_ids = list({fn_id for a_game in games for fn_id in [a_game.white_id, a_game.black_id]})
+    repo_by_function_id = db.find_repos_by_function_ids(engine, function_ids)
+    games_to_save = []
+    games_to_remember = []
+    changed_repo_by_id = {}
+    for a_game in games:
+        if a_game.game_id in game_by_id:
+            if game_by_id[a_game.game_id].result != a_game.result:
+                loggers.games_queue.info('someone is trying to change result of finished game %s', a_game)
+            else:
+                games_to_remember.append(a_game)
+            continue
+        try:
+            match = _make_match(a_game, repo_by_function_id)
+        except DeletedFromDb:
+            loggers.games_queue.error(
+                'pymash_event:error:deleted_from_db skipping handling of game %s', a_game.game_id,
+                exc_info=True)
+            continue
+        except models.MatchWithYourselfError:
+            loggers.games_queue.error(
+                'pymash_event:error:same_repo skipping handling of game %s', a_game.game_id)
+            continue
+        match.change_ratings()
+        games_to_save.append(a_game)
+        game_by_id[a_game.game_id] = a_game
+        for a_repo in [match.white, match.black]:
+            changed_repo_by_id[a_repo.repo_id] = a_repo
+    db.save_many_games_and_ratings(engine, games_to_save, list(changed_repo_by_id.values()))
+    loggers.games_queue.info('saved %d/%d games', len(games_to_save), len(games))
+    for a_game in games_to_remember + games_to_save:
+        games_ledger.add(a_game)
+
+
+def _is_already_processed(game: models.Game, games_ledger: ledger.GamesLedger) -> bool:
+    processed_result = games_ledger.get_result(game.game_id)
+    if processed_result is None:
+        return False
+    if processed_result != game.result:
+        loggers.games_queue.info('someone is trying to change result of finished game %s', game)
+    else:
+        loggers.games_queue.info('game %s is already processed', game)
+    return True
+
+
+def _make_match(game: models.Game, repo_by_function_id: tp.Dict[int, models.Repo]) -> models.Match:
+    for fn_id in [game.white_id, game.black_id]:
+        if fn_id not in repo_by_function_id:
+            raise DeletedFromDb(f'function {fn_id} does not exist')
+    return models.Match(repo_by_function_id[game.white_id], repo_by_function_id[game.black_id], game.result)
 
 
-def _get_user_ip(request: web.Request) -> str:
+def get_user_ip(request: web.Request) -> str:
     return request.headers['X-Forwarded-For'].split(', ')[0]
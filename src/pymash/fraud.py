@@ -1,25 +1,109 @@
+import array
 import collections
+import contextlib
 import datetime as dt
+import gc
+import ipaddress
+import itertools
+import json
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import time
 import typing as tp
+import zlib
 
+from pymash import cfg
 from pymash import loggers
 from pymash import models
+from pymash import utils
+
+RATE_LIMIT = 1
+WINDOW = dt.timedelta(seconds=10)
+BAN_DURATION = dt.timedelta(minutes=30)
+MAX_NUM_ATTEMPTS_WITHOUT_GC = 10_000
+NUM_SQLITE_SHARDS = 4
+SKETCH_WIDTH = 2 ** 16
+SKETCH_DEPTH = 4
+
+# ipv4 addresses are mapped to ::ffff:0:0/96, so all ips fit into 16 bytes
+_IPV4_MAPPED_PREFIX = 0xffff << 32
+_PACKED_IP_SIZE = 16
+
+# snapshot file: header, 16-byte big-endian int ips, newline-separated ips that aren't ip addresses,
+# then little-endian arrays: number of second buckets per ip,
+# flat (unix_ts, num_attempts) buckets, ban end per ip (nan if not banned)
+_SNAPSHOT_MAGIC = b'PMWS'
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = struct.Struct('<4sBQQQQ')
+_SNAPSHOT_ARRAY_TYPECODES = ['I', 'q', 'd']
+
+# ban list file: header, records of 16-byte big-endian int ips with ban ends sorted by ip,
+# then json with ban ends of ips that aren't ip addresses
+_BAN_LIST_MAGIC = b'PMBL'
+_BAN_LIST_VERSION = 1
+_BAN_LIST_HEADER = struct.Struct('<4sBQQ')
+_BAN_LIST_RECORD = struct.Struct(f'>{_PACKED_IP_SIZE}sd')
+
+# noinspection SqlNoDataSourceInspection
+_SQLITE_SCHEMA = [
+    'PRAGMA journal_mode=WAL',
+    '''CREATE TABLE IF NOT EXISTS attempts (
+         ip TEXT NOT NULL,
+         unix_ts INTEGER NOT NULL,
+         num_attempts INTEGER NOT NULL,
+         PRIMARY KEY (ip, unix_ts)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS bans (
+         ip TEXT NOT NULL PRIMARY KEY,
+         end_unix_ts REAL NOT NULL,
+         reason TEXT NOT NULL) WITHOUT ROWID''',
+]
+
+
+class BaseError(Exception):
+    pass
+
+
+class SnapshotError(BaseError):
+    pass
+
+
+class BanListError(BaseError):
+    pass
 
 
 class _BanDetails:
+    __slots__ = ()
+
     def is_banned_at(self, datetime: dt.datetime) -> bool:
         raise NotImplementedError
 
+    def get_end_unix_ts(self) -> float:
+        raise NotImplementedError
+
 
 class _NotBannedDetails(_BanDetails):
+    __slots__ = ()
+
     def is_banned_at(self, datetime: dt.datetime) -> bool:
         return False
 
+    def get_end_unix_ts(self) -> float:
+        return math.nan
+
     def __repr__(self):
         return '_NotBannedDetails()'
 
 
+_NOT_BANNED = _NotBannedDetails()
+
+
 class _BannedDetails(_BanDetails):
+    __slots__ = ('_end', '_reason')
+
     def __init__(self, end, reason):
         self._end = end
         self._reason = reason
@@ -27,17 +111,41 @@ class _BannedDetails(_BanDetails):
     def is_banned_at(self, datetime: dt.datetime) -> bool:
         return datetime < self._end
 
+    def get_end_unix_ts(self) -> float:
+        return self._end.replace(tzinfo=dt.timezone.utc).timestamp()
+
     def __repr__(self):
         return f'_BannedDetails(end={self._end!a}, reason={self._reason!a})'
 
 
 class _User:
+    # one of these is kept per ip, so during distributed attacks their size matters
+    __slots__ = ('_buckets', '_ban_details')
+
     def __init__(self):
-        self._num_attempts_by_unix_ts = collections.Counter()
-        self._ban_details = _NotBannedDetails()
+        # flat [unix_ts, num_attempts, unix_ts, num_attempts, ...] list is several times smaller than a Counter
+        self._buckets: tp.List[int] = []
+        self._ban_details: _BanDetails = _NOT_BANNED
+
+    @classmethod
+    def restore(cls, buckets: tp.List[int], ban_end_unix_ts: float) -> '_User':
+        user = cls()
+        user._buckets = buckets
+        if not math.isnan(ban_end_unix_ts):
+            user.ban(dt.datetime.utcfromtimestamp(ban_end_unix_ts), 'restored from snapshot')
+        return user
 
     def record_attempt_at(self, datetime: dt.datetime) -> None:
-        self._num_attempts_by_unix_ts[_convert_to_unix_ts(datetime)] += 1
+        self.record_attempt_at_unix_ts(utils.convert_to_unix_ts(datetime))
+
+    def record_attempt_at_unix_ts(self, unix_ts: int) -> None:
+        buckets = self._buckets
+        for i in range(0, len(buckets), 2):
+            if buckets[i] == unix_ts:
+                buckets[i + 1] += 1
+                return
+        buckets.append(unix_ts)
+        buckets.append(1)
 
     def ban(self, end, reason) -> None:
         self._ban_details = _BannedDetails(end, reason)
@@ -45,15 +153,57 @@ class _User:
     def is_banned_at(self, datetime: dt.datetime) -> bool:
         return self._ban_details.is_banned_at(datetime)
 
+    def get_buckets(self) -> tp.List[int]:
+        return self._buckets
+
+    def get_ban_end_unix_ts(self) -> float:
+        return self._ban_details.get_end_unix_ts()
+
     def get_num_attempts_in_interval(self, start: dt.datetime, end: dt.datetime) -> int:
         num_attempts = 0
-        start_ts = _convert_to_unix_ts(start)
-        end_ts = _convert_to_unix_ts(end)
-        for ts, count in self._num_attempts_by_unix_ts.items():
-            if start_ts <= ts < end_ts:
-                num_attempts += count
+        start_ts = utils.convert_to_unix_ts(start)
+        end_ts = utils.convert_to_unix_ts(end)
+        buckets = self._buckets
+        for i in range(0, len(buckets), 2):
+            if start_ts <= buckets[i] < end_ts:
+                num_attempts += buckets[i + 1]
         return num_attempts
 
+    def get_max_num_attempts_in_windows(self, unix_ts: int, window_seconds: int) -> int:
+        # max among all windows containing unix_ts, with a single pass over the buckets
+        first_ts = unix_ts - window_seconds + 1
+        counts = [0] * (2 * window_seconds - 1)
+        buckets = self._buckets
+        for i in range(0, len(buckets), 2):
+            if 0 <= buckets[i] - first_ts < len(counts):
+                counts[buckets[i] - first_ts] += buckets[i + 1]
+        window_count = sum(counts[:window_seconds])
+        max_count = window_count
+        for i in range(window_seconds, len(counts)):
+            window_count += counts[i] - counts[i - window_seconds]
+            max_count = max(max_count, window_count)
+        return max_count
+
+
+class SubnetLevel:
+    def __init__(self, name: str, ipv4_prefix_len: int, ipv6_prefix_len: int, rate_limit: float) -> None:
+        self.name = name
+        self.ipv4_shift = 32 - ipv4_prefix_len
+        self.ipv6_shift = 128 - ipv6_prefix_len
+        self.rate_limit = rate_limit
+
+    def __repr__(self):
+        cls_name = self.__class__.__name__
+        return f'{cls_name}(name={self.name!a}, rate_limit={self.rate_limit})'
+
+
+# there is no asn database at hand, so /16 and /48 are a rough proxy for an autonomous system
+SUBNET_LEVELS = [
+    SubnetLevel('ip', ipv4_prefix_len=32, ipv6_prefix_len=128, rate_limit=RATE_LIMIT),
+    SubnetLevel('subnet', ipv4_prefix_len=24, ipv6_prefix_len=64, rate_limit=10 * RATE_LIMIT),
+    SubnetLevel('asn', ipv4_prefix_len=16, ipv6_prefix_len=48, rate_limit=50 * RATE_LIMIT),
+]
+
 
 class BaseWatchman:
     def add(self, now: dt.datetime, attempt: models.GameAttempt) -> None:
@@ -62,6 +212,19 @@ class BaseWatchman:
     def is_banned_at(self, ip: str, datetime: dt.datetime) -> bool:
         raise NotImplementedError
 
+    # returns ids of games that should be skipped because their ips are banned
+    def add_many(self, now: dt.datetime,
+                 games_and_attempts: tp.List[tp.Tuple[models.Game, models.GameAttempt]]) -> tp.Set[str]:
+        skipped_game_ids = set()
+        for game, attempt in games_and_attempts:
+            self.add(now, attempt)
+            if self.is_banned_at(attempt.ip, now):
+                skipped_game_ids.add(game.game_id)
+        return skipped_game_ids
+
+    def close(self) -> None:
+        pass
+
 
 class KindWatchman(BaseWatchman):
     def add(self, now: dt.datetime, attempt: models.GameAttempt) -> None:
@@ -78,14 +241,18 @@ class Watchman(BaseWatchman):
         assert window.total_seconds().is_integer()
         self._rate_limit = rate_limit
         self._window = window
+        self._window_seconds = int(window.total_seconds())
         self._ban_duration = ban_duration
-        self._user_by_ip: tp.Dict[str, _User] = collections.defaultdict(_User)
+        self._user_by_ip: tp.Dict[tp.Union[int, str], _User] = collections.defaultdict(_User)
+        # banned ips are few, so they are tracked separately to publish them without a full scan
+        self._banned_ips: tp.Set[tp.Union[int, str]] = set()
+        self._bans_version = 0
         self._num_attempts_without_gc = 0
         self._max_num_attempts_without_gc = max_num_attempts_without_gc
 
     def add(self, now: dt.datetime, attempt: models.GameAttempt) -> None:
         self._num_attempts_without_gc += 1
-        user = self._user_by_ip[attempt.ip]
+        user = self._user_by_ip[_pack_ip(attempt.ip)]
         user.record_attempt_at(attempt.at)
         for datetime in self._rate_affecting_datetimes(attempt):
             rate = self._get_rate(user, start=datetime)
@@ -95,13 +262,77 @@ class Watchman(BaseWatchman):
         self._gc(now)
 
     def is_banned_at(self, ip: str, datetime: dt.datetime) -> bool:
-        user = self._user_by_ip[ip]
-        return user.is_banned_at(datetime)
+        user = self._user_by_ip.get(_pack_ip(ip))
+        return user is not None and user.is_banned_at(datetime)
+
+    def add_many(self, now: dt.datetime,
+                 games_and_attempts: tp.List[tp.Tuple[models.Game, models.GameAttempt]]) -> tp.Set[str]:
+        self._num_attempts_without_gc += len(games_and_attempts)
+        skipped_game_ids = set()
+        # attempts of the same ip go one after another in time order, so each ip is packed
+        # and looked up once per batch, and the result is the same as if they came one by one
+        sorted_games_and_attempts = sorted(games_and_attempts, key=_get_attempt_ip_and_at)
+        for ip, ip_games_and_attempts in itertools.groupby(sorted_games_and_attempts, key=_get_attempt_ip):
+            user = self._user_by_ip[_pack_ip(ip)]
+            for game, attempt in ip_games_and_attempts:
+                unix_ts = utils.convert_to_unix_ts(attempt.at)
+                user.record_attempt_at_unix_ts(unix_ts)
+                rate = user.get_max_num_attempts_in_windows(unix_ts, self._window_seconds) / self._window_seconds
+                if rate > self._rate_limit:
+                    self._ban(attempt=attempt, user=user, rate=rate, now=now)
+                if user.is_banned_at(now):
+                    skipped_game_ids.add(game.game_id)
+        self._gc(now)
+        return skipped_game_ids
 
     @property
     def num_ips(self) -> int:
         return len(self._user_by_ip)
 
+    # changes every time a new ban is added
+    @property
+    def bans_version(self) -> int:
+        return self._bans_version
+
+    def get_ban_end_unix_ts_by_ip(self) -> tp.Dict[tp.Union[int, str], float]:
+        return {
+            ip: self._user_by_ip[ip].get_ban_end_unix_ts()
+            for ip in self._banned_ips
+        }
+
+    @utils.log_time(loggers.games_queue, lambda self, path: repr(path))
+    def save_snapshot(self, path: str) -> None:
+        int_ips = [ip for ip in self._user_by_ip if isinstance(ip, int)]
+        str_ips = [ip for ip in self._user_by_ip if isinstance(ip, str)]
+        # int ips go first, so the file doesn't need a per ip type marker
+        users = [self._user_by_ip[ip] for ip in itertools.chain(int_ips, str_ips)]
+        num_buckets = array.array('I')
+        buckets = array.array('q')
+        ban_end_unix_timestamps = array.array('d')
+        for user in users:
+            user_buckets = user.get_buckets()
+            num_buckets.append(len(user_buckets) // 2)
+            buckets.extend(user_buckets)
+            ban_end_unix_timestamps.append(user.get_ban_end_unix_ts())
+        _write_snapshot(path, int_ips, str_ips, [num_buckets, buckets, ban_end_unix_timestamps])
+
+    @utils.log_time(loggers.games_queue, lambda self, path: repr(path))
+    def load_snapshot(self, path: str) -> None:
+        ips, (num_buckets, buckets, ban_end_unix_timestamps) = _read_snapshot(path)
+        user_by_ip = collections.defaultdict(_User)
+        banned_ips = set()
+        bucket_iter = iter(buckets.tolist())
+        # millions of new objects trigger lots of useless gc passes
+        with _gc_disabled():
+            for ip, ip_num_buckets, ban_end_unix_ts in zip(ips, num_buckets, ban_end_unix_timestamps):
+                user_buckets = list(itertools.islice(bucket_iter, 2 * ip_num_buckets))
+                user_by_ip[ip] = _User.restore(user_buckets, ban_end_unix_ts)
+                if not math.isnan(ban_end_unix_ts):
+                    banned_ips.add(ip)
+        self._user_by_ip = user_by_ip
+        self._banned_ips = banned_ips
+        self._bans_version += 1
+
     def _rate_affecting_datetimes(self, attempt: models.GameAttempt) -> tp.Iterable[dt.datetime]:
         at_exact_sec = attempt.at.replace(microsecond=0)
         start = at_exact_sec - self._window + dt.timedelta(seconds=1)
@@ -115,6 +346,8 @@ class Watchman(BaseWatchman):
         reason = f'cur_rate is {rate}, rate_limit is {self._rate_limit}'
         end = now + self._ban_duration
         user.ban(end, reason)
+        self._banned_ips.add(_pack_ip(attempt.ip))
+        self._bans_version += 1
         loggers.games_queue.info('pymash_event:banned_ip %s till %s because %s', attempt.ip, end, reason)
 
     def _needs_gc(self) -> bool:
@@ -123,14 +356,445 @@ class Watchman(BaseWatchman):
     def _gc(self, now: dt.datetime) -> None:
         if not self._needs_gc():
             return
-        for ip in list(self._user_by_ip):
-            if not self.is_banned_at(ip, now):
+        for ip, user in list(self._user_by_ip.items()):
+            if not user.is_banned_at(now):
                 del self._user_by_ip[ip]
+        self._banned_ips.intersection_update(self._user_by_ip)
+        self._num_attempts_without_gc = 0
+
+
+class SubnetWatchman(BaseWatchman):
+    # Attempts are counted per ip, per /24 (/64 for ipv6) and per /16 (/48) with separate limits,
+    # so attackers rotating ips inside a subnet get the whole subnet banned.
+    # Counters live in count-min sketches, one per second of the window, so memory doesn't depend
+    # on the number of distinct ips, and each attempt costs a fixed number of counter updates.
+    # Sketches can only overestimate counts, so limits should have some headroom.
+    def __init__(self, levels: tp.List[SubnetLevel], window: dt.timedelta, ban_duration: dt.timedelta,
+                 sketch_width: int, sketch_depth: int, max_num_attempts_without_gc: int) -> None:
+        assert window.total_seconds() >= 1
+        assert window.total_seconds().is_integer()
+        self._levels = levels
+        self._window_seconds = int(window.total_seconds())
+        self._ban_duration = ban_duration
+        self._sketch_width = sketch_width
+        self._sketch_depth = sketch_depth
+        self._empty_sketch = array.array('I', bytes(4 * sketch_width * sketch_depth))
+        self._sketches = [array.array('I', self._empty_sketch) for _ in range(self._window_seconds)]
+        self._sketch_unix_timestamps: tp.List[tp.Optional[int]] = [None] * self._window_seconds
+        self._ban_end_by_key: tp.Dict[tp.Tuple[int, tp.Union[int, str]], dt.datetime] = {}
+        self._num_attempts_without_gc = 0
+        self._max_num_attempts_without_gc = max_num_attempts_without_gc
+
+    def add(self, now: dt.datetime, attempt: models.GameAttempt) -> None:
+        self._num_attempts_without_gc += 1
+        unix_ts = utils.convert_to_unix_ts(attempt.at)
+        sketch = self._get_sketch(unix_ts)
+        window_sketches = self._get_window_sketches(unix_ts)
+        for key in self._get_keys(attempt.ip):
+            indexes = self._get_sketch_indexes(key)
+            if sketch is not None:
+                for an_index in indexes:
+                    sketch[an_index] += 1
+            count = min(sum(a_sketch[an_index] for a_sketch in window_sketches) for an_index in indexes)
+            rate = count / self._window_seconds
+            if rate > self._levels[key[0]].rate_limit:
+                self._ban(attempt, key, rate, now)
+        self._gc(now)
+
+    def is_banned_at(self, ip: str, datetime: dt.datetime) -> bool:
+        for key in self._get_keys(ip):
+            ban_end = self._ban_end_by_key.get(key)
+            if ban_end is not None and datetime < ban_end:
+                return True
+        return False
+
+    def _get_keys(self, ip: str) -> tp.List[tp.Tuple[int, tp.Union[int, str]]]:
+        packed_ip = _pack_ip(ip)
+        if isinstance(packed_ip, str):
+            # subnets make sense only for ip addresses
+            return [(0, packed_ip)]
+        if packed_ip >> 32 == _IPV4_MAPPED_PREFIX >> 32:
+            return [(i, packed_ip >> a_level.ipv4_shift) for i, a_level in enumerate(self._levels)]
+        return [(i, packed_ip >> a_level.ipv6_shift) for i, a_level in enumerate(self._levels)]
+
+    def _get_sketch_indexes(self, key: tp.Tuple[int, tp.Union[int, str]]) -> tp.List[int]:
+        return [
+            row * self._sketch_width + hash((row, key)) % self._sketch_width
+            for row in range(self._sketch_depth)
+        ]
+
+    def _get_sketch(self, unix_ts: int) -> tp.Optional[array.array]:
+        slot = unix_ts % self._window_seconds
+        slot_unix_ts = self._sketch_unix_timestamps[slot]
+        if slot_unix_ts is not None and slot_unix_ts > unix_ts:
+            # the attempt is older than the window, so it can't affect rates anymore
+            return None
+        if slot_unix_ts != unix_ts:
+            self._sketches[slot][:] = self._empty_sketch
+            self._sketch_unix_timestamps[slot] = unix_ts
+        return self._sketches[slot]
+
+    def _get_window_sketches(self, unix_ts: int) -> tp.List[array.array]:
+        return [
+            a_sketch
+            for a_sketch, sketch_unix_ts in zip(self._sketches, self._sketch_unix_timestamps)
+            if sketch_unix_ts is not None and unix_ts - self._window_seconds < sketch_unix_ts <= unix_ts
+        ]
+
+    def _ban(self, attempt: models.GameAttempt, key: tp.Tuple[int, tp.Union[int, str]], rate: float,
+             now: dt.datetime) -> None:
+        level = self._levels[key[0]]
+        reason = f'cur_rate is {rate}, rate_limit is {level.rate_limit}'
+        end = now + self._ban_duration
+        self._ban_end_by_key[key] = end
+        loggers.games_queue.info('pymash_event:banned_ip %s at level %s till %s because %s',
+                                 attempt.ip, level.name, end, reason)
+
+    def _gc(self, now: dt.datetime) -> None:
+        if self._num_attempts_without_gc < self._max_num_attempts_without_gc:
+            return
+        self._ban_end_by_key = {
+            key: ban_end
+            for key, ban_end in self._ban_end_by_key.items()
+            if now < ban_end
+        }
+        self._num_attempts_without_gc = 0
+
+
+class BanListWatchman(BaseWatchman):
+    # Web tier side of the in-memory watchman: the worker publishes its bans with write_ban_list,
+    # web workers mmap the file, so banned ips get rejected before their games are queued.
+    # Int ips are sorted fixed size records, so a lookup is a binary search right in the mapped file.
+    RELOAD_INTERVAL_SECONDS = 1
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._file_id = None
+        self._mmap: tp.Optional[mmap.mmap] = None
+        self._num_int_ips = 0
+        self._ban_end_unix_ts_by_str_ip: tp.Dict[str, float] = {}
+        self._checked_at: tp.Optional[float] = None
+
+    def add(self, now: dt.datetime, attempt: models.GameAttempt) -> None:
+        # bans come from the worker
+        pass
+
+    def is_banned_at(self, ip: str, datetime: dt.datetime) -> bool:
+        self._reload_if_changed()
+        packed_ip = _pack_ip(ip)
+        if isinstance(packed_ip, str):
+            ban_end_unix_ts = self._ban_end_unix_ts_by_str_ip.get(packed_ip)
+        else:
+            ban_end_unix_ts = self._find_ban_end_unix_ts(packed_ip)
+        if ban_end_unix_ts is None:
+            return False
+        return datetime.replace(tzinfo=dt.timezone.utc).timestamp() < ban_end_unix_ts
+
+    def close(self) -> None:
+        self._unload()
+
+    def _find_ban_end_unix_ts(self, ip: int) -> tp.Optional[float]:
+        key = ip.to_bytes(_PACKED_IP_SIZE, 'big')
+        lo = 0
+        hi = self._num_int_ips
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record_ip, ban_end_unix_ts = _BAN_LIST_RECORD.unpack_from(
+                self._mmap, _BAN_LIST_HEADER.size + mid * _BAN_LIST_RECORD.size)
+            if record_ip == key:
+                return ban_end_unix_ts
+            if record_ip < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.RELOAD_INTERVAL_SECONDS:
+            return
+        self._checked_at = now
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            file_id = None
+        else:
+            file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if file_id == self._file_id:
+            return
+        self._unload()
+        if file_id is not None:
+            try:
+                self._load()
+            except BanListError:
+                loggers.web.error('could not load ban list, ignoring it', exc_info=True)
+                self._unload()
+        self._file_id = file_id
+
+    def _load(self) -> None:
+        with open(self._path, 'rb') as fobj:
+            # empty files can't be mapped
+            if os.fstat(fobj.fileno()).st_size < _BAN_LIST_HEADER.size:
+                raise BanListError(f'ban list {self._path} is truncated')
+            self._mmap = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_int_ips, str_ips_size = _BAN_LIST_HEADER.unpack_from(self._mmap)
+        if magic != _BAN_LIST_MAGIC or version != _BAN_LIST_VERSION:
+            raise BanListError(f'unsupported ban list {self._path}: magic {magic!a}, version {version}')
+        str_ips_offset = _BAN_LIST_HEADER.size + num_int_ips * _BAN_LIST_RECORD.size
+        if str_ips_offset + str_ips_size != len(self._mmap):
+            raise BanListError(f'ban list {self._path} is corrupted')
+        try:
+            ban_end_unix_ts_by_str_ip = json.loads(
+                self._mmap[str_ips_offset:str_ips_offset + str_ips_size].decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            raise BanListError(f'ban list {self._path} has corrupted str ips')
+        self._num_int_ips = num_int_ips
+        self._ban_end_unix_ts_by_str_ip = ban_end_unix_ts_by_str_ip
+
+    def _unload(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = None
+        self._num_int_ips = 0
+        self._ban_end_unix_ts_by_str_ip = {}
+
+
+class SqliteWatchman(BaseWatchman):
+    # State lives in local SQLite WAL files shared by all worker and web processes on the host,
+    # so bans survive restarts and the web tier can reject banned ips before queueing their games.
+    # IPs are sharded between files to reduce write lock contention.
+    BUSY_TIMEOUT_SECONDS = 5
+
+    def __init__(self, directory: str, num_shards: int, rate_limit: float, window: dt.timedelta,
+                 ban_duration: dt.timedelta, max_num_attempts_without_gc: int) -> None:
+        assert window.total_seconds() >= 1
+        assert window.total_seconds().is_integer()
+        self._paths = [
+            os.path.join(directory, f'watchman_{i}.sqlite')
+            for i in range(num_shards)
+        ]
+        self._conns: tp.List[tp.Optional[sqlite3.Connection]] = [None] * num_shards
+        self._rate_limit = rate_limit
+        self._window_seconds = int(window.total_seconds())
+        self._ban_duration = ban_duration
         self._num_attempts_without_gc = 0
+        self._max_num_attempts_without_gc = max_num_attempts_without_gc
+
+    def add(self, now: dt.datetime, attempt: models.GameAttempt) -> None:
+        self._num_attempts_without_gc += 1
+        conn = self._get_conn(attempt.ip)
+        unix_ts = utils.convert_to_unix_ts(attempt.at)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            num_attempts_by_unix_ts = self._record_attempt(conn, attempt.ip, unix_ts)
+            rate = _get_max_rate(num_attempts_by_unix_ts, unix_ts, self._window_seconds)
+            if rate > self._rate_limit:
+                self._ban(conn, attempt, rate, now)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._gc(now)
 
+    def is_banned_at(self, ip: str, datetime: dt.datetime) -> bool:
+        row = self._get_conn(ip).execute('SELECT end_unix_ts FROM bans WHERE ip = ?', (ip,)).fetchone()
+        if row is None:
+            return False
+        return datetime.replace(tzinfo=dt.timezone.utc).timestamp() < row[0]
+
+    def close(self) -> None:
+        for a_conn in self._conns:
+            if a_conn is not None:
+                a_conn.close()
+        self._conns = [None] * len(self._conns)
+
+    def _record_attempt(self, conn, ip: str, unix_ts: int) -> tp.Dict[int, int]:
+        conn.execute('INSERT OR IGNORE INTO attempts (ip, unix_ts, num_attempts) VALUES (?, ?, 0)',
+                     (ip, unix_ts))
+        conn.execute('UPDATE attempts SET num_attempts = num_attempts + 1 WHERE ip = ? AND unix_ts = ?',
+                     (ip, unix_ts))
+        rows = conn.execute(
+            'SELECT unix_ts, num_attempts FROM attempts WHERE ip = ? AND unix_ts > ? AND unix_ts < ?',
+            (ip, unix_ts - self._window_seconds, unix_ts + self._window_seconds))
+        return dict(rows)
+
+    def _ban(self, conn, attempt: models.GameAttempt, rate: float, now: dt.datetime) -> None:
+        reason = f'cur_rate is {rate}, rate_limit is {self._rate_limit}'
+        end = now + self._ban_duration
+        conn.execute('INSERT OR REPLACE INTO bans (ip, end_unix_ts, reason) VALUES (?, ?, ?)',
+                     (attempt.ip, end.replace(tzinfo=dt.timezone.utc).timestamp(), reason))
+        loggers.games_queue.info('pymash_event:banned_ip %s till %s because %s', attempt.ip, end, reason)
+
+    def _gc(self, now: dt.datetime) -> None:
+        if self._num_attempts_without_gc < self._max_num_attempts_without_gc:
+            return
+        now_ts = utils.convert_to_unix_ts(now)
+        for shard in range(len(self._paths)):
+            conn = self._get_shard_conn(shard)
+            conn.execute('DELETE FROM attempts WHERE unix_ts <= ?', (now_ts - self._window_seconds,))
+            conn.execute('DELETE FROM bans WHERE end_unix_ts <= ?', (now_ts,))
+        self._num_attempts_without_gc = 0
 
-def _convert_to_unix_ts(datetime: dt.datetime) -> int:
-    return int(datetime.replace(tzinfo=dt.timezone.utc).timestamp())
+    def _get_conn(self, ip: str) -> sqlite3.Connection:
+        return self._get_shard_conn(zlib.crc32(ip.encode('utf-8')) % len(self._paths))
+
+    def _get_shard_conn(self, shard: int) -> sqlite3.Connection:
+        if self._conns[shard] is None:
+            conn = sqlite3.connect(self._paths[shard], timeout=self.BUSY_TIMEOUT_SECONDS, isolation_level=None)
+            for a_statement in _SQLITE_SCHEMA:
+                conn.execute(a_statement)
+            self._conns[shard] = conn
+        return self._conns[shard]
+
+
+def make_watchman(config: cfg.Config) -> BaseWatchman:
+    if not config.enable_antifraud:
+        return KindWatchman()
+    if config.watchman_backend == cfg.WatchmanBackend.SQLITE:
+        return SqliteWatchman(
+            directory=config.watchman_sqlite_dir,
+            num_shards=NUM_SQLITE_SHARDS,
+            rate_limit=RATE_LIMIT,
+            window=WINDOW,
+            ban_duration=BAN_DURATION,
+            max_num_attempts_without_gc=MAX_NUM_ATTEMPTS_WITHOUT_GC)
+    if config.watchman_backend == cfg.WatchmanBackend.SUBNET:
+        return SubnetWatchman(
+            levels=SUBNET_LEVELS,
+            window=WINDOW,
+            ban_duration=BAN_DURATION,
+            sketch_width=SKETCH_WIDTH,
+            sketch_depth=SKETCH_DEPTH,
+            max_num_attempts_without_gc=MAX_NUM_ATTEMPTS_WITHOUT_GC)
+    watchman = Watchman(
+        rate_limit=RATE_LIMIT,
+        window=WINDOW,
+        ban_duration=BAN_DURATION,
+        max_num_attempts_without_gc=MAX_NUM_ATTEMPTS_WITHOUT_GC)
+    if config.watchman_snapshot_path and os.path.exists(config.watchman_snapshot_path):
+        try:
+            watchman.load_snapshot(config.watchman_snapshot_path)
+        except SnapshotError:
+            loggers.games_queue.error('could not load watchman snapshot, starting from scratch', exc_info=True)
+    return watchman
+
+
+@contextlib.contextmanager
+def _gc_disabled():
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def _write_snapshot(
+        path: str, int_ips: tp.List[int], str_ips: tp.List[str], arrays: tp.List[array.array]) -> None:
+    str_ips_data = '\n'.join(str_ips).encode('utf-8')
+    header = _SNAPSHOT_HEADER.pack(
+        _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, len(int_ips), len(str_ips), len(arrays[1]), len(str_ips_data))
+    with _open_for_atomic_write(path) as fobj:
+        fobj.write(header)
+        fobj.write(b''.join(ip.to_bytes(_PACKED_IP_SIZE, 'big') for ip in int_ips))
+        fobj.write(str_ips_data)
+        for an_array in arrays:
+            if sys.byteorder != 'little':
+                an_array.byteswap()
+            an_array.tofile(fobj)
+
+
+@contextlib.contextmanager
+def _open_for_atomic_write(path: str) -> tp.Iterator[tp.BinaryIO]:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as fobj:
+        yield fobj
+        fobj.flush()
+        os.fsync(fobj.fileno())
+    # readers see either the old file or the new one, never a partially written file
+    os.replace(tmp_path, path)
+
+
+def write_ban_list(path: str, ban_end_unix_ts_by_ip: tp.Dict[tp.Union[int, str], float]) -> None:
+    int_ip_records = sorted(
+        (ip.to_bytes(_PACKED_IP_SIZE, 'big'), ban_end_unix_ts)
+        for ip, ban_end_unix_ts in ban_end_unix_ts_by_ip.items()
+        if isinstance(ip, int))
+    str_ips_data = json.dumps({
+        ip: ban_end_unix_ts
+        for ip, ban_end_unix_ts in ban_end_unix_ts_by_ip.items()
+        if isinstance(ip, str)
+    }).encode('utf-8')
+    with _open_for_atomic_write(path) as fobj:
+        fobj.write(_BAN_LIST_HEADER.pack(_BAN_LIST_MAGIC, _BAN_LIST_VERSION, len(int_ip_records), len(str_ips_data)))
+        fobj.write(b''.join(_BAN_LIST_RECORD.pack(*a_record) for a_record in int_ip_records))
+        fobj.write(str_ips_data)
+
+
+def _read_snapshot(path: str) -> tp.Tuple[tp.List[tp.Union[int, str]], tp.List[array.array]]:
+    with open(path, 'rb') as fobj:
+        data = fobj.read()
+    if len(data) < _SNAPSHOT_HEADER.size:
+        raise SnapshotError(f'snapshot {path} is truncated')
+    magic, version, num_int_ips, num_str_ips, num_bucket_ints, str_ips_size = _SNAPSHOT_HEADER.unpack_from(data)
+    if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+        raise SnapshotError(f'unsupported snapshot {path}: magic {magic!a}, version {version}')
+    offset = _SNAPSHOT_HEADER.size
+    int_ips_end = offset + num_int_ips * _PACKED_IP_SIZE
+    ips: tp.List[tp.Union[int, str]] = [
+        int.from_bytes(data[ip_offset:ip_offset + _PACKED_IP_SIZE], 'big')
+        for ip_offset in range(offset, int_ips_end, _PACKED_IP_SIZE)
+    ]
+    offset = int_ips_end
+    if num_str_ips:
+        ips.extend(data[offset:offset + str_ips_size].decode('utf-8').split('\n'))
+    offset += str_ips_size
+    num_ips = num_int_ips + num_str_ips
+    arrays = []
+    for typecode, size in zip(_SNAPSHOT_ARRAY_TYPECODES, [num_ips, num_bucket_ints, num_ips]):
+        an_array = array.array(typecode)
+        num_bytes = size * an_array.itemsize
+        if offset + num_bytes > len(data):
+            raise SnapshotError(f'snapshot {path} is truncated')
+        an_array.frombytes(data[offset:offset + num_bytes])
+        if sys.byteorder != 'little':
+            an_array.byteswap()
+        arrays.append(an_array)
+        offset += num_bytes
+    if len(ips) != num_ips:
+        raise SnapshotError(f'snapshot {path} is corrupted')
+    return ips, arrays
+
+
+def _get_attempt_ip(game_and_attempt: tp.Tuple[models.Game, models.GameAttempt]) -> str:
+    return game_and_attempt[1].ip
+
+
+def _get_attempt_ip_and_at(
+        game_and_attempt: tp.Tuple[models.Game, models.GameAttempt]) -> tp.Tuple[str, dt.datetime]:
+    return game_and_attempt[1].ip, game_and_attempt[1].at
+
+
+def _pack_ip(ip: str) -> tp.Union[int, str]:
+    # ints are several times smaller than strs. X-Forwarded-For can contain anything,
+    # so whatever isn't an ip address is kept as is.
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 4:
+        return _IPV4_MAPPED_PREFIX | int(address)
+    return int(address)
+
+
+def _get_max_rate(num_attempts_by_unix_ts: tp.Dict[int, int], unix_ts: int, window_seconds: int) -> float:
+    # max rate among all windows containing unix_ts
+    max_count = 0
+    for start in range(unix_ts - window_seconds + 1, unix_ts + 1):
+        count = sum(num_attempts_by_unix_ts.get(ts, 0) for ts in range(start, start + window_seconds))
+        max_count = max(max_count, count)
+    return max_count / window_seconds
 
 
 def _datetimes_between(first: dt.datetime, last: dt.datetime, step: dt.timedelta) -> tp.Iterable[dt.datetime]:
@@ -0,0 +1,25 @@
+import collections
+import typing as tp
+
+from pymash import models
+
+
+class GamesLedger:
+    # bounded memory of recently processed games:
+    # redelivered messages are skipped without touching the database
+    def __init__(self, max_size: int) -> None:
+        assert max_size > 0
+        self._max_size = max_size
+        self._result_by_game_id: tp.Dict[str, models.BaseResult] = collections.OrderedDict()
+
+    def get_result(self, game_id: str) -> tp.Optional[models.BaseResult]:
+        return self._result_by_game_id.get(game_id)
+
+    def add(self, game: models.Game) -> None:
+        self._result_by_game_id[game.game_id] = game.result
+        self._result_by_game_id.move_to_end(game.game_id)
+        while len(self._result_by_game_id) > self._max_size:
+            self._result_by_game_id.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._result_by_game_id)
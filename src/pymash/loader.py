@@ -1,9 +1,18 @@
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import glob
-import multiprocessing
+import hashlib
+import heapq
+import io
 import os
 import random
 import re
+import signal
 import tempfile
+import threading
+import time
 import typing as tp
 import zipfile
 
@@ -14,6 +23,7 @@ from pymash import cfg
 from pymash import db
 from pymash import loggers
 from pymash import models
+from pymash import near_duplicates
 from pymash import parser
 from pymash import type_aliases as ta
 from pymash import utils
@@ -29,7 +39,16 @@ class Selector:
     MIN_NUM_STATEMENTS = 4
     NUM_FUNCTIONS_PER_REPO = 1000
     MIN_NUM_FUNCTIONS_PER_REPO = 20
-    NOT_IMPLEMENTED_RE = re.compile(r'raise\s+NotImplementedError')
+    # generated modules and vendored blobs stall parsing and almost never have good functions
+    MAX_FILE_BYTES = 2 ** 20
+    MAX_FILE_LINES = 20_000
+    MAX_FILE_PARSE_SECONDS = 5.0
+    # files are parsed in chunks of about this size, big files get a chunk of their own
+    MAX_PARSE_CHUNK_BYTES = 2 ** 20
+    # more chunks than workers, so workers don't wait for the one with the slowest chunk
+    NUM_PARSE_CHUNKS_PER_WORKER = 4
+    # chunks submitted ahead of the one being consumed, results of the rest aren't held in memory
+    NUM_PENDING_PARSE_CHUNKS_PER_WORKER = 2
     TEST_FILE_PATH_RE = re.compile(r'test', re.IGNORECASE)
 
 
@@ -40,14 +59,34 @@ def load_most_popular(
         limit: int,
         whitelisted_full_names: ta.SetOfStrings = (),
         blacklisted_full_names: ta.SetOfStrings = (),
-        concurrency: int = 1) -> None:
+        concurrency: int = 1,
+        parse_concurrency: int = 1) -> None:
     github_client = _get_github_client()
     github_repos = _find_most_popular_github_repos(github_client, language, limit)
     github_repos.extend(_find_github_repos(github_client, whitelisted_full_names))
     github_repos = _exclude_blacklisted(github_repos, blacklisted_full_names)
 
-    loaded_repos = _load_many_github_repos(github_repos, concurrency=concurrency)
+    loaded_repos = _load_many_github_repos(
+        github_repos, concurrency=concurrency, parse_concurrency=parse_concurrency)
     db.deactivate_all_other_repos(engine, loaded_repos)
+    _deactivate_near_duplicates(engine)
+    db.renumber_function_slots(engine)
+
+
+@utils.log_time(loggers.loader)
+def _deactivate_near_duplicates(engine: ta.Engine) -> None:
+    # repos are loaded in different processes, so the index is built after all of them are in the db
+    index = near_duplicates.NearDuplicatesIndex()
+    num_functions = 0
+    duplicate_ids = []
+    for function_id, text in db.iter_active_functions_ids_and_texts(engine):
+        num_functions += 1
+        if index.find_or_add(function_id, text) is not None:
+            duplicate_ids.append(function_id)
+    db.deactivate_many_functions(engine, duplicate_ids)
+    loggers.loader.info('deactivated %d near duplicates of %d functions', len(duplicate_ids), num_functions)
+    # e.g. vendored forks lose all their functions
+    db.deactivate_repos_with_few_active_functions(engine, Selector.MIN_NUM_FUNCTIONS_PER_REPO)
 
 
 def _find_github_repos(github_client, full_names) -> ta.GithubRepos:
@@ -104,24 +143,32 @@ def _unzip_file(path: str, output_dir: str) -> None:
 
 @utils.log_time(
     loggers.loader,
-    lambda github_repos, concurrency:
-    f'{len(github_repos)} github repos, concurrency {concurrency}'
+    lambda github_repos, concurrency, parse_concurrency:
+    f'{len(github_repos)} github repos, concurrency {concurrency}, parse concurrency {parse_concurrency}'
 )
-def _load_many_github_repos(github_repos: ta.GithubRepos, concurrency: int) -> ta.Repos:
+def _load_many_github_repos(
+        github_repos: ta.GithubRepos, concurrency: int, parse_concurrency: int) -> ta.Repos:
     loggers.loader.info(
-        'will load %d github repos, concurrency %d', len(github_repos), concurrency)
-    pool = multiprocessing.Pool(concurrency)
-    maybe_repos = pool.map(load_github_repo, github_repos)
+        'will load %d github repos, concurrency %d, parse concurrency %d',
+        len(github_repos), concurrency, parse_concurrency)
+    load = functools.partial(load_github_repo, parse_concurrency=parse_concurrency)
+    if concurrency == 1:
+        maybe_repos = list(map(load, github_repos))
+    else:
+        # unlike multiprocessing.Pool workers, executor workers aren't daemonic
+        # and can start parsing processes of their own
+        with concurrent.futures.ProcessPoolExecutor(concurrency) as executor:
+            maybe_repos = list(executor.map(load, github_repos))
     return list(filter(None, maybe_repos))
 
 
 # TODO: maybe separate parsing & saving to database
-@utils.log_time(loggers.loader, lambda github_repo: github_repo.full_name)
-def load_github_repo(github_repo: models.GithubRepo) -> tp.Optional[models.Repo]:
+@utils.log_time(loggers.loader, lambda github_repo, parse_concurrency=1: github_repo.full_name)
+def load_github_repo(
+        github_repo: models.GithubRepo, parse_concurrency: int = 1) -> tp.Optional[models.Repo]:
     loggers.loader.info('loading repo %s', github_repo.full_name)
     with base.ScriptContext() as context:
-        functions = _get_functions_from_github_repo(github_repo)
-        functions_to_add = _select_functions_to_add(functions)
+        functions_to_add = _get_functions_from_github_repo(github_repo, parse_concurrency)
         if len(functions_to_add) >= Selector.MIN_NUM_FUNCTIONS_PER_REPO:
             return db.upsert_repo(context.engine, github_repo, functions_to_add)
         else:
@@ -131,11 +178,12 @@ def load_github_repo(github_repo: models.GithubRepo) -> tp.Optional[models.Repo]
             return None
 
 
-def _get_functions_from_github_repo(github_repo: models.GithubRepo) -> tp.Set[parser.Function]:
+def _get_functions_from_github_repo(
+        github_repo: models.GithubRepo, parse_concurrency: int) -> ta.ParserFunctions:
     with tempfile.NamedTemporaryFile() as temp_file:
         with utils.log_time(loggers.loader, f'fetching {github_repo.zipball_url}'):
             _urlretrieve(github_repo.zipball_url, temp_file.name)
-        return _get_functions_from_zip_archive(temp_file.name, github_repo)
+        return _get_functions_from_zip_archive(temp_file.name, github_repo, parse_concurrency)
 
 
 def _urlretrieve(url, output_path):
@@ -146,37 +194,171 @@ def _urlretrieve(url, output_path):
 
 
 def _get_functions_from_zip_archive(
-        archive_path: str, github_repo: models.GithubRepo) -> tp.Set[parser.Function]:
+        archive_path: str, github_repo: models.GithubRepo, parse_concurrency: int) -> ta.ParserFunctions:
     with tempfile.TemporaryDirectory() as temp_dir:
         with utils.log_time(loggers.loader, f'unzipping {archive_path}'):
             _unzip_file(archive_path, temp_dir)
-        return _get_functions_from_directory(temp_dir, github_repo)
+        return _get_functions_from_directory(temp_dir, github_repo, parse_concurrency)
 
 
 def _get_functions_from_directory(
-        dir_path: str, github_repo: models.GithubRepo) -> tp.Set[parser.Function]:
-    functions = set()
-    parser_options = parser.Options(catch_exceptions=True, verbose=False)
+        dir_path: str, github_repo: models.GithubRepo, parse_concurrency: int = 1) -> ta.ParserFunctions:
+    # Files are parsed one by one and only a sample of good functions is kept,
+    # so memory doesn't grow with the size of the repo.
+    counts = collections.Counter()
     with utils.log_time(loggers.loader, f'parsing {github_repo.url}'):
         py_files = _find_files(dir_path, extension='py')
-        for a_file in py_files:
-            functions.update(parser.get_functions(a_file, parser_options))
-    loggers.loader.info('found %d distinct functions in %d files', len(functions), len(py_files))
-    return functions
-
-
-def _select_functions_to_add(functions: tp.Set[parser.Function]) -> ta.ParserFunctions:
-    with utils.log_time(loggers.loader, f'select good functions from {len(functions)} functions'):
-        good_functions = select_good_functions(functions)
-        loggers.loader.info('selected %d/%d good functions', len(good_functions), len(functions))
-        functions_to_add = _select_random_functions(good_functions)
-        loggers.loader.info('selected %d/%d random functions', len(functions_to_add), len(good_functions))
+        good_functions = _iter_good_functions(py_files, counts, parse_concurrency)
+        distinct_functions = _iter_distinct_functions(good_functions, counts)
+        functions_to_add = _sample_functions(distinct_functions, Selector.NUM_FUNCTIONS_PER_REPO)
+    loggers.loader.info('found %d functions in %d files', counts['functions'], len(py_files))
+    loggers.loader.info(
+        'skipped %d/%d files in %s: %d too big, %d with too many lines, %d timed out after %.1fs',
+        counts['too_big_files'] + counts['too_long_files'] + counts['timed_out_files'], len(py_files),
+        github_repo.url, counts['too_big_files'], counts['too_long_files'], counts['timed_out_files'],
+        counts['timed_out_seconds'])
+    loggers.loader.info(
+        'selected %d/%d good functions, %d of them distinct',
+        counts['good'], counts['functions'], counts['distinct'])
+    loggers.loader.info('selected %d/%d random functions', len(functions_to_add), counts['distinct'])
     return functions_to_add
 
 
-def _select_random_functions(functions: tp.List[parser.Function]) -> tp.List[parser.Function]:
-    num_functions = min(Selector.NUM_FUNCTIONS_PER_REPO, len(functions))
-    return random.sample(functions, num_functions)
+def _iter_good_functions(
+        py_files: tp.List[str], counts: tp.Counter[str], parse_concurrency: int) -> tp.Iterator[parser.Function]:
+    if parse_concurrency == 1:
+        chunks_results = map(_parse_and_select, ([a_file] for a_file in py_files))
+        yield from _iter_chunks_results(chunks_results, counts)
+    else:
+        chunks = _make_parse_chunks(py_files, parse_concurrency)
+        with concurrent.futures.ProcessPoolExecutor(parse_concurrency) as executor:
+            max_num_pending = parse_concurrency * Selector.NUM_PENDING_PARSE_CHUNKS_PER_WORKER
+            chunks_results = _map_with_lookahead(executor, _parse_and_select, chunks, max_num_pending)
+            yield from _iter_chunks_results(chunks_results, counts)
+
+
+def _map_with_lookahead(
+        executor: concurrent.futures.Executor, fn: tp.Callable, items: tp.Iterable,
+        max_num_pending: int) -> tp.Iterator:
+    # executor.map submits all items at once and keeps all their results until they're consumed
+    pending = collections.deque()
+    for an_item in items:
+        if len(pending) >= max_num_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, an_item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _iter_chunks_results(
+        chunks_results: tp.Iterable[tp.Tuple[tp.Counter[str], ta.ParserFunctions]],
+        counts: tp.Counter[str]) -> tp.Iterator[parser.Function]:
+    for chunk_counts, good_functions in chunks_results:
+        counts.update(chunk_counts)
+        counts['good'] += len(good_functions)
+        yield from good_functions
+
+
+def _parse_and_select(py_files: tp.List[str]) -> tp.Tuple[tp.Counter[str], ta.ParserFunctions]:
+    # runs in worker processes: only good functions and counts are sent back
+    parser_options = parser.Options(catch_exceptions=True, verbose=False)
+    counts = collections.Counter()
+    good_functions = []
+    for a_file in py_files:
+        functions = _parse_file(a_file, parser_options, counts)
+        counts['functions'] += len(functions)
+        good_functions.extend(select_good_functions(functions))
+    return counts, good_functions
+
+
+def _parse_file(path: str, parser_options: parser.Options, counts: tp.Counter[str]) -> ta.ParserFunctions:
+    if os.path.getsize(path) > Selector.MAX_FILE_BYTES:
+        counts['too_big_files'] += 1
+        return []
+    with open(path, 'rb') as fileobj:
+        data = fileobj.read()
+    if data.count(b'\n') > Selector.MAX_FILE_LINES:
+        counts['too_long_files'] += 1
+        return []
+    started_at = time.monotonic()
+    try:
+        with _deadline(Selector.MAX_FILE_PARSE_SECONDS):
+            fileobj = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+            return parser.get_functions_from_fileobj(fileobj, path, parser_options)
+    except _DeadlineExceeded:
+        loggers.loader.info('skipped %s, because parsing took too long', path)
+        counts['timed_out_files'] += 1
+        counts['timed_out_seconds'] += time.monotonic() - started_at
+        return []
+
+
+class _DeadlineExceeded(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def _deadline(seconds: float):
+    # SIGALRM is delivered between bytecodes: a single long ast.parse call isn't interrupted,
+    # size limits above keep it short.
+    # Signal handlers can be set only in the main thread, other threads parse without a deadline.
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _raise_deadline_exceeded(signum, frame):
+        raise _DeadlineExceeded
+
+    prev_handler = signal.signal(signal.SIGALRM, _raise_deadline_exceeded)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, prev_handler)
+
+
+def _make_parse_chunks(py_files: tp.List[str], parse_concurrency: int) -> tp.List[tp.List[str]]:
+    size_by_file = {a_file: os.path.getsize(a_file) for a_file in py_files}
+    num_chunks = parse_concurrency * Selector.NUM_PARSE_CHUNKS_PER_WORKER
+    chunk_bytes = min(Selector.MAX_PARSE_CHUNK_BYTES, sum(size_by_file.values()) // num_chunks)
+    chunks = []
+    cur_chunk = []
+    cur_chunk_bytes = 0
+    # biggest files go first, so the slowest chunks don't end up in the tail
+    for a_file in sorted(py_files, key=size_by_file.__getitem__, reverse=True):
+        cur_chunk.append(a_file)
+        cur_chunk_bytes += size_by_file[a_file]
+        if cur_chunk_bytes >= chunk_bytes:
+            chunks.append(cur_chunk)
+            cur_chunk = []
+            cur_chunk_bytes = 0
+    if cur_chunk:
+        chunks.append(cur_chunk)
+    return chunks
+
+
+def _iter_distinct_functions(
+        functions: tp.Iterable[parser.Function], counts: tp.Counter[str]) -> tp.Iterator[parser.Function]:
+    seen_digests = set()
+    for a_function in functions:
+        digest = hashlib.blake2b(a_function.text.encode('utf-8'), digest_size=16).digest()
+        if digest not in seen_digests:
+            seen_digests.add(digest)
+            counts['distinct'] += 1
+            yield a_function
+
+
+def _sample_functions(functions: tp.Iterable[parser.Function], k: int) -> ta.ParserFunctions:
+    # bottom-k sample: k functions with the smallest random keys, it's uniform without replacement
+    heap = []
+    for i, a_function in enumerate(functions):
+        # index breaks ties, so functions are never compared
+        item = (-random.random(), i, a_function)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return [a_function for _, _, a_function in heap]
 
 
 def _find_files(directory: str, extension: str) -> tp.List[str]:
@@ -192,43 +374,28 @@ def _find_files(directory: str, extension: str) -> tp.List[str]:
 
 
 def select_good_functions(functions: tp.Iterable[parser.Function]) -> ta.ParserFunctions:
-    return [
-        a_function
-        for a_function in functions
-        if not _is_bad_function(a_function)
-    ]
+    # Checks run column-wise: each one goes over the candidates that survived the previous ones,
+    # so expensive checks see only a small part of functions.
+    candidates = list(functions)
+    for a_check in _CHECKS:
+        candidates = [a_function for a_function in candidates if not a_check(a_function)]
+    return candidates
 
 
 def _is_test_file(path):
     return Selector.TEST_FILE_PATH_RE.search(path) is not None
 
 
-def _is_bad_function(fn: parser.Function) -> bool:
-    checks = [
-        _has_bad_name,
-        _is_too_short,
-        _is_too_long,
-        _has_too_few_statements,
-        _has_too_long_line,
-        _has_too_many_comment_lines,
-        _raises_not_implemented_error,
-        _is_init_method,
-    ]
-    if any(a_check(fn) for a_check in checks):
-        return True
-    return False
-
-
 def _has_bad_name(fn: parser.Function) -> bool:
     return Selector.BAD_FUNCTION_NAME_RE.search(fn.name) is not None
 
 
 def _is_too_short(fn: parser.Function) -> bool:
-    return len(fn.lines) < Selector.MIN_NUM_LINES
+    return fn.num_lines < Selector.MIN_NUM_LINES
 
 
 def _is_too_long(fn: parser.Function) -> bool:
-    return len(fn.lines) > Selector.MAX_NUM_LINES
+    return fn.num_lines > Selector.MAX_NUM_LINES
 
 
 def _has_too_few_statements(fn: parser.Function) -> bool:
@@ -236,17 +403,30 @@ def _has_too_few_statements(fn: parser.Function) -> bool:
 
 
 def _has_too_long_line(fn: parser.Function) -> bool:
-    return any(len(a_line) > Selector.MAX_LINE_LENGTH for a_line in fn.lines)
+    return fn.max_line_length > Selector.MAX_LINE_LENGTH
 
 
 def _has_too_many_comment_lines(fn: parser.Function) -> bool:
-    num_comment_lines = sum(1 for a_line in fn.lines if parser.is_comment_line(a_line))
-    return num_comment_lines > Selector.MAX_NUM_COMMENT_LINES
+    return fn.num_comment_lines > Selector.MAX_NUM_COMMENT_LINES
 
 
 def _raises_not_implemented_error(fn: parser.Function) -> bool:
-    return Selector.NOT_IMPLEMENTED_RE.search(fn.text) is not None
+    return 'NotImplementedError' in fn.raised_names
 
 
 def _is_init_method(fn: parser.Function) -> bool:
     return fn.name == '__init__'
+
+
+# Ordered by cost per rejected function measured with scripts/benchmark_loader.py on a large repo:
+# checks comparing features precomputed by the parser go first, regex checks go last.
+_CHECKS = [
+    _has_too_few_statements,
+    _is_too_short,
+    _is_too_long,
+    _is_init_method,
+    _has_too_many_comment_lines,
+    _raises_not_implemented_error,
+    _has_bad_name,
+    _has_too_long_line,
+]
@@ -1,4 +1,5 @@
 import argparse
+import functools
 
 import aioboto3
 from aiohttp import web
@@ -6,9 +7,13 @@ from aiopg import sa
 
 from pymash import appenv
 from pymash import cfg
+from pymash import fraud
 from pymash import loggers
+from pymash import prefetch
 from pymash import routes
+from pymash import static
 from pymash import utils
+from pymash import views
 
 ACCESS_LOG_FORMAT = '%t %a %{X-Forwarded-For}i "%r" %s %b %Tf "%{Referer}i" "%{User-Agent}i'
 
@@ -26,19 +31,30 @@ def main():
 def create_app() -> web.Application:
     app = web.Application()
     app['config'] = cfg.get_config()
+    _load_static_assets(app)
     _setup_startup_cleanup(app)
     routes.setup_routes(app)
     appenv.setup_jinja2(app)
     return app
 
 
+@utils.log_time(loggers.web)
+def _load_static_assets(app: web.Application) -> None:
+    static_build_dir = app['config'].static_build_dir
+    app['static_assets'] = static.load(static_build_dir) if static_build_dir else None
+
+
 def _setup_startup_cleanup(app: web.Application) -> None:
     app.on_startup.append(_setup_logging)
     app.on_startup.append(_create_engine)
     app.on_startup.append(_create_sqs_resource)
+    app.on_startup.append(_create_watchman)
+    app.on_startup.append(_start_games_prefetcher)
 
+    app.on_cleanup.append(_stop_games_prefetcher)
     app.on_cleanup.append(_close_engine)
     app.on_cleanup.append(_close_sqs_resource)
+    app.on_cleanup.append(_close_watchman)
 
 
 # noinspection PyUnusedLocal
@@ -73,6 +89,40 @@ async def _close_sqs_resource(app: web.Application) -> None:
     await app['sqs_resource'].close()
 
 
+@utils.log_time(loggers.web)
+async def _create_watchman(app: web.Application) -> None:
+    # web tier only consults the watchman: bans are shared with the worker
+    # via sqlite backend or via the ban list published by the in-memory one
+    config = app['config']
+    if config.enable_antifraud and config.watchman_backend == cfg.WatchmanBackend.SQLITE:
+        app['watchman'] = fraud.make_watchman(config)
+    elif config.enable_antifraud and config.ban_list_path:
+        app['watchman'] = fraud.BanListWatchman(config.ban_list_path)
+    else:
+        app['watchman'] = fraud.KindWatchman()
+
+
+@utils.log_time(loggers.web)
+async def _close_watchman(app: web.Application) -> None:
+    app['watchman'].close()
+
+
+@utils.log_time(loggers.web)
+async def _start_games_prefetcher(app: web.Application) -> None:
+    # games are found and highlighted in the background, show_game only renders them
+    games_prefetch_size = app['config'].games_prefetch_size
+    if games_prefetch_size > 0:
+        app['games_prefetcher'] = prefetch.Prefetcher(
+            functools.partial(views.prepare_game, app), max_size=games_prefetch_size, name='games')
+        app['games_prefetcher'].start(app.loop)
+
+
+@utils.log_time(loggers.web)
+async def _stop_games_prefetcher(app: web.Application) -> None:
+    if 'games_prefetcher' in app:
+        await app['games_prefetcher'].close()
+
+
 def _parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', default='localhost')
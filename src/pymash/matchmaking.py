@@ -0,0 +1,49 @@
+import bisect
+import random
+import typing as tp
+
+from pymash import models
+
+# Black repo is picked among repos with rating within this distance from the white one:
+# games between repos of similar strength carry more information than foregone conclusions.
+RATING_WINDOW = 200
+
+
+class BaseError(Exception):
+    pass
+
+
+class NotEnoughRepos(BaseError):
+    pass
+
+
+class Matchmaker:
+    def __init__(self, repos: tp.List[models.Repo], rating_window: float = RATING_WINDOW) -> None:
+        sorted_repos = sorted(repos, key=lambda a_repo: a_repo.rating)
+        self._repo_ids = [a_repo.repo_id for a_repo in sorted_repos]
+        self._ratings = [a_repo.rating for a_repo in sorted_repos]
+        self._rating_window = rating_window
+
+    def __len__(self) -> int:
+        return len(self._repo_ids)
+
+    def pick_two_repo_ids(self) -> tp.Tuple[int, int]:
+        num_repos = len(self._repo_ids)
+        if num_repos < 2:
+            raise NotEnoughRepos(f'need at least 2 repos, got {num_repos}')
+        white_index = random.randrange(num_repos)
+        begin, end = self._get_window(white_index)
+        black_index = random.randrange(begin, end - 1)
+        if black_index >= white_index:
+            black_index += 1
+        return self._repo_ids[white_index], self._repo_ids[black_index]
+
+    def _get_window(self, white_index: int) -> tp.Tuple[int, int]:
+        rating = self._ratings[white_index]
+        begin = bisect.bisect_left(self._ratings, rating - self._rating_window)
+        end = bisect.bisect_right(self._ratings, rating + self._rating_window)
+        if end - begin < 2:
+            # repo is alone in its window, the closest neighbours are the best we have
+            begin = max(0, white_index - 1)
+            end = min(len(self._ratings), white_index + 2)
+        return begin, end
@@ -0,0 +1,107 @@
+import array
+import operator
+import re
+import typing as tp
+import zlib
+
+# Signatures use one permutation hashing: every shingle is hashed once into one of NUM_BINS bins
+# and the bin keeps the minimum, empty bins borrow values from the next non empty bin.
+# It's NUM_BINS times cheaper than computing NUM_BINS independent minhashes.
+NUM_BINS = 64
+NUM_BANDS = 8
+ROWS_PER_BAND = NUM_BINS // NUM_BANDS
+SHINGLE_SIZE = 3
+# functions with estimated jaccard similarity of token shingles above this are near duplicates
+SIMILARITY_THRESHOLD = 0.8
+
+# bytes pattern: tokens are hashed as bytes, non ascii characters are split into one byte tokens
+_TOKEN_RE = re.compile(rb'\w+|[^\w\s]')
+_BIN_BITS = NUM_BINS.bit_length() - 1
+_VALUE_MASK = 2 ** 32 - 1
+_EMPTY = _VALUE_MASK + 1
+_GOLDEN_RATIO_32 = 0x9e3779b1
+
+assert NUM_BINS == 2 ** _BIN_BITS
+assert NUM_BANDS * ROWS_PER_BAND == NUM_BINS
+
+
+class NearDuplicatesIndex:
+    # LSH index: near duplicates share all rows of at least one band with high probability,
+    # so a lookup checks NUM_BANDS buckets instead of all added items.
+    def __init__(self, similarity_threshold: float = SIMILARITY_THRESHOLD) -> None:
+        self._similarity_threshold = similarity_threshold
+        self._item_ids = array.array('q')
+        self._signatures = array.array('I')
+        # bucket keeps only the first item, the next ones are found through other bands
+        self._item_index_by_band_key = [{} for _ in range(NUM_BANDS)]
+
+    def __len__(self) -> int:
+        return len(self._item_ids)
+
+    def find_or_add(self, item_id: int, text: str) -> tp.Optional[int]:
+        # returns id of the near duplicate added before, text is not added in this case
+        signature = get_signature(text)
+        if signature is None:
+            return None
+        band_keys = _get_band_keys(signature)
+        for item_index_by_band_key, a_band_key in zip(self._item_index_by_band_key, band_keys):
+            item_index = item_index_by_band_key.get(a_band_key)
+            if item_index is None:
+                continue
+            if self._get_similarity(item_index, signature) >= self._similarity_threshold:
+                return self._item_ids[item_index]
+        item_index = len(self._item_ids)
+        self._item_ids.append(item_id)
+        self._signatures.extend(signature)
+        for item_index_by_band_key, a_band_key in zip(self._item_index_by_band_key, band_keys):
+            item_index_by_band_key.setdefault(a_band_key, item_index)
+        return None
+
+    def _get_similarity(self, item_index: int, signature: array.array) -> float:
+        begin = item_index * NUM_BINS
+        return estimate_similarity(signature, self._signatures[begin:begin + NUM_BINS])
+
+
+def get_signature(text: str) -> tp.Optional[array.array]:
+    tokens = _TOKEN_RE.findall(text.encode('utf-8'))
+    if len(tokens) < SHINGLE_SIZE:
+        return None
+    # hash() of a tuple of ints, unlike hash() of strings, is the same in every process
+    token_hashes = list(map(zlib.crc32, tokens))
+    shingles = zip(*(token_hashes[i:] for i in range(SHINGLE_SIZE)))
+    mins = [_EMPTY] * NUM_BINS
+    for shingle_hash in map(hash, shingles):
+        bin_index = shingle_hash & (NUM_BINS - 1)
+        value = (shingle_hash >> _BIN_BITS) & _VALUE_MASK
+        if value < mins[bin_index]:
+            mins[bin_index] = value
+    return array.array('I', _densify(mins))
+
+
+def estimate_similarity(signature: array.array, other_signature: array.array) -> float:
+    return sum(map(operator.eq, signature, other_signature)) / NUM_BINS
+
+
+def _densify(mins: tp.List[int]) -> tp.List[int]:
+    # Empty bin takes the value of the closest non empty bin to the right (wrapping around)
+    # mixed with the distance, so two signatures agree in this bin
+    # only if they agree in the borrowed bin at the same distance.
+    densified = list(mins)
+    next_value = None
+    next_index = None
+    for i in reversed(range(2 * NUM_BINS)):
+        bin_index = i % NUM_BINS
+        if mins[bin_index] != _EMPTY:
+            next_value = mins[bin_index]
+            next_index = i
+        elif i < NUM_BINS:
+            distance = next_index - i
+            densified[bin_index] = next_value ^ ((distance * _GOLDEN_RATIO_32) & _VALUE_MASK)
+    return densified
+
+
+def _get_band_keys(signature: array.array) -> tp.List[int]:
+    return [
+        hash(signature[i:i + ROWS_PER_BAND].tobytes())
+        for i in range(0, NUM_BINS, ROWS_PER_BAND)
+    ]
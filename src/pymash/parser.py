@@ -2,20 +2,21 @@ import ast
 import copy
 import functools
 import itertools
-import math
-import numbers
 import re
 import textwrap
+import tokenize
 import typing as tp
 
 from pymash import loggers
 
-_MULTILINE_DOUBLE_QUOTES_DOCSTRING_RE = re.compile(r'[ \t]*"""(?P<docstring>.*?)"""\n', re.DOTALL)
-_MULTILINE_SINGLE_QUOTES_DOCSTRING_RE = re.compile(r"[ \t]*'''(?P<docstring>.*?)'''\n", re.DOTALL)
-
-_COMMENT_LINE_RE = re.compile('^\s*#')
 _BAD_CLASS_NAME_RE = re.compile('test', re.IGNORECASE)
 
+_OPENING_BRACKETS = frozenset('([{')
+_CLOSING_BRACKETS = frozenset(')]}')
+_NOT_SIGNIFICANT_TOKEN_TYPES = frozenset([
+    tokenize.NEWLINE, tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT,
+])
+
 
 class BaseError(Exception):
     pass
@@ -25,7 +26,7 @@ class UnknownFunctionText(BaseError):
     pass
 
 
-class TripleQuotesDocstringError(UnknownFunctionText):
+class DocstringTokenizeError(UnknownFunctionText):
     pass
 
 
@@ -70,29 +71,36 @@ class _Position:
 
 
 class Function:
-    def __init__(self, node, text: str, file_name: str) -> None:
-        self._node = node
+    # Features used by loader checks are computed once here, so selection doesn't go back to the text.
+    # AST node isn't kept: it references the whole module tree.
+    __slots__ = ('name', 'text', 'file_name', 'line_number', 'num_statements', 'raised_names',
+                 'num_lines', 'max_line_length', 'num_comment_lines')
+
+    def __init__(self, name: str, text: str, file_name: str, line_number: int, num_statements: int,
+                 raised_names: tp.FrozenSet[str]) -> None:
+        self.name = name
         self.text = text
         self.file_name = file_name
-        self._cached_lines = None
-
-    @property
-    def line_number(self) -> int:
-        return self._node.lineno
-
-    @property
-    def name(self):
-        return self._node.name
-
-    @property
-    def num_statements(self) -> int:
-        return len(self._node.body)
+        self.line_number = line_number
+        self.num_statements = num_statements
+        self.raised_names = raised_names
+        lines = text.splitlines()
+        self.num_lines = len(lines)
+        self.max_line_length = max(map(len, lines), default=0)
+        if '#' in text:
+            self.num_comment_lines = sum(1 for a_line in lines if is_comment_line(a_line))
+        else:
+            self.num_comment_lines = 0
 
-    @property
-    def lines(self) -> tp.List[str]:
-        if self._cached_lines is None:
-            self._cached_lines = self.text.splitlines()
-        return self._cached_lines
+    @classmethod
+    def from_node(cls, node, text: str, file_name: str) -> 'Function':
+        return cls(
+            name=node.name,
+            text=text,
+            file_name=file_name,
+            line_number=node.lineno,
+            num_statements=len(node.body),
+            raised_names=_get_raised_names(node))
 
     def __hash__(self) -> int:
         return hash((self.name, self.text))
@@ -140,11 +148,24 @@ def _get_functions_from_str(
             if not options.catch_exceptions:
                 raise
         else:
-            fn = Function(node=fn_node, text=text, file_name=file_name)
+            fn = Function.from_node(fn_node, text=text, file_name=file_name)
             functions.append(fn)
     return functions
 
 
+def _get_raised_names(fn_node) -> tp.FrozenSet[str]:
+    names = set()
+    for node in ast.walk(fn_node):
+        if not isinstance(node, ast.Raise) or node.exc is None:
+            continue
+        exc = node.exc.func if isinstance(node.exc, ast.Call) else node.exc
+        if isinstance(exc, ast.Name):
+            names.add(exc.id)
+        elif isinstance(exc, ast.Attribute):
+            names.add(exc.attr)
+    return frozenset(names)
+
+
 def _get_lines(source_code: str) -> tp.List[str]:
     lines = []
     cur_line_chars = []
@@ -198,72 +219,100 @@ def _iter_by_pairs(iterable: tp.Iterable) -> tp.Iterable:
 
 
 def _get_function_text(source_lines, fn_node, from_pos: _Position, to_pos: _Position) -> str:
-    docstring_info = _get_docstring_info(fn_node)
-    fn_lines = []
     relevant_lines = source_lines[from_pos.lineno - 1:to_pos.lineno - 1]
-    for lineno, line in enumerate(relevant_lines, start=from_pos.lineno):
-        chars_to_add = []
-        for col_offset, char in enumerate(line):
-            char_pos = _Position(lineno, col_offset)
-            if not docstring_info.contains(char_pos):
-                chars_to_add.append(char)
-        fn_lines.append(''.join(chars_to_add))
+    docstring_info = _get_docstring_info(fn_node, relevant_lines, from_pos)
+    fn_lines = [
+        docstring_info.cut_from_line(lineno, line)
+        for lineno, line in enumerate(relevant_lines, start=from_pos.lineno)
+    ]
     final_fn_lines = _exclude_meaningless_lines(fn_lines)
-    text = docstring_info.cut_from(''.join(final_fn_lines))
-    return textwrap.dedent(text)
+    return textwrap.dedent(''.join(final_fn_lines))
 
 
 class _BaseDocstringInfo:
-    def contains(self, pos: _Position) -> bool:
-        raise NotImplementedError
-
-    def cut_from(self, text: str) -> str:
+    def cut_from_line(self, lineno: int, line: str) -> str:
         raise NotImplementedError
 
 
 class _EmptyDocstringInfo(_BaseDocstringInfo):
-    def contains(self, pos: _Position) -> bool:
-        return False
-
-    def cut_from(self, text: str) -> str:
-        return text
+    def cut_from_line(self, lineno: int, line: str) -> str:
+        return line
 
 
 class _DocstringInfo(_BaseDocstringInfo):
+    # everything from the docstring up to the next statement is cut
     def __init__(self, begin: _Position, end: _Position) -> None:
+        assert begin < end
         self._begin = begin
         self._end = end
 
-    def contains(self, pos: _Position) -> bool:
-        # multi line docstrings are handled separately via _hacky_cut_multiline_docstring
-        # because of the python bug
-        if self._is_multi_line:
-            return False
-        return _is_position_inside(pos, self._begin, self._end)
-
-    def cut_from(self, text: str) -> str:
-        if self._is_multi_line:
-            return _hacky_cut_multiline_docstring(text)
-        return text
+    def cut_from_line(self, lineno: int, line: str) -> str:
+        if not self._begin.lineno <= lineno <= self._end.lineno:
+            return line
+        start = self._begin.column if lineno == self._begin.lineno else 0
+        stop = self._end.column if lineno == self._end.lineno else len(line)
+        return line[:start] + line[stop:]
 
-    @property
-    def _is_multi_line(self):
-        # ast has a bug: multiline strings have wrong start:
-        # (column == -1, line number is just wrong)
-        return self._begin.column == -1
 
-
-def _get_docstring_info(fn_node) -> _BaseDocstringInfo:
+def _get_docstring_info(fn_node, fn_lines: tp.List[str], from_pos: _Position) -> _BaseDocstringInfo:
     node = _get_docstring_node_or_none(fn_node)
     if node is None:
         return _EmptyDocstringInfo()
 
     if len(fn_node.body) == 1:
         raise EmptyFunctionError
-    begin = _Position.from_ast_node(node)
-    next_node = fn_node.body[1]
-    end = _Position.from_ast_node(next_node)
-    return _DocstringInfo(begin, end)
+    # ast positions of multiline strings are wrong in python < 3.8 (column is -1, line is the last one),
+    # so the docstring span is taken from tokens
+    begin, end = _find_docstring_span(fn_lines)
+    return _DocstringInfo(_shift_position(begin, from_pos), _shift_position(end, from_pos))
+
+
+def _find_docstring_span(fn_lines: tp.List[str]) -> tp.Tuple[_Position, _Position]:
+    # The docstring statement starts at the first token after the colon closing the `def` header
+    # and ends where the second statement starts. Tokens after the second statement aren't read.
+    tokens = _iter_tokens_with_depth(fn_lines)
+    try:
+        _skip_past(tokens, lambda a_token: a_token.type == tokenize.NAME and a_token.string == 'def')
+        _skip_past(tokens, lambda a_token: a_token.type == tokenize.OP and a_token.string == ':')
+        begin = _get_next_significant_token(tokens)
+        _skip_past(tokens, _is_end_of_statement)
+        end = _get_next_significant_token(tokens)
+    except (tokenize.TokenError, SyntaxError) as exc:
+        raise DocstringTokenizeError(''.join(fn_lines)) from exc
+    return _Position(*begin.start), _Position(*end.start)
+
+
+def _iter_tokens_with_depth(lines: tp.List[str]) -> tp.Iterator[tp.Tuple[tokenize.TokenInfo, int]]:
+    # depth is the number of brackets around the token, brackets themselves are outside
+    depth = 0
+    for a_token in tokenize.generate_tokens(iter(lines).__next__):
+        if a_token.type == tokenize.OP and a_token.string in _CLOSING_BRACKETS:
+            depth -= 1
+        yield a_token, depth
+        if a_token.type == tokenize.OP and a_token.string in _OPENING_BRACKETS:
+            depth += 1
+
+
+def _skip_past(tokens: tp.Iterator[tp.Tuple[tokenize.TokenInfo, int]], predicate: tp.Callable) -> None:
+    for a_token, depth in tokens:
+        if depth == 0 and predicate(a_token):
+            return
+    raise DocstringTokenizeError('unexpected end of function')
+
+
+def _get_next_significant_token(tokens: tp.Iterator[tp.Tuple[tokenize.TokenInfo, int]]) -> tokenize.TokenInfo:
+    for a_token, _ in tokens:
+        if a_token.type not in _NOT_SIGNIFICANT_TOKEN_TYPES:
+            return a_token
+    raise DocstringTokenizeError('unexpected end of function')
+
+
+def _is_end_of_statement(token: tokenize.TokenInfo) -> bool:
+    return token.type == tokenize.NEWLINE or (token.type == tokenize.OP and token.string == ';')
+
+
+def _shift_position(pos: _Position, from_pos: _Position) -> _Position:
+    return _Position(pos.lineno + from_pos.lineno - 1, pos.column)
 
 
 def _get_docstring_node_or_none(fn_node):
@@ -299,46 +348,10 @@ def _is_empty_line(s: str) -> bool:
 
 
 def is_comment_line(s: str) -> bool:
-    if _COMMENT_LINE_RE.match(s) is not None:
-        return True
-    return False
+    # same as matching ^\s*#, but several times faster
+    return s.lstrip().startswith('#')
 
 
 def _is_empty_or_comment_line(s: str) -> bool:
     return _is_empty_line(s) or is_comment_line(s)
 
-
-def _hacky_cut_multiline_docstring(text: str) -> str:
-    regexes = [
-        _MULTILINE_DOUBLE_QUOTES_DOCSTRING_RE,
-        _MULTILINE_SINGLE_QUOTES_DOCSTRING_RE,
-    ]
-    for a_regex in sorted(regexes, key=_EarliestMatch(text)):
-        if a_regex.search(text) is not None:
-            return a_regex.subn(_check_and_cut_multiline_docstring, text, count=1)[0]
-    return text
-
-
-class _EarliestMatch:
-    def __init__(self, text: str) -> None:
-        self._text = text
-
-    def __call__(self, regex) -> numbers.Number:
-        match = regex.search(self._text)
-        if match is None:
-            return math.inf
-        return match.span()[0]
-
-
-def _check_and_cut_multiline_docstring(match) -> str:
-    text = match.group('docstring')
-    if ('"""' in text) or ("'''" in text):
-        raise TripleQuotesDocstringError(text)
-    if text[-1:] == '\\':
-        raise TripleQuotesDocstringError(text)
-    return ''
-
-
-def _is_position_inside(pos: _Position, begin: _Position, end: _Position) -> bool:
-    assert end.lineno >= begin.lineno
-    return begin <= pos < end
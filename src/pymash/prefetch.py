@@ -0,0 +1,65 @@
+import asyncio
+import typing as tp
+
+from pymash import loggers
+
+
+class Prefetcher:
+    # Bounded queue of items made in the background, so a request pops a ready item
+    # instead of waiting for it to be made. Request makes the item itself when the queue is empty.
+    RETRY_DELAY_SECONDS = 1.0
+
+    def __init__(self, make_item: tp.Callable[[], tp.Awaitable], max_size: int, name: str) -> None:
+        assert max_size > 0
+        self._make_item = make_item
+        self._name = name
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._fill_task = None
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        assert self._fill_task is None
+        self._fill_task = loop.create_task(self._fill())
+
+    async def close(self) -> None:
+        if self._fill_task is not None:
+            self._fill_task.cancel()
+            try:
+                await self._fill_task
+            except asyncio.CancelledError:
+                pass
+            self._fill_task = None
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def pop_or_none(self):
+        try:
+            item = self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            self.num_misses += 1
+            loggers.web.info('pymash_event:prefetch_miss %s queue is empty, miss rate %.3f',
+                             self._name, self.miss_rate)
+            return None
+        self.num_hits += 1
+        loggers.web.info('pymash_event:prefetch_hit %s queue depth %d', self._name, len(self))
+        return item
+
+    @property
+    def miss_rate(self) -> float:
+        num_pops = self.num_hits + self.num_misses
+        return self.num_misses / num_pops if num_pops else 0.0
+
+    async def _fill(self) -> None:
+        while True:
+            try:
+                item = await self._make_item()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                loggers.web.exception('could not prefetch %s', self._name)
+                await asyncio.sleep(self.RETRY_DELAY_SECONDS)
+                continue
+            # waits here while the queue is full
+            await self._queue.put(item)
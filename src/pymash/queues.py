@@ -0,0 +1,209 @@
+import datetime as dt
+import select
+import sqlite3
+import time
+import typing as tp
+
+from pymash import db
+from pymash import type_aliases as ta
+from pymash.tables import GameEvents
+
+# noinspection SqlNoDataSourceInspection
+_SQLITE_SCHEMA = [
+    'PRAGMA journal_mode=WAL',
+    '''CREATE TABLE IF NOT EXISTS messages (
+         message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+         body TEXT NOT NULL,
+         sent_at REAL NOT NULL,
+         visible_at REAL NOT NULL)''',
+    'CREATE INDEX IF NOT EXISTS messages_visible_at_idx ON messages (visible_at)',
+]
+
+
+class BaseGamesQueue:
+    MAX_NUM_MESSAGES = 10
+
+    def send(self, body: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    # returns messages with .body, .attributes['SentTimestamp'] and .delete()
+    def receive(self, max_num_messages: int, wait_time_seconds: int) -> tp.List:
+        raise NotImplementedError
+
+
+class BaseAsyncGamesQueue:
+    async def send(self, body: str) -> None:
+        raise NotImplementedError
+
+
+class SqsGamesQueue(BaseGamesQueue):
+    def __init__(self, queue) -> None:
+        self._queue = queue
+
+    def send(self, body: str) -> None:
+        self._queue.send_message(MessageBody=body)
+
+    def receive(self, max_num_messages: int, wait_time_seconds: int) -> tp.List:
+        return self._queue.receive_messages(
+            MaxNumberOfMessages=max_num_messages,
+            WaitTimeSeconds=wait_time_seconds,
+            AttributeNames=['SentTimestamp'])
+
+
+class AsyncSqsGamesQueue(BaseAsyncGamesQueue):
+    def __init__(self, queue) -> None:
+        self._queue = queue
+
+    async def send(self, body: str) -> None:
+        await self._queue.send_message(MessageBody=body)
+
+
+class LocalMessage:
+    def __init__(self, queue: BaseGamesQueue, message_id: int, body: str, sent_at: float) -> None:
+        self._queue = queue
+        self.message_id = message_id
+        self.body = body
+        # same format as in SQS: milliseconds since epoch as a string
+        self.attributes = {'SentTimestamp': str(int(sent_at * 1000))}
+
+    def delete(self) -> None:
+        self._queue.delete(self.message_id)
+
+    def __repr__(self):
+        cls_name = self.__class__.__name__
+        return f'{cls_name}(message_id={self.message_id})'
+
+
+class SqliteGamesQueue(BaseGamesQueue):
+    # SQS-compatible queue in a local SQLite file, so the pipeline can be load-tested without AWS.
+    # Received messages are invisible for VISIBILITY_TIMEOUT_SECONDS and get redelivered
+    # if they weren't deleted during this time, just like in SQS.
+    VISIBILITY_TIMEOUT_SECONDS = 30
+    POLL_INTERVAL_SECONDS = 0.05
+    BUSY_TIMEOUT_SECONDS = 10
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._conn = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT_SECONDS, isolation_level=None)
+        for a_statement in _SQLITE_SCHEMA:
+            self._conn.execute(a_statement)
+
+    def send(self, body: str) -> None:
+        now = time.time()
+        self._conn.execute(
+            'INSERT INTO messages (body, sent_at, visible_at) VALUES (?, ?, ?)',
+            (body, now, now))
+
+    def receive(self, max_num_messages: int, wait_time_seconds: int) -> tp.List[LocalMessage]:
+        deadline = time.time() + wait_time_seconds
+        while True:
+            messages = self._claim(max_num_messages)
+            if messages or time.time() >= deadline:
+                return messages
+            time.sleep(self.POLL_INTERVAL_SECONDS)
+
+    def delete(self, message_id: int) -> None:
+        self._conn.execute('DELETE FROM messages WHERE message_id = ?', (message_id,))
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _claim(self, max_num_messages: int) -> tp.List[LocalMessage]:
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock, so concurrent consumers can't claim the same messages
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._conn.execute(
+                'SELECT message_id, body, sent_at FROM messages WHERE visible_at <= ? '
+                'ORDER BY message_id LIMIT ?',
+                (now, max_num_messages)).fetchall()
+            self._conn.executemany(
+                'UPDATE messages SET visible_at = ? WHERE message_id = ?',
+                [(now + self.VISIBILITY_TIMEOUT_SECONDS, message_id) for message_id, _, _ in rows])
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return [
+            LocalMessage(self, message_id, body, sent_at)
+            for message_id, body, sent_at in rows
+        ]
+
+
+class AsyncSqliteGamesQueue(BaseAsyncGamesQueue):
+    def __init__(self, path: str) -> None:
+        self._queue = SqliteGamesQueue(path)
+
+    async def send(self, body: str) -> None:
+        # local insert in WAL mode takes microseconds, so it's okay to block the loop
+        self._queue.send(body)
+
+
+class PostgresGamesQueue(BaseGamesQueue):
+    # game_events table in the main database: saves a network hop and SQS costs on small deployments.
+    # Events are claimed with FOR UPDATE SKIP LOCKED, so several workers can consume concurrently,
+    # and idle workers are woken up by LISTEN/NOTIFY instead of polling.
+    MAX_NUM_MESSAGES = 100
+    VISIBILITY_TIMEOUT = dt.timedelta(seconds=30)
+
+    def __init__(self, engine: ta.Engine) -> None:
+        self._engine = engine
+        self._listen_conn = None
+
+    def send(self, body: str) -> None:
+        db.save_game_event(self._engine, body)
+
+    def receive(self, max_num_messages: int, wait_time_seconds: int) -> tp.List[LocalMessage]:
+        deadline = time.time() + wait_time_seconds
+        # we should listen before claiming, otherwise we can miss a notification
+        self._ensure_listening()
+        while True:
+            messages = self._claim(max_num_messages)
+            timeout = deadline - time.time()
+            if messages or timeout <= 0:
+                return messages
+            self._wait_for_notification(timeout)
+
+    def delete(self, message_id: int) -> None:
+        db.delete_game_event(self._engine, message_id)
+
+    def close(self) -> None:
+        if self._listen_conn is not None:
+            self._listen_conn.close()
+            self._listen_conn = None
+
+    def _claim(self, max_num_messages: int) -> tp.List[LocalMessage]:
+        rows = db.claim_game_events(self._engine, max_num_messages, self.VISIBILITY_TIMEOUT)
+        return [
+            LocalMessage(self, a_row[GameEvents.c.event_id], a_row[GameEvents.c.body],
+                         a_row[GameEvents.c.created].timestamp())
+            for a_row in rows
+        ]
+
+    def _ensure_listening(self) -> None:
+        if self._listen_conn is not None:
+            return
+        self._listen_conn = self._engine.raw_connection()
+        # LISTEN connection shouldn't be reused by the pool
+        self._listen_conn.detach()
+        psycopg2_conn = self._listen_conn.connection
+        psycopg2_conn.autocommit = True
+        with psycopg2_conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {db.GAME_EVENTS_CHANNEL}')
+
+    def _wait_for_notification(self, timeout: float) -> None:
+        psycopg2_conn = self._listen_conn.connection
+        if select.select([psycopg2_conn], [], [], timeout) != ([], [], []):
+            psycopg2_conn.poll()
+            del psycopg2_conn.notifies[:]
+
+
+class AsyncPostgresGamesQueue(BaseAsyncGamesQueue):
+    def __init__(self, engine: ta.AsyncEngine) -> None:
+        self._engine = engine
+
+    async def send(self, body: str) -> None:
+        await db.send_game_event(self._engine, body)
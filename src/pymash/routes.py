@@ -13,5 +13,7 @@ def setup_routes(app: web.Application):
 
     app.router.add_get('/leaders', views.show_leaders, name='show_leaders')
 
+    app.router.add_get('/assets/{hashed_name}', views.show_asset, name='asset')
+
     app.router.add_static(
         '/static', os.path.join(os.path.dirname(__file__), 'templates', 'static'))
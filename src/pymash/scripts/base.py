@@ -3,6 +3,7 @@ import sqlalchemy as sa
 
 from pymash import cfg
 from pymash import loggers
+from pymash import queues
 from pymash import type_aliases as ta
 
 
@@ -21,6 +22,8 @@ class ScriptContext:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._games_queue is not None:
+            self._games_queue.close()
         self._engine.dispose()
 
     @property
@@ -45,12 +48,20 @@ class ScriptContext:
         return self._sqs
 
     @property
-    def games_queue(self):
+    def games_queue(self) -> queues.BaseGamesQueue:
         if self._games_queue is None:
-            self._games_queue = self.sqs.get_queue_by_name(
-                QueueName=self.config.sqs_games_queue_name)
+            self._games_queue = self._make_games_queue()
         return self._games_queue
 
+    def _make_games_queue(self) -> queues.BaseGamesQueue:
+        config = self.config
+        if config.games_queue_backend == cfg.GamesQueueBackend.SQLITE:
+            return queues.SqliteGamesQueue(config.sqlite_games_queue_path)
+        if config.games_queue_backend == cfg.GamesQueueBackend.POSTGRES:
+            return queues.PostgresGamesQueue(self.engine)
+        sqs_queue = self.sqs.get_queue_by_name(QueueName=config.sqs_games_queue_name)
+        return queues.SqsGamesQueue(sqs_queue)
+
 
 def _assert_is_set(value):
     assert value is not None, 'use ScriptContext with the `with` statement'
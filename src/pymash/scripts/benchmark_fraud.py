@@ -0,0 +1,154 @@
+import argparse
+import datetime as dt
+import os
+import random
+import resource
+import tempfile
+import time
+
+from pymash import fraud
+from pymash import models
+
+_NOW = dt.datetime(2018, 1, 31, 19, 30, 27)
+
+
+def main():
+    args = _parse_args()
+    args.func(args)
+
+
+def _benchmark_snapshot(args) -> None:
+    watchman = _make_watchman()
+    _add_many_ips(watchman, args.num_ips, args.num_attempts_per_ip)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'watchman.snapshot')
+        started_at = time.time()
+        watchman.save_snapshot(path)
+        save_duration = time.time() - started_at
+        size = os.path.getsize(path)
+
+        restored_watchman = _make_watchman()
+        started_at = time.time()
+        restored_watchman.load_snapshot(path)
+        restore_duration = time.time() - started_at
+    assert restored_watchman.num_ips == watchman.num_ips
+    print(f'tracked ips: {watchman.num_ips}')
+    print(f'snapshot size: {size / 2 ** 20:.1f}MiB, {size / watchman.num_ips:.1f} bytes per ip')
+    print(f'save: {save_duration:.2f}s')
+    print(f'restore: {restore_duration:.2f}s')
+
+
+def _benchmark_memory(args) -> None:
+    # ru_maxrss is in KiB on linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if args.watchman == 'subnet':
+        watchman = _make_subnet_watchman()
+    else:
+        watchman = _make_watchman()
+    started_at = time.time()
+    _add_many_ips(watchman, args.num_ips, args.num_attempts_per_ip)
+    duration = time.time() - started_at
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(f'tracked ips: {args.num_ips}')
+    print(f'max rss growth: {(rss_after - rss_before) / 2 ** 20:.1f}MiB, '
+          f'{(rss_after - rss_before) / args.num_ips:.1f} bytes per ip')
+    print(f'add: {args.num_ips * args.num_attempts_per_ip / duration:.0f} attempts/sec')
+
+
+def _benchmark_batch(args) -> None:
+    batches = _make_attempt_batches(args.rate, args.duration, args.num_ips, args.batch_size)
+    num_attempts = sum(len(a_batch) for a_batch in batches)
+
+    watchman = _make_watchman()
+    started_at = time.time()
+    per_item_skipped_game_ids = set()
+    for a_batch in batches:
+        for game, attempt in a_batch:
+            watchman.add(_NOW, attempt)
+            if watchman.is_banned_at(attempt.ip, _NOW):
+                per_item_skipped_game_ids.add(game.game_id)
+    per_item_duration = time.time() - started_at
+
+    watchman = _make_watchman()
+    started_at = time.time()
+    batch_skipped_game_ids = set()
+    for a_batch in batches:
+        batch_skipped_game_ids.update(watchman.add_many(_NOW, a_batch))
+    batch_duration = time.time() - started_at
+
+    print(f'attempts: {num_attempts} at {args.rate}/sec from {args.num_ips} ips, batch size {args.batch_size}')
+    print(f'skipped games: per item {len(per_item_skipped_game_ids)}, batch {len(batch_skipped_game_ids)}')
+    for name, duration in [('per item', per_item_duration), ('batch', batch_duration)]:
+        print(f'{name}: {num_attempts / duration:.0f} attempts/sec, '
+              f'{args.rate * duration / num_attempts:.0%} of a core at {args.rate}/sec')
+
+
+def _make_attempt_batches(rate: int, duration: int, num_ips: int, batch_size: int):
+    rnd = random.Random(0)
+    games_and_attempts = []
+    for i in range(rate * duration):
+        ip_index = rnd.randrange(num_ips)
+        ip = f'10.{ip_index >> 16 & 255}.{ip_index >> 8 & 255}.{ip_index & 255}'
+        at = _NOW + dt.timedelta(seconds=i / rate)
+        game = models.Game(game_id=str(i), white_id=666, black_id=777, result=models.WHITE_WINS_RESULT)
+        games_and_attempts.append((game, models.GameAttempt(ip, at)))
+    return [
+        games_and_attempts[i:i + batch_size]
+        for i in range(0, len(games_and_attempts), batch_size)
+    ]
+
+
+def _add_many_ips(watchman: fraud.BaseWatchman, num_ips: int, num_attempts_per_ip: int) -> None:
+    rnd = random.Random(0)
+    for i in range(num_ips):
+        ip = f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' if i < 2 ** 24 else f'fd00::{i:x}'
+        for _ in range(num_attempts_per_ip):
+            at = _NOW - dt.timedelta(seconds=rnd.randrange(int(fraud.WINDOW.total_seconds())))
+            watchman.add(_NOW, models.GameAttempt(ip, at))
+
+
+def _make_watchman() -> fraud.Watchman:
+    return fraud.Watchman(
+        rate_limit=fraud.RATE_LIMIT,
+        window=fraud.WINDOW,
+        ban_duration=fraud.BAN_DURATION,
+        # gc would drop not banned ips in the middle of the benchmark
+        max_num_attempts_without_gc=2 ** 62)
+
+
+def _make_subnet_watchman() -> fraud.SubnetWatchman:
+    return fraud.SubnetWatchman(
+        levels=fraud.SUBNET_LEVELS,
+        window=fraud.WINDOW,
+        ban_duration=fraud.BAN_DURATION,
+        sketch_width=fraud.SKETCH_WIDTH,
+        sketch_depth=fraud.SKETCH_DEPTH,
+        max_num_attempts_without_gc=2 ** 62)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    snapshot_parser = subparsers.add_parser('snapshot', help='snapshot size, save and restore time')
+    snapshot_parser.add_argument('--num-ips', type=int, default=1_000_000)
+    snapshot_parser.add_argument('--num-attempts-per-ip', type=int, default=2)
+    snapshot_parser.set_defaults(func=_benchmark_snapshot)
+    memory_parser = subparsers.add_parser('memory', help='memory used by tracked ips')
+    memory_parser.add_argument('--num-ips', type=int, default=1_000_000)
+    memory_parser.add_argument('--num-attempts-per-ip', type=int, default=1)
+    memory_parser.add_argument('--watchman', choices=['memory', 'subnet'], default='memory')
+    memory_parser.set_defaults(func=_benchmark_memory)
+    batch_parser = subparsers.add_parser('batch', help='per item add vs add_many')
+    batch_parser.add_argument('--rate', type=int, default=10_000, help='attempts per second')
+    batch_parser.add_argument('--duration', type=int, default=30, help='seconds of attempts')
+    batch_parser.add_argument('--num-ips', type=int, default=20_000)
+    batch_parser.add_argument('--batch-size', type=int, default=10)
+    batch_parser.set_defaults(func=_benchmark_batch)
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.error('benchmark name is required')
+    return args
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import logging
+import re
+import threading
+import time
+import types
+import typing as tp
+
+import aiohttp
+from aiohttp import web
+
+from pymash import cfg
+from pymash import fraud
+from pymash import ledger
+from pymash import loggers
+from pymash import main as pymash_main
+from pymash.scripts import base
+from pymash.scripts import process_finished_games
+
+_FORM_ACTION_RE = re.compile(r'<form action="(?P<action>[^"]+)" method="POST">')
+_HIDDEN_INPUT_RE = re.compile(r'<input type="hidden" name="(?P<name>\w+)"\s+value="(?P<value>[^"]*)"/>')
+
+
+class _Stats:
+    def __init__(self):
+        self.num_posted_games = 0
+        self.num_processed_games = 0
+        self.queue_lags = []
+        self.processing_durations = []
+        self.started_at = time.time()
+        self.last_processed_at = None
+
+    def __str__(self):
+        duration = (self.last_processed_at or time.time()) - self.started_at
+        return '\n'.join([
+            f'posted games: {self.num_posted_games}',
+            f'processed games: {self.num_processed_games}',
+            f'end to end throughput: {self.num_processed_games / duration:.1f} games/sec',
+            f'queue lag: {_format_percentiles(self.queue_lags)}',
+            f'processing latency (received to deleted): {_format_percentiles(self.processing_durations)}',
+        ])
+
+
+def main():
+    args = _parse_args()
+    loggers.setup_logging()
+    logging.getLogger('pymash').setLevel(logging.WARNING)
+    _check_games_queue_backend()
+    num_games = args.num_players * args.num_games_per_player
+    stats = _Stats()
+    worker = threading.Thread(target=_run_worker, args=(stats, num_games, args.timeout))
+    worker.start()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_run_players(args, stats))
+    worker.join()
+    print(stats)
+
+
+def _check_games_queue_backend():
+    config = cfg.get_config()
+    if config.games_queue_backend == cfg.GamesQueueBackend.SQS:
+        raise SystemExit('benchmark needs a local games queue, e.g. PYMASH_GAMES_QUEUE_BACKEND=sqlite')
+
+
+class _MeasuredGamesQueue:
+    # worker deletes a message after it's processed, so both latencies are measured around the real worker code
+    def __init__(self, games_queue, stats: _Stats) -> None:
+        self.MAX_NUM_MESSAGES = games_queue.MAX_NUM_MESSAGES
+        self._games_queue = games_queue
+        self._stats = stats
+
+    def receive(self, max_num_messages: int, wait_time_seconds: int) -> list:
+        messages = self._games_queue.receive(max_num_messages=max_num_messages, wait_time_seconds=wait_time_seconds)
+        received_at = time.time()
+        for a_message in messages:
+            sent_at = int(a_message.attributes['SentTimestamp']) / 1000
+            self._stats.queue_lags.append(received_at - sent_at)
+        return [_MeasuredMessage(a_message, received_at, self._stats) for a_message in messages]
+
+
+class _MeasuredMessage:
+    def __init__(self, message, received_at: float, stats: _Stats) -> None:
+        self.body = message.body
+        self.attributes = message.attributes
+        self._message = message
+        self._received_at = received_at
+        self._stats = stats
+
+    def delete(self) -> None:
+        self._message.delete()
+        self._stats.last_processed_at = time.time()
+        self._stats.processing_durations.append(self._stats.last_processed_at - self._received_at)
+        self._stats.num_processed_games += 1
+
+
+def _run_worker(stats: _Stats, num_games: int, timeout: float) -> None:
+    watchman = fraud.KindWatchman()
+    games_ledger = ledger.GamesLedger(max_size=num_games)
+    deadline = time.time() + timeout
+    with base.ScriptContext() as context:
+        # PYMASH_ENABLE_GAMES_COMPACTION chooses the worker path, as in production
+        process_new_messages = process_finished_games.get_process_new_messages(context.config)
+        measured_context = types.SimpleNamespace(
+            config=context.config,
+            engine=context.engine,
+            games_queue=_MeasuredGamesQueue(context.games_queue, stats))
+        while stats.num_processed_games < num_games and time.time() < deadline:
+            process_new_messages(
+                watchman=watchman, games_ledger=games_ledger, context=measured_context, wait_time_seconds=1)
+
+
+async def _run_players(args, stats: _Stats) -> None:
+    app = pymash_main.create_app()
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, args.host, args.port)
+    await site.start()
+    base_url = f'http://{args.host}:{args.port}'
+    try:
+        async with aiohttp.ClientSession() as session:
+            players = [
+                _play(session, base_url, _get_player_ip(i), args.num_games_per_player, stats)
+                for i in range(args.num_players)
+            ]
+            await asyncio.gather(*players)
+    finally:
+        await runner.cleanup()
+
+
+async def _play(session, base_url: str, ip: str, num_games: int, stats: _Stats) -> None:
+    headers = {'X-Forwarded-For': ip}
+    for _ in range(num_games):
+        async with session.get(f'{base_url}/game', headers=headers) as resp:
+            resp.raise_for_status()
+            html = await resp.text()
+        action, data = _parse_game_form(html)
+        async with session.post(f'{base_url}{action}', data=data, headers=headers,
+                                allow_redirects=False) as resp:
+            assert resp.status == 302, resp.status
+        stats.num_posted_games += 1
+
+
+def _parse_game_form(html: str) -> tp.Tuple[str, dict]:
+    action = _FORM_ACTION_RE.search(html).group('action')
+    data = {}
+    # the first form is enough: it's the vote for the white player
+    for match in _HIDDEN_INPUT_RE.finditer(html):
+        if match.group('name') in data:
+            break
+        data[match.group('name')] = match.group('value')
+    return action, data
+
+
+def _get_player_ip(player_index: int) -> str:
+    return f'10.{player_index >> 16 & 255}.{player_index >> 8 & 255}.{player_index & 255}'
+
+
+def _format_percentiles(values: tp.List[float]) -> str:
+    if not values:
+        return 'n/a'
+    sorted_values = sorted(values)
+    p50 = sorted_values[len(sorted_values) // 2]
+    p95 = sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * 0.95))]
+    return f'p50 {p50 * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms, max {sorted_values[-1] * 1000:.1f}ms'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--num-players', type=int, default=50)
+    parser.add_argument('--num-games-per-player', type=int, default=20)
+    parser.add_argument('--timeout', type=float, default=300)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import argparse
+import ast
+import os
+import random
+import resource
+import tempfile
+import time
+import typing as tp
+
+from pymash import loader
+from pymash import models
+from pymash import near_duplicates
+from pymash import parser
+
+
+def main():
+    args = _parse_args()
+    args.func(args)
+
+
+def _benchmark_select(args) -> None:
+    functions = _parse_directory(args.directory)
+    started_at = time.perf_counter()
+    for _ in range(args.num_runs):
+        good_functions = loader.select_good_functions(functions)
+    duration = (time.perf_counter() - started_at) / args.num_runs
+    print(f'selected {len(good_functions)}/{len(functions)} functions '
+          f'in {duration * 1000:.1f}ms, {len(functions) / duration:.0f} functions/sec')
+
+    # every check in isolation over all functions
+    print(f'{"check":<32} {"ns/function":>12} {"rejected":>9} {"ns/rejection":>13}')
+    for a_check in loader._CHECKS:
+        num_rejected = sum(map(a_check, functions))
+        _print_check_stats(
+            a_check.__name__, lambda: list(map(a_check, functions)),
+            num_items=len(functions), num_rejected=num_rejected)
+
+
+def _benchmark_parse(args) -> None:
+    # hit rate is the share of top level functions and methods that parser manages to extract
+    options = parser.Options(catch_exceptions=True, verbose=False)
+    num_candidates = 0
+    num_multiline_docstrings = 0
+    num_functions = 0
+    duration = 0
+    py_files = loader._find_files(args.directory, extension='py')
+    for a_file in py_files:
+        try:
+            with open(a_file, encoding='utf-8') as fileobj:
+                source_code = fileobj.read()
+        except UnicodeDecodeError:
+            continue
+        nodes = parser._get_ast_nodes(source_code, parser._get_lines(source_code), options)
+        for fn_node, _ in parser._iter_function_nodes_with_next(nodes):
+            num_candidates += 1
+            docstring_node = parser._get_docstring_node_or_none(fn_node)
+            if docstring_node is not None and '\n' in ast.literal_eval(docstring_node.value):
+                num_multiline_docstrings += 1
+        started_at = time.perf_counter()
+        num_functions += len(parser._get_functions_from_str(source_code, a_file, options))
+        duration += time.perf_counter() - started_at
+    print(f'extracted {num_functions}/{num_candidates} functions ({num_functions / num_candidates:.2%}) '
+          f'from {len(py_files)} files in {duration:.1f}s, '
+          f'{num_multiline_docstrings} functions have multiline docstrings')
+
+
+def _benchmark_scaling(args) -> None:
+    github_repo = _make_github_repo(args.directory or 'synthetic')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = args.directory
+        if directory is None:
+            directory = temp_dir
+            _write_synthetic_repo(directory, args.num_files)
+        for a_parse_concurrency in args.parse_concurrency:
+            started_at = time.perf_counter()
+            loader._get_functions_from_directory(directory, github_repo, a_parse_concurrency)
+            duration = time.perf_counter() - started_at
+            print(f'parse concurrency {a_parse_concurrency}: {duration:.1f}s')
+
+
+def _write_synthetic_repo(directory: str, num_files: int) -> None:
+    # file sizes are skewed like in real repos: most files are small, a few are huge
+    rnd = random.Random(0)
+    for i in range(num_files):
+        num_functions = min(500, int(rnd.paretovariate(1.2)))
+        functions = [
+            f'def fn_{i}_{j}(x, y):\n    z = x * {j}\n    if z > y:\n        z -= y\n    return z + {i}\n'
+            for j in range(num_functions)
+        ]
+        package_dir = os.path.join(directory, f'package_{i % 100}')
+        os.makedirs(package_dir, exist_ok=True)
+        with open(os.path.join(package_dir, f'module_{i}.py'), 'w') as fileobj:
+            fileobj.write('\n\n'.join(functions))
+
+
+def _make_github_repo(url: str) -> models.GithubRepo:
+    return models.GithubRepo(
+        github_id=0, name='benchmark', full_name='benchmark', url=url, zipball_url='', num_stars=0)
+
+
+def _benchmark_near_duplicates(args) -> None:
+    rnd = random.Random(0)
+    vocabulary = [f'name_{i}' for i in range(args.vocabulary_size)] + list('()[]{}:=+-*/.,')
+    texts = _make_texts_with_near_duplicates(rnd, vocabulary, args.num_functions, args.near_duplicates_share)
+    num_injected = len(texts) - len(set(texts)) + sum(1 for a_text in texts if a_text.startswith('copy'))
+    # ru_maxrss is in KiB on linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    index = near_duplicates.NearDuplicatesIndex()
+    started_at = time.perf_counter()
+    num_found = sum(1 for i, a_text in enumerate(texts) if index.find_or_add(i, a_text) is not None)
+    duration = time.perf_counter() - started_at
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(f'found {num_found}/{num_injected} injected near duplicates among {len(texts)} functions')
+    print(f'build: {duration:.1f}s, {len(texts) / duration:.0f} functions/sec')
+    print(f'max rss growth: {(rss_after - rss_before) / 2 ** 20:.1f}MiB, '
+          f'{(rss_after - rss_before) / len(index):.0f} bytes per indexed function')
+
+
+def _make_texts_with_near_duplicates(
+        rnd: random.Random, vocabulary: tp.List[str], num_functions: int, near_duplicates_share: float):
+    # near duplicate is a copy of an earlier function with one token changed
+    texts = []
+    for i in range(num_functions):
+        if texts and rnd.random() < near_duplicates_share:
+            tokens = rnd.choice(texts).split(' ')
+            tokens[rnd.randrange(1, len(tokens))] = rnd.choice(vocabulary)
+            texts.append(' '.join(['copy'] + tokens[1:]))
+        else:
+            num_tokens = rnd.randrange(30, 120)
+            texts.append(' '.join([f'def_{i}'] + rnd.choices(vocabulary, k=num_tokens)))
+    return texts
+
+
+def _benchmark_memory(args) -> None:
+    # ru_maxrss is in KiB on linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if args.streaming:
+        github_repo = _make_github_repo(args.directory)
+        started_at = time.perf_counter()
+        functions = loader._get_functions_from_directory(args.directory, github_repo)
+        duration = time.perf_counter() - started_at
+        print(f'selected {len(functions)} functions in {duration:.1f}s')
+    else:
+        functions = _parse_directory(args.directory)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(f'max rss growth: {(rss_after - rss_before) / 2 ** 20:.1f}MiB')
+
+
+def _print_check_stats(name: str, run: tp.Callable, num_items: int, num_rejected: int) -> None:
+    started_at = time.perf_counter()
+    run()
+    duration = time.perf_counter() - started_at
+    ns_per_rejection = f'{duration / num_rejected * 1e9:.0f}' if num_rejected else '-'
+    print(f'{name:<32} {duration / num_items * 1e9:>12.0f} {num_rejected / num_items:>9.1%} '
+          f'{ns_per_rejection:>13}')
+
+
+def _parse_directory(directory: str) -> tp.List[parser.Function]:
+    options = parser.Options(catch_exceptions=True, verbose=False)
+    functions = set()
+    started_at = time.perf_counter()
+    py_files = loader._find_files(directory, extension='py')
+    for a_file in py_files:
+        functions.update(parser.get_functions(a_file, options))
+    duration = time.perf_counter() - started_at
+    print(f'parsed {len(functions)} functions from {len(py_files)} files in {duration:.1f}s')
+    return list(functions)
+
+
+def _parse_args():
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers()
+    select_parser = subparsers.add_parser('select', help='select_good_functions throughput and check stats')
+    select_parser.add_argument('directory', help='checkout of a large repo')
+    select_parser.add_argument('--num-runs', type=int, default=5)
+    select_parser.set_defaults(func=_benchmark_select)
+    parse_parser = subparsers.add_parser('parse', help='parser throughput and hit rate')
+    parse_parser.add_argument('directory', help='checkout of a large repo')
+    parse_parser.set_defaults(func=_benchmark_parse)
+    scaling_parser = subparsers.add_parser('scaling', help='loader time by parse concurrency')
+    scaling_parser.add_argument('--directory', help='checkout of a large repo, synthetic repo by default')
+    scaling_parser.add_argument('--num-files', type=int, default=50_000, help='size of synthetic repo')
+    scaling_parser.add_argument('--parse-concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    scaling_parser.set_defaults(func=_benchmark_scaling)
+    near_duplicates_parser = subparsers.add_parser(
+        'near-duplicates', help='near duplicates index build time and memory')
+    near_duplicates_parser.add_argument('--num-functions', type=int, default=1_000_000)
+    near_duplicates_parser.add_argument('--near-duplicates-share', type=float, default=0.1)
+    near_duplicates_parser.add_argument('--vocabulary-size', type=int, default=5000)
+    near_duplicates_parser.set_defaults(func=_benchmark_near_duplicates)
+    memory_parser = subparsers.add_parser('memory', help='peak memory of parsed functions')
+    memory_parser.add_argument('directory', help='checkout of a large repo')
+    memory_parser.add_argument('--streaming', action='store_true',
+                               help='run the loader pipeline instead of keeping all parsed functions')
+    memory_parser.set_defaults(func=_benchmark_memory)
+    args = arg_parser.parse_args()
+    if not hasattr(args, 'func'):
+        arg_parser.error('benchmark name is required')
+    return args
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import contextlib
+import random
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from pymash import db
+from pymash import models
+from pymash.scripts import base
+from pymash.tables import *
+
+_BENCHMARK_GITHUB_ID = -1
+_INSERT_BATCH_SIZE = 10_000
+_RANDOM_INDEX_NAME = 'benchmark_functions_random_idx'
+
+
+def main():
+    args = _parse_args()
+    with base.ScriptContext() as context:
+        engine = context.engine
+        if args.populate:
+            _populate(engine, args.populate)
+        for name, make_query in [('random column', _make_random_column_query),
+                                 ('slots', db._make_query_to_find_two_random_functions)]:
+            print(f'=== {name}')
+            with _maybe_random_index(engine, make_query):
+                _print_explain_analyze(engine, make_query())
+                _print_duration(engine, make_query, args.num_queries)
+
+
+@contextlib.contextmanager
+def _maybe_random_index(engine, make_query):
+    # the app doesn't query the random column anymore, so its index exists only while it's benchmarked
+    if make_query is not _make_random_column_query:
+        yield
+        return
+    with engine.begin() as conn:
+        conn.execute(f'CREATE INDEX {_RANDOM_INDEX_NAME} ON functions (random)')
+        conn.execute('ANALYZE functions')
+    try:
+        yield
+    finally:
+        with engine.begin() as conn:
+            conn.execute(f'DROP INDEX {_RANDOM_INDEX_NAME}')
+
+
+def _make_random_column_query():
+    # query before slots: the function after a random value is picked, so a function after a gap is picked more often
+    def make_one():
+        is_active = Functions.c.is_active.is_(True)
+        select_max_random = Functions.select().where(is_active).with_only_columns(
+            [sa.func.max(Functions.c.random)]).as_scalar()
+        gte_than_random = Functions.c.random >= sa.func.least(random.random(), select_max_random)
+        return Functions.select().where(
+            sa.and_(gte_than_random, is_active)).order_by(Functions.c.random).limit(1)
+
+    return make_one().union_all(make_one())
+
+
+def _print_explain_analyze(engine, query) -> None:
+    compiled = query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+    with engine.connect() as conn:
+        for a_row in conn.execute(sa.text(f'EXPLAIN (ANALYZE, BUFFERS) {compiled}')):
+            print(a_row[0])
+
+
+def _print_duration(engine, make_query, num_queries: int) -> None:
+    with engine.connect() as conn:
+        started_at = time.perf_counter()
+        for _ in range(num_queries):
+            list(conn.execute(make_query()))
+        duration = time.perf_counter() - started_at
+    print(f'{num_queries} queries: {duration / num_queries * 1000:.2f}ms per query')
+
+
+def _populate(engine, num_functions: int) -> None:
+    with engine.begin() as conn:
+        repo_id = conn.execute(Repos.insert().values({
+            Repos.c.github_id: _BENCHMARK_GITHUB_ID,
+            Repos.c.name: 'benchmark',
+            Repos.c.url: 'https://github.com/benchmark/benchmark',
+            Repos.c.is_active: True,
+            Repos.c.rating: models.Repo.DEFAULT_RATING,
+        }).returning(Repos.c.repo_id)).scalar()
+        for begin in range(0, num_functions, _INSERT_BATCH_SIZE):
+            end = min(num_functions, begin + _INSERT_BATCH_SIZE)
+            conn.execute(Functions.insert(), [
+                {
+                    Functions.c.repo_id.key: repo_id,
+                    Functions.c.text.key: _make_function_text(i),
+                    Functions.c.is_active.key: True,
+                    Functions.c.file_name.key: f'benchmark/module_{i // 100}.py',
+                    Functions.c.line_number.key: i % 100 * 10 + 1,
+                }
+                for i in range(begin, end)
+            ])
+    db.renumber_function_slots(engine)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute('VACUUM ANALYZE functions')
+    print(f'inserted {num_functions} functions')
+
+
+def _make_function_text(i: int) -> str:
+    body = '\n'.join(f'    x_{j} = x * {i + j}' for j in range(8))
+    return f'def fn_{i}(x):\n{body}\n    return x_7'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--populate', type=int, default=0,
+                        help='insert this number of synthetic functions before the benchmark')
+    parser.add_argument('--num-queries', type=int, default=1000)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import tempfile
+import time
+import uuid
+
+import aiohttp_jinja2
+from aiohttp import test_utils
+from aiohttp import web
+
+from pymash import appenv
+from pymash import cfg
+from pymash import models
+from pymash import routes
+
+_FUNCTION_TEXT = '''def get_functions(path, options):
+    with open(path, encoding='utf-8') as fileobj:
+        source_code = fileobj.read()
+    return _get_functions_from_str(source_code, path, options)
+'''
+
+
+def main():
+    args = _parse_args()
+    args.func(args)
+
+
+def _benchmark_startup(args) -> None:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, bytecode_cache_dir in [('no cache', ''), ('cold cache', cache_dir), ('warm cache', cache_dir)]:
+            config = _make_config(auto_reload=False, bytecode_cache_dir=bytecode_cache_dir)
+            started_at = time.perf_counter()
+            _make_app(config)
+            duration = time.perf_counter() - started_at
+            print(f'{name}: setup_jinja2 took {duration * 1000:.1f}ms')
+
+
+def _benchmark_render(args) -> None:
+    for auto_reload in [True, False]:
+        app = _make_app(_make_config(auto_reload=auto_reload, bytecode_cache_dir=''))
+        request = test_utils.make_mocked_request('GET', '/game', app=app)
+        # request_processor runs in the middleware, it's skipped here
+        context = dict(_make_game_context(), request=request)
+        started_at = time.perf_counter()
+        for _ in range(args.num_renders):
+            aiohttp_jinja2.render_string('game.html', request, context)
+        duration = (time.perf_counter() - started_at) / args.num_renders
+        print(f'auto_reload={auto_reload}: {duration * 1e6:.0f}us per game.html render')
+
+
+def _make_config(auto_reload: bool, bytecode_cache_dir: str) -> cfg.Config:
+    config = cfg.get_config()
+    config.templates_auto_reload = auto_reload
+    config.templates_bytecode_cache_dir = bytecode_cache_dir
+    return config
+
+
+def _make_app(config: cfg.Config) -> web.Application:
+    app = web.Application()
+    app['config'] = config
+    routes.setup_routes(app)
+    appenv.setup_jinja2(app)
+    return app
+
+
+def _make_game_context() -> dict:
+    white = models.Function(function_id=1, repo_id=1, is_active=True, text=_FUNCTION_TEXT)
+    black = models.Function(function_id=2, repo_id=2, is_active=True, text=_FUNCTION_TEXT)
+    game = models.Game(game_id=uuid.uuid4().hex, white_id=1, black_id=2, result=models.UNKNOWN_RESULT)
+    return {
+        'game': game,
+        'white': white,
+        'black': black,
+        'white_html': appenv.highlight(white.text),
+        'black_html': appenv.highlight(black.text),
+        'has_already_visited': False,
+    }
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    startup_parser = subparsers.add_parser('startup', help='time to set up jinja2 with all templates loaded')
+    startup_parser.set_defaults(func=_benchmark_startup)
+    render_parser = subparsers.add_parser('render', help='game.html render time by auto_reload')
+    render_parser.add_argument('--num-renders', type=int, default=10_000)
+    render_parser.set_defaults(func=_benchmark_render)
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.error('benchmark name is required')
+    return args
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import argparse
+import os
+
+from pymash import static
+
+
+def main():
+    args = _parse_args()
+    hashed_name_by_name = static.build(args.source_dir, args.build_dir)
+    for a_name, a_hashed_name in sorted(hashed_name_by_name.items()):
+        sizes = [
+            f'{os.path.basename(a_path)} {os.path.getsize(a_path) / 1024:.1f}KiB'
+            for a_path in _get_built_paths(args.build_dir, a_hashed_name)
+        ]
+        print(f'{a_name}: {", ".join(sizes)}')
+
+
+def _get_built_paths(build_dir, hashed_name):
+    for an_extension in ['', '.gz', '.br']:
+        path = os.path.join(build_dir, hashed_name + an_extension)
+        if os.path.exists(path):
+            yield path
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('build_dir', help='directory for PYMASH_STATIC_BUILD_DIR')
+    parser.add_argument('--source-dir', default=static.SOURCE_DIR)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -21,15 +21,22 @@ def main():
             limit=args.limit,
             whitelisted_full_names=_WHITELISTED_FULL_NAMES,
             blacklisted_full_names=_BLACKLISTED_FULL_NAMES,
-            concurrency=args.concurrency)
+            concurrency=args.concurrency,
+            parse_concurrency=args.parse_concurrency)
 
 
 def _parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--concurrency', default=1, type=int)
+    parser.add_argument('--concurrency', default=1, type=int, help='number of repos loaded in parallel')
+    parser.add_argument('--parse-concurrency', default=1, type=int,
+                        help='number of processes parsing files of one repo, '
+                             'up to concurrency * parse concurrency processes parse at once')
     parser.add_argument('language')
     parser.add_argument('limit', type=int)
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.concurrency < 1 or args.parse_concurrency < 1:
+        parser.error('--concurrency and --parse-concurrency should be at least 1')
+    return args
 
 
 if __name__ == '__main__':
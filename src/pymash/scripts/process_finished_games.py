@@ -1,65 +1,140 @@
 import datetime as dt
-import json
-
 import itertools
+import signal
+import time
 
-from pymash import cfg
 from pymash import events
 from pymash import fraud
+from pymash import ledger
 from pymash import loggers
 from pymash.scripts import base
 
+_COMPACTION_WINDOW_SECONDS = 1
+_MAX_COMPACTION_BATCH_SIZE = 1000
+_GAMES_LEDGER_MAX_SIZE = 100_000
+_WATCHMAN_SNAPSHOT_INTERVAL_SECONDS = 60
+
 
-def main(iterations, wait_time_seconds=10, watchman=None):
+def main(iterations, wait_time_seconds=10, watchman=None, games_ledger=None):
     with base.ScriptContext() as context:
         if watchman is None:
-            watchman = _get_watchman(context.config)
-        for _ in iterations:
-            _process_new_messages(
-                watchman=watchman,
-                context=context,
-                wait_time_seconds=wait_time_seconds)
+            watchman = fraud.make_watchman(context.config)
+        if games_ledger is None:
+            games_ledger = ledger.GamesLedger(max_size=_GAMES_LEDGER_MAX_SIZE)
+        process_new_messages = get_process_new_messages(context.config)
+        snapshot_saved_at = time.time()
+        published_bans_version = None
+        try:
+            for _ in iterations:
+                process_new_messages(
+                    watchman=watchman,
+                    games_ledger=games_ledger,
+                    context=context,
+                    wait_time_seconds=wait_time_seconds)
+                published_bans_version = _publish_ban_list(
+                    watchman, context.config.ban_list_path, published_bans_version)
+                if time.time() - snapshot_saved_at >= _WATCHMAN_SNAPSHOT_INTERVAL_SECONDS:
+                    _save_watchman_snapshot(watchman, context.config.watchman_snapshot_path)
+                    snapshot_saved_at = time.time()
+        finally:
+            # on errors and on SIGTERM too, otherwise a restart loses the attempts since the last snapshot
+            _save_watchman_snapshot(watchman, context.config.watchman_snapshot_path)
+
+
+# noinspection PyUnusedLocal
+def _exit_on_sigterm(signum, frame):
+    loggers.games_queue.info('got signal %d, stopping', signum)
+    # SystemExit unwinds the stack, so finally blocks run
+    raise SystemExit(0)
+
+
+def _publish_ban_list(watchman, path, published_bans_version):
+    # web tier rejects banned ips using this list, the sqlite watchman shares bans by itself
+    if not path or not isinstance(watchman, fraud.Watchman):
+        return published_bans_version
+    if watchman.bans_version != published_bans_version:
+        fraud.write_ban_list(path, watchman.get_ban_end_unix_ts_by_ip())
+    return watchman.bans_version
+
+
+def _save_watchman_snapshot(watchman, path):
+    # only the in-memory watchman loses its state on restart
+    if path and isinstance(watchman, fraud.Watchman):
+        watchman.save_snapshot(path)
+
+
+def get_process_new_messages(config):
+    if config.enable_games_compaction:
+        return _process_new_messages_in_batch
+    return _process_new_messages
 
 
-def _process_new_messages(watchman, context, wait_time_seconds):
-    messages = context.games_queue.receive_messages(
-        MaxNumberOfMessages=10, WaitTimeSeconds=wait_time_seconds)
+def _process_new_messages(watchman, games_ledger, context, wait_time_seconds):
+    games_queue = context.games_queue
+    messages = games_queue.receive(
+        max_num_messages=games_queue.MAX_NUM_MESSAGES, wait_time_seconds=wait_time_seconds)
     loggers.games_queue.info('will handle %d messages', len(messages))
+    games_and_attempts = [events.decode_game_finished_event(a_message.body) for a_message in messages]
+    skipped_game_ids = _add_attempts(watchman, games_and_attempts)
+    for a_message, (game, _) in zip(messages, games_and_attempts):
+        if game.game_id not in skipped_game_ids:
+            _process_game(games_ledger, context, game)
+        a_message.delete()
+
+
+def _process_new_messages_in_batch(watchman, games_ledger, context, wait_time_seconds):
+    messages = _receive_messages_in_window(context.games_queue, wait_time_seconds)
+    loggers.games_queue.info('will handle %d messages in batch', len(messages))
+    games_and_attempts = [events.decode_game_finished_event(a_message.body) for a_message in messages]
+    skipped_game_ids = _add_attempts(watchman, games_and_attempts)
+    games = []
+    seen_game_ids = set()
+    for game, _ in games_and_attempts:
+        if game.game_id in skipped_game_ids:
+            continue
+        if game.game_id in seen_game_ids:
+            loggers.games_queue.info('skipped duplicate game %s', game.game_id)
+        else:
+            seen_game_ids.add(game.game_id)
+            games.append(game)
+    if games:
+        events.process_many_game_finished_events(context.engine, games, games_ledger)
     for a_message in messages:
-        _process_message(
-            watchman=watchman,
-            context=context,
-            message=a_message)
         a_message.delete()
 
 
-def _process_message(watchman, context, message):
-    message_dict = json.loads(message.body)
-    game = events.parse_game_finished_event_as_game(message_dict)
-    attempt = events.parse_game_finished_event_as_game_attempt(message_dict)
-    now = dt.datetime.utcnow()
-    watchman.add(now, attempt)
-    if watchman.is_banned_at(attempt.ip, now):
-        loggers.games_queue.info('pymash_event:skipped_game %s, because ip %s is banned',
-                                 game.game_id, attempt.ip)
-        return
+def _receive_messages_in_window(games_queue, wait_time_seconds):
+    messages = games_queue.receive(
+        max_num_messages=games_queue.MAX_NUM_MESSAGES, wait_time_seconds=wait_time_seconds)
+    deadline = time.time() + _COMPACTION_WINDOW_SECONDS
+    # under load we group messages during a short window, otherwise we process what we have right away
+    while messages and len(messages) < _MAX_COMPACTION_BATCH_SIZE and time.time() < deadline:
+        more_messages = games_queue.receive(
+            max_num_messages=games_queue.MAX_NUM_MESSAGES, wait_time_seconds=0)
+        if not more_messages:
+            break
+        messages.extend(more_messages)
+    return messages
+
+
+def _add_attempts(watchman, games_and_attempts):
+    skipped_game_ids = watchman.add_many(dt.datetime.utcnow(), games_and_attempts)
+    for game, attempt in games_and_attempts:
+        if game.game_id in skipped_game_ids:
+            loggers.games_queue.info('pymash_event:skipped_game %s, because ip %s is banned',
+                                     game.game_id, attempt.ip)
+    return skipped_game_ids
+
+
+def _process_game(games_ledger, context, game):
     try:
-        events.process_game_finished_event(context.engine, game)
+        events.process_game_finished_event(context.engine, game, games_ledger)
     except events.DeletedFromDb:
         loggers.games_queue.error(
             'pymash_event:error:deleted_from_db skipping handling of game %s', game.game_id,
             exc_info=True)
 
 
-def _get_watchman(config: cfg.Config) -> fraud.BaseWatchman:
-    if config.enable_antifraud:
-        return fraud.Watchman(
-            rate_limit=1,
-            window=dt.timedelta(seconds=10),
-            ban_duration=dt.timedelta(minutes=30),
-            max_num_attempts_without_gc=10_000)
-    return fraud.KindWatchman()
-
-
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
     main(iterations=itertools.repeat(1))
@@ -0,0 +1,99 @@
+import argparse
+import random
+import statistics
+import typing as tp
+
+from pymash import cfg
+from pymash import matchmaking
+from pymash import models
+
+
+def main():
+    # Offline replay of games between synthetic repos with known true ratings:
+    # the winner is drawn from the elo expected score of the true ratings,
+    # and the question is how fast the estimated ratings approach the true ones.
+    args = _parse_args()
+    print(f'{"mode":<12} {"games":>9} {"rank corr":>10} {"mean abs error":>15}')
+    for a_mode in cfg.Matchmaking.ALL:
+        random.seed(args.seed)
+        true_rating_by_repo_id = _make_true_ratings(args.num_repos, args.true_rating_std)
+        repos = [
+            models.Repo(repo_id=repo_id, github_id=repo_id, name=f'repo_{repo_id}', url='',
+                        is_active=True, rating=models.Repo.DEFAULT_RATING)
+            for repo_id in true_rating_by_repo_id
+        ]
+        for num_games in _replay(repos, true_rating_by_repo_id, a_mode, args):
+            rank_corr, mean_abs_error = _get_convergence(repos, true_rating_by_repo_id)
+            print(f'{a_mode:<12} {num_games:>9} {rank_corr:>10.3f} {mean_abs_error:>15.1f}')
+
+
+def _replay(repos: tp.List[models.Repo], true_rating_by_repo_id: tp.Dict[int, float], mode: str, args):
+    repo_by_id = {a_repo.repo_id: a_repo for a_repo in repos}
+    matchmaker = None
+    for i in range(1, args.num_games + 1):
+        if mode == cfg.Matchmaking.STRATIFIED:
+            # web tier refreshes the matchmaker from the leaders query every few seconds
+            if (i - 1) % args.refresh_every == 0:
+                matchmaker = matchmaking.Matchmaker(repos)
+            white_id, black_id = matchmaker.pick_two_repo_ids()
+        else:
+            white_id, black_id = random.sample(list(repo_by_id), 2)
+        white_wins_proba = _get_expected_score(true_rating_by_repo_id[white_id], true_rating_by_repo_id[black_id])
+        result = models.WHITE_WINS_RESULT if random.random() < white_wins_proba else models.BLACK_WINS_RESULT
+        models.Match(repo_by_id[white_id], repo_by_id[black_id], result).change_ratings()
+        if i % args.report_every == 0:
+            yield i
+
+
+def _make_true_ratings(num_repos: int, std: float) -> tp.Dict[int, float]:
+    return {
+        repo_id: random.gauss(models.Repo.DEFAULT_RATING, std)
+        for repo_id in range(num_repos)
+    }
+
+
+def _get_expected_score(rating: float, other_rating: float) -> float:
+    return 1 / (1 + 10 ** ((other_rating - rating) / 400))
+
+
+def _get_convergence(
+        repos: tp.List[models.Repo], true_rating_by_repo_id: tp.Dict[int, float]) -> tp.Tuple[float, float]:
+    ratings = [a_repo.rating for a_repo in repos]
+    true_ratings = [true_rating_by_repo_id[a_repo.repo_id] for a_repo in repos]
+    rank_corr = _get_correlation(_get_ranks(ratings), _get_ranks(true_ratings))
+    # elo keeps the mean rating, so ratings are compared around their means
+    mean, true_mean = statistics.mean(ratings), statistics.mean(true_ratings)
+    mean_abs_error = statistics.mean(
+        abs((a_rating - mean) - (a_true_rating - true_mean))
+        for a_rating, a_true_rating in zip(ratings, true_ratings))
+    return rank_corr, mean_abs_error
+
+
+def _get_ranks(values: tp.List[float]) -> tp.List[int]:
+    ranks = [0] * len(values)
+    for rank, index in enumerate(sorted(range(len(values)), key=values.__getitem__)):
+        ranks[index] = rank
+    return ranks
+
+
+def _get_correlation(xs: tp.List[float], ys: tp.List[float]) -> float:
+    mean_x, mean_y = statistics.mean(xs), statistics.mean(ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    variance_x = sum((x - mean_x) ** 2 for x in xs)
+    variance_y = sum((y - mean_y) ** 2 for y in ys)
+    return covariance / (variance_x * variance_y) ** 0.5
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-repos', type=int, default=1000)
+    parser.add_argument('--num-games', type=int, default=200_000)
+    parser.add_argument('--true-rating-std', type=float, default=300)
+    parser.add_argument('--refresh-every', type=int, default=50, help='games between matchmaker refreshes')
+    parser.add_argument('--report-every', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
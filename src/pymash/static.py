@@ -0,0 +1,160 @@
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import typing as tp
+
+try:
+    import brotli
+except ImportError:
+    # .br files aren't built without brotli, browsers get gzip instead
+    brotli = None
+
+SOURCE_DIR = os.path.join(os.path.dirname(__file__), 'templates', 'static')
+MANIFEST_FILE_NAME = 'manifest.json'
+# file names have content hashes, so they can be cached forever
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+BROTLI = 'br'
+GZIP = 'gzip'
+IDENTITY = 'identity'
+_EXTENSION_BY_ENCODING = {
+    BROTLI: '.br',
+    GZIP: '.gz',
+}
+# the best encoding goes first
+_ENCODINGS_BY_PREFERENCE = [BROTLI, GZIP, IDENTITY]
+# sass sources and source maps aren't needed by browsers
+_SKIPPED_EXTENSIONS = ['.scss', '.map']
+_HASH_LENGTH = 12
+
+
+class BaseError(Exception):
+    pass
+
+
+class AssetNotFound(BaseError):
+    pass
+
+
+class Asset:
+    def __init__(self, content_type: str, body_by_encoding: tp.Dict[str, bytes]) -> None:
+        assert IDENTITY in body_by_encoding
+        self.content_type = content_type
+        self._body_by_encoding = body_by_encoding
+
+    @property
+    def encodings(self) -> tp.List[str]:
+        return list(self._body_by_encoding)
+
+    def get_body(self, encoding: str) -> bytes:
+        return self._body_by_encoding[encoding]
+
+
+class Assets:
+    def __init__(self, hashed_name_by_name: tp.Dict[str, str], asset_by_hashed_name: tp.Dict[str, Asset]) -> None:
+        self._hashed_name_by_name = hashed_name_by_name
+        self._asset_by_hashed_name = asset_by_hashed_name
+
+    def get_hashed_name(self, name: str) -> str:
+        try:
+            return self._hashed_name_by_name[name]
+        except KeyError:
+            raise AssetNotFound(f'{name} is not in the manifest')
+
+    def get_or_none(self, hashed_name: str) -> tp.Optional[Asset]:
+        return self._asset_by_hashed_name.get(hashed_name)
+
+
+def build(source_dir: str, build_dir: str) -> tp.Dict[str, str]:
+    os.makedirs(build_dir, exist_ok=True)
+    hashed_name_by_name = {}
+    for a_name in sorted(os.listdir(source_dir)):
+        path = os.path.join(source_dir, a_name)
+        if not os.path.isfile(path) or os.path.splitext(a_name)[1] in _SKIPPED_EXTENSIONS:
+            continue
+        with open(path, 'rb') as fileobj:
+            body = fileobj.read()
+        hashed_name = _get_hashed_name(a_name, body)
+        for an_encoding, a_body in _compress(body).items():
+            _write_file(os.path.join(build_dir, hashed_name + _EXTENSION_BY_ENCODING.get(an_encoding, '')), a_body)
+        hashed_name_by_name[a_name] = hashed_name
+    # manifest goes last: a build dir with a manifest is complete
+    manifest = json.dumps(hashed_name_by_name, indent=2, sort_keys=True)
+    _write_file(os.path.join(build_dir, MANIFEST_FILE_NAME), manifest.encode('utf-8'))
+    return hashed_name_by_name
+
+
+def load(build_dir: str) -> Assets:
+    with open(os.path.join(build_dir, MANIFEST_FILE_NAME), encoding='utf-8') as fileobj:
+        hashed_name_by_name = json.load(fileobj)
+    asset_by_hashed_name = {}
+    for a_name, a_hashed_name in hashed_name_by_name.items():
+        body_by_encoding = {}
+        for an_encoding in _ENCODINGS_BY_PREFERENCE:
+            path = os.path.join(build_dir, a_hashed_name + _EXTENSION_BY_ENCODING.get(an_encoding, ''))
+            if os.path.exists(path):
+                with open(path, 'rb') as fileobj:
+                    body_by_encoding[an_encoding] = fileobj.read()
+        content_type = mimetypes.guess_type(a_name)[0] or 'application/octet-stream'
+        asset_by_hashed_name[a_hashed_name] = Asset(content_type, body_by_encoding)
+    return Assets(hashed_name_by_name, asset_by_hashed_name)
+
+
+def choose_encoding(accept_encoding: str, encodings: tp.List[str]) -> str:
+    accepted = _parse_accept_encoding(accept_encoding)
+    for an_encoding in _ENCODINGS_BY_PREFERENCE:
+        if an_encoding in encodings and (an_encoding in accepted or an_encoding == IDENTITY):
+            return an_encoding
+    return IDENTITY
+
+
+def _parse_accept_encoding(accept_encoding: str) -> tp.Set[str]:
+    # q-values only matter here when they reject an encoding, server preference decides otherwise
+    accepted = set()
+    for a_part in accept_encoding.split(','):
+        coding, *params = [a_param.strip() for a_param in a_part.split(';')]
+        if coding and not any(_is_zero_quality(a_param) for a_param in params):
+            accepted.add(coding.lower())
+    return accepted
+
+
+def _is_zero_quality(param: str) -> bool:
+    name, _, value = param.partition('=')
+    if name.strip().lower() != 'q':
+        return False
+    try:
+        return float(value) == 0
+    except ValueError:
+        return False
+
+
+def _get_hashed_name(name: str, body: bytes) -> str:
+    base, extension = os.path.splitext(name)
+    digest = hashlib.sha256(body).hexdigest()[:_HASH_LENGTH]
+    return f'{base}.{digest}{extension}'
+
+
+def _compress(body: bytes) -> tp.Dict[str, bytes]:
+    body_by_encoding = {
+        IDENTITY: body,
+        GZIP: _gzip(body),
+    }
+    if brotli is not None:
+        body_by_encoding[BROTLI] = brotli.compress(body, quality=11)
+    return body_by_encoding
+
+
+def _gzip(body: bytes) -> bytes:
+    result = io.BytesIO()
+    # mtime=0 keeps builds of the same file byte for byte identical
+    with gzip.GzipFile(fileobj=result, mode='wb', compresslevel=9, mtime=0) as fileobj:
+        fileobj.write(body)
+    return result.getvalue()
+
+
+def _write_file(path: str, body: bytes) -> None:
+    with open(path, 'wb') as fileobj:
+        fileobj.write(body)
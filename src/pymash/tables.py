@@ -2,7 +2,7 @@ import sqlalchemy as sa
 from sqlalchemy.ext import declarative
 from sqlalchemy import event
 
-__all__ = ['Repos', 'Functions', 'Games']
+__all__ = ['Repos', 'Functions', 'Games', 'GameEvents']
 
 # noinspection SqlNoDataSourceInspection
 _TRIGGER_TEMPLATE = (
@@ -69,15 +69,22 @@ class _FunctionDbModel(_CreatedUpdatedMixin, Base):
     repo_id = sa.Column(sa.ForeignKey(Repos.c.repo_id), nullable=False, index=True)
     text = sa.Column(sa.Text, nullable=False)
     is_active = sa.Column(sa.Boolean, nullable=False)
-    random = sa.Column(sa.Float, server_default=sa.func.random(), nullable=False, index=True)
+    random = sa.Column(sa.Float, server_default=sa.func.random(), nullable=False)
     file_name = sa.Column(sa.Text, nullable=False)
     line_number = sa.Column(sa.BigInteger, nullable=False)
+    # active functions are numbered 0..n-1 when repos are loaded, random function has a random slot
+    slot = sa.Column(sa.BigInteger, nullable=True)
 
     __table_args__ = (
         sa.Index(
-            'functions_is_active_random_partial_idx',
-            random,
-            postgresql_where=is_active.is_(True)),
+            'functions_slot_partial_idx',
+            slot,
+            postgresql_where=slot.isnot(None)),
+        # slot range of a repo for matchmaking
+        sa.Index(
+            'functions_repo_id_slot_partial_idx',
+            repo_id, slot,
+            postgresql_where=slot.isnot(None)),
         sa.Index(
             'functions_repo_id_md5_text_unique_idx',
             repo_id, sa.func.md5(text),
@@ -100,3 +107,18 @@ class _GameDbModel(_CreatedUpdatedMixin, Base):
 
 # noinspection PyTypeChecker
 Games = _get_table_with_trigger(_GameDbModel)
+
+
+class _GameEventDbModel(_CreatedUpdatedMixin, Base):
+    __tablename__ = 'game_events'
+    event_id = sa.Column(sa.BigInteger, primary_key=True, nullable=False)
+    body = sa.Column(sa.Text, nullable=False)
+    visible_after = sa.Column(
+        sa.DateTime(timezone=True),
+        server_default=sa.func.current_timestamp(),
+        nullable=False,
+        index=True)
+
+
+# noinspection PyTypeChecker
+GameEvents = _get_table_with_trigger(_GameEventDbModel)
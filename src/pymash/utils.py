@@ -1,4 +1,5 @@
 import asyncio
+import datetime as dt
 import functools
 import time
 import typing as tp
@@ -9,6 +10,11 @@ def _get_args_str(*args, **kwargs):
     return ''
 
 
+def convert_to_unix_ts(datetime: dt.datetime) -> int:
+    # naive datetimes are in utc
+    return int(datetime.replace(tzinfo=dt.timezone.utc).timestamp())
+
+
 class log_time:
     def __init__(self, logger, get_args_str_or_str: tp.Union[tp.Callable, str] = _get_args_str):
         self._logger = logger
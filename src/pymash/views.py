@@ -1,15 +1,21 @@
+import datetime as dt
 import functools
 import time
+import typing as tp
 import uuid
 
 import aiohttp_jinja2
 import voluptuous as vol
 from aiohttp import web
 
+from pymash import appenv
+from pymash import cfg
 from pymash import db
 from pymash import events
 from pymash import loggers
+from pymash import matchmaking
 from pymash import models
+from pymash import static
 from pymash import type_aliases as ta
 from pymash import utils
 
@@ -33,6 +39,7 @@ def _cache_coroutine_by_time(seconds):
                 loggers.web.info('%s cache hit', view.__name__)
             return cache[now]
 
+        cached_view.cache_clear = cache.clear
         return functools.update_wrapper(cached_view, view)
 
     return decorator
@@ -41,15 +48,15 @@ def _cache_coroutine_by_time(seconds):
 @utils.log_time(loggers.web)
 @aiohttp_jinja2.template('leaders.html')
 async def show_leaders(request: web.Request) -> ta.DictOrResponse:
-    repos = await _cached_find_active_repos(request)
+    repos = await _cached_find_active_repos(request.app)
     return {
         'repos': repos,
     }
 
 
 @_cache_coroutine_by_time(_CACHE_LEADERS_IN_SECONDS)
-async def _cached_find_active_repos(request):
-    repos = await db.find_active_repos_order_by_rating(request.app['db_engine'])
+async def _cached_find_active_repos(app):
+    repos = await db.find_active_repos_order_by_rating(app['db_engine'])
     return repos
 
 
@@ -77,6 +84,7 @@ class _PostGameInput:
 
 @utils.log_time(loggers.web)
 async def post_game(request: web.Request) -> web.Response:
+    _reject_banned_ip(request)
     data = await request.post()
     game = await _get_game_or_error(request, data)
     _validate_hash(request, game, data[_PostGameInput.Keys.hash_])
@@ -106,6 +114,13 @@ async def _get_game_or_error(request, data) -> models.Game:
         raise web.HTTPBadRequest
 
 
+def _reject_banned_ip(request: web.Request) -> None:
+    ip = events.get_user_ip(request)
+    if request.app['watchman'].is_banned_at(ip, dt.datetime.utcnow()):
+        loggers.web.info('pymash_event:rejected_banned_ip %s', ip)
+        raise web.HTTPTooManyRequests
+
+
 def _validate_hash(request: web.Request, game: models.Game, actual_hash: str):
     expected_hash = game.get_hash(request.app['config'].game_hash_salt)
     if expected_hash != actual_hash:
@@ -126,24 +141,56 @@ def _set_visited_cookie(view):
 @_set_visited_cookie
 @aiohttp_jinja2.template('game.html')
 async def show_game(request: web.Request) -> ta.DictOrResponse:
-    white, black = await _find_two_random_functions_or_error(request.app['db_engine'])
+    prepared_game = _pop_prefetched_game_or_none(request.app)
+    if prepared_game is None:
+        prepared_game = await prepare_game(request.app)
+    return {
+        'game': prepared_game.game,
+        'white': prepared_game.white,
+        'black': prepared_game.black,
+        'white_html': prepared_game.white_html,
+        'black_html': prepared_game.black_html,
+        'has_already_visited': (_COOKIE_VISITED in request.cookies),
+    }
+
+
+class PreparedGame:
+    def __init__(self, game: models.Game, white: models.Function, black: models.Function,
+                 white_html: str, black_html: str) -> None:
+        self.game = game
+        self.white = white
+        self.black = black
+        self.white_html = white_html
+        self.black_html = black_html
+
+
+async def prepare_game(app: web.Application) -> PreparedGame:
+    white, black = await _find_two_functions_or_error(app)
     game = models.Game(
         game_id=uuid.uuid4().hex,
         white_id=white.function_id,
         black_id=black.function_id,
         result=models.UNKNOWN_RESULT)
-    return {
-        'game': game,
-        'white': white,
-        'black': black,
-        'has_already_visited': (_COOKIE_VISITED in request.cookies),
-    }
+    return PreparedGame(
+        game=game,
+        white=white,
+        black=black,
+        white_html=appenv.highlight(white.text),
+        black_html=appenv.highlight(black.text))
+
 
+def _pop_prefetched_game_or_none(app: web.Application) -> tp.Optional[PreparedGame]:
+    games_prefetcher = app.get('games_prefetcher')
+    if games_prefetcher is None:
+        return None
+    return games_prefetcher.pop_or_none()
 
-async def _find_two_random_functions_or_error(engine: ta.AsyncEngine):
+
+async def _find_two_functions_or_error(app: web.Application):
+    try_to_find_two_functions = await _get_try_to_find_two_functions(app)
     num_tries = 3
     for _ in range(num_tries):
-        functions = await db.try_to_find_two_random_functions(engine)
+        functions = await try_to_find_two_functions()
         if _are_valid_functions(functions):
             return functions
     else:
@@ -151,6 +198,30 @@ async def _find_two_random_functions_or_error(engine: ta.AsyncEngine):
         raise web.HTTPServiceUnavailable
 
 
+async def _get_try_to_find_two_functions(app: web.Application):
+    engine = app['db_engine']
+    if app['config'].matchmaking == cfg.Matchmaking.STRATIFIED:
+        matchmaker = await _cached_make_matchmaker(app)
+        return functools.partial(_try_to_find_two_functions_of_matched_repos, engine, matchmaker)
+    return functools.partial(db.try_to_find_two_random_functions, engine)
+
+
+@_cache_coroutine_by_time(_CACHE_LEADERS_IN_SECONDS)
+async def _cached_make_matchmaker(app):
+    repos = await _cached_find_active_repos(app)
+    return matchmaking.Matchmaker(repos)
+
+
+async def _try_to_find_two_functions_of_matched_repos(
+        engine: ta.AsyncEngine, matchmaker: matchmaking.Matchmaker) -> ta.Functions:
+    try:
+        white_repo_id, black_repo_id = matchmaker.pick_two_repo_ids()
+    except matchmaking.NotEnoughRepos:
+        loggers.web.info('not enough repos for matchmaking', exc_info=True)
+        return []
+    return await db.try_to_find_two_random_functions_of_repos(engine, white_repo_id, black_repo_id)
+
+
 def _are_valid_functions(functions: ta.Functions) -> bool:
     if len(functions) != 2:
         return False
@@ -160,5 +231,20 @@ def _are_valid_functions(functions: ta.Functions) -> bool:
     return True
 
 
+async def show_asset(request: web.Request) -> web.Response:
+    assets = request.app['static_assets']
+    asset = None if assets is None else assets.get_or_none(request.match_info['hashed_name'])
+    if asset is None:
+        raise web.HTTPNotFound
+    encoding = static.choose_encoding(request.headers.get('Accept-Encoding', ''), asset.encodings)
+    headers = {
+        'Cache-Control': static.CACHE_CONTROL,
+        'Vary': 'Accept-Encoding',
+    }
+    if encoding != static.IDENTITY:
+        headers['Content-Encoding'] = encoding
+    return web.Response(body=asset.get_body(encoding), content_type=asset.content_type, headers=headers)
+
+
 def _floor_to_full_nearest_multiply(x, n):
     return (x // n) * n
@@ -83,6 +83,7 @@ def add_functions_and_repos(pymash_engine):
             Functions.c.random: 0.3,
             Functions.c.file_name: '/tmp/django/django.py',
             Functions.c.line_number: 100111,
+            Functions.c.slot: 0,
         }))
         conn.execute(Functions.insert().values({
             Functions.c.function_id: 777,
@@ -92,6 +93,7 @@ def add_functions_and_repos(pymash_engine):
             Functions.c.random: 0.6,
             Functions.c.file_name: '/tmp/flask/flask.py',
             Functions.c.line_number: 100222,
+            Functions.c.slot: 1,
         }))
         conn.execute(Functions.insert().values({
             Functions.c.function_id: 888,
@@ -101,6 +103,7 @@ def add_functions_and_repos(pymash_engine):
             Functions.c.random: 0.9,
             Functions.c.file_name: '/tmp/flask/flask.py',
             Functions.c.line_number: 100333,
+            Functions.c.slot: None,
         }))
 
 
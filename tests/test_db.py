@@ -0,0 +1,69 @@
+import collections
+import random
+
+import aiopg.sa
+
+from pymash import cfg
+from pymash import db
+from pymash.tables import *
+
+# random values with a big gap before the last function:
+# picking the next function after a random value would choose it 9 times out of 10
+_RANDOM_VALUES = [0.00, 0.01, 0.02, 0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.9]
+# chi-squared critical value for 9 degrees of freedom and p=0.001
+_CHI_SQUARED_CRITICAL_VALUE = 27.88
+
+
+def test_renumber_function_slots(pymash_engine):
+    _add_functions(pymash_engine)
+    db.renumber_function_slots(pymash_engine)
+    db.deactivate_many_functions(pymash_engine, [1, 5])
+    db.renumber_function_slots(pymash_engine)
+    with pymash_engine.connect() as conn:
+        rows = list(conn.execute(Functions.select().order_by(Functions.c.function_id)))
+    assert [a_row[Functions.c.slot] for a_row in rows] == [None, 0, 1, 2, None, 3, 4, 5, 6, 7]
+
+
+async def test_try_to_find_two_random_functions_is_uniform(pymash_engine, loop, monkeypatch):
+    monkeypatch.setattr(random, 'random', random.Random(0).random)
+    _add_functions(pymash_engine)
+    db.renumber_function_slots(pymash_engine)
+    num_picks_by_function_id = collections.Counter()
+    engine = await aiopg.sa.create_engine(cfg.get_config().dsn, loop=loop)
+    try:
+        for _ in range(1000):
+            functions = await db.try_to_find_two_random_functions(engine)
+            num_picks_by_function_id.update(a_function.function_id for a_function in functions)
+    finally:
+        engine.close()
+        await engine.wait_closed()
+    assert set(num_picks_by_function_id) == set(range(1, len(_RANDOM_VALUES) + 1))
+    assert _get_chi_squared(num_picks_by_function_id.values()) < _CHI_SQUARED_CRITICAL_VALUE
+
+
+def _get_chi_squared(observed):
+    observed = list(observed)
+    expected = sum(observed) / len(observed)
+    return sum((a_value - expected) ** 2 / expected for a_value in observed)
+
+
+def _add_functions(pymash_engine):
+    with pymash_engine.connect() as conn:
+        conn.execute(Repos.insert().values({
+            Repos.c.repo_id: 1,
+            Repos.c.github_id: 1001,
+            Repos.c.name: 'django',
+            Repos.c.url: 'https://github.com/django/django',
+            Repos.c.is_active: True,
+            Repos.c.rating: 1800,
+        }))
+        for function_id, random_value in enumerate(_RANDOM_VALUES, start=1):
+            conn.execute(Functions.insert().values({
+                Functions.c.function_id: function_id,
+                Functions.c.repo_id: 1,
+                Functions.c.text: f'def fn_{function_id}(): return {function_id}',
+                Functions.c.is_active: True,
+                Functions.c.random: random_value,
+                Functions.c.file_name: '/tmp/django/django.py',
+                Functions.c.line_number: function_id,
+            }))
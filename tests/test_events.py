@@ -0,0 +1,46 @@
+import datetime as dt
+import json
+
+import pytest
+
+from pymash import events
+from pymash import models
+
+_OCCURRED_AT = dt.datetime(2018, 1, 31, 19, 30, 27)
+
+
+@pytest.mark.parametrize('game_id, ip, result, is_compact', [
+    # normal case
+    ('0123456789abcdef0123456789abcdef', '192.168.1.1', models.WHITE_WINS_RESULT, True),
+    # ipv6
+    ('0123456789abcdef0123456789abcdef', '2001:db8::1', models.BLACK_WINS_RESULT, True),
+    # game_id from the url is not always a uuid
+    ('some_game_id', '192.168.1.1', models.WHITE_WINS_RESULT, False),
+    # uppercase uuid doesn't survive the compact round trip
+    ('0123456789ABCDEF0123456789ABCDEF', '192.168.1.1', models.WHITE_WINS_RESULT, False),
+    # X-Forwarded-For can contain anything
+    ('0123456789abcdef0123456789abcdef', 'unknown', models.BLACK_WINS_RESULT, False),
+])
+def test_encode_decode_game_finished_event(game_id, ip, result, is_compact):
+    game = models.Game(game_id=game_id, white_id=666, black_id=777, result=result)
+    body = events.encode_game_finished_event(game, ip, _OCCURRED_AT)
+    assert body.startswith('{') is not is_compact
+
+    decoded_game, decoded_attempt = events.decode_game_finished_event(body)
+    assert decoded_game.game_id == game_id
+    assert decoded_game.white_id == 666
+    assert decoded_game.black_id == 777
+    assert decoded_game.result == result
+    assert decoded_attempt.ip == ip
+    # both encodings keep the time of the attempt
+    assert decoded_attempt.at == _OCCURRED_AT
+
+
+def test_decode_json_game_finished_event():
+    game = models.Game(game_id='some_game_id', white_id=666, black_id=777,
+                       result=models.BLACK_WINS_RESULT)
+    body = json.dumps(events.make_game_finished_event(game, '127.0.0.1'))
+    decoded_game, decoded_attempt = events.decode_game_finished_event(body)
+    assert decoded_game.game_id == 'some_game_id'
+    assert decoded_game.result == models.BLACK_WINS_RESULT
+    assert decoded_attempt.ip == '127.0.0.1'
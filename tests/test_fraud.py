@@ -1,4 +1,8 @@
 import datetime as dt
+import os
+import random
+
+import pytest
 
 from pymash import fraud
 from pymash import models
@@ -26,6 +30,176 @@ def test_watchman():
     assert watchman.is_banned_at(_IP, _NOW)
 
 
+def test_watchman_add_many():
+    watchman = _get_watchman()
+    games_and_attempts = [
+        (_get_game('third'), models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 27))),
+        (_get_game('good'), models.GameAttempt(_GOOD_IP, dt.datetime(2018, 1, 31, 19, 30, 27))),
+        (_get_game('first'), models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 25))),
+        (_get_game('fourth'), models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 27))),
+        (_get_game('second'), models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 26))),
+    ]
+    assert watchman.add_many(_NOW, games_and_attempts) == {'fourth'}
+    assert watchman.is_banned_at(_IP, _NOW)
+    assert not watchman.is_banned_at(_GOOD_IP, _NOW)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_watchman_add_many_same_as_add(seed):
+    rnd = random.Random(seed)
+    games_and_attempts = [
+        (_get_game(str(i)), models.GameAttempt(
+            rnd.choice(['1.1.1.1', '2.2.2.2', '3.3.3.3']), _NOW + dt.timedelta(seconds=rnd.randrange(10))))
+        for i in range(40)
+    ]
+    watchman = _get_watchman()
+    expected_skipped_game_ids = set()
+    for game, attempt in sorted(games_and_attempts, key=lambda game_and_attempt: (
+            game_and_attempt[1].ip, game_and_attempt[1].at)):
+        watchman.add(_NOW, attempt)
+        if watchman.is_banned_at(attempt.ip, _NOW):
+            expected_skipped_game_ids.add(game.game_id)
+
+    assert expected_skipped_game_ids
+    assert _get_watchman().add_many(_NOW, games_and_attempts) == expected_skipped_game_ids
+    assert fraud.KindWatchman().add_many(_NOW, games_and_attempts) == set()
+
+
+def test_sqlite_watchman(tmpdir):
+    watchman = _get_sqlite_watchman(tmpdir)
+    for second in [25, 26, 27]:
+        watchman.add(_NOW, models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, second)))
+        assert not watchman.is_banned_at(_IP, _NOW)
+    watchman.add(_NOW, models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 27)))
+    assert watchman.is_banned_at(_IP, _NOW)
+    assert not watchman.is_banned_at(_GOOD_IP, _NOW)
+    watchman.close()
+
+    # state is shared between processes and survives restarts
+    other_watchman = _get_sqlite_watchman(tmpdir)
+    assert other_watchman.is_banned_at(_IP, _NOW)
+    assert not other_watchman.is_banned_at(_IP, _NOW + dt.timedelta(minutes=31))
+
+
+def test_watchman_snapshot(tmpdir):
+    path = str(tmpdir.join('watchman.snapshot'))
+    watchman = _get_watchman()
+    for second in [25, 26, 27, 27]:
+        watchman.add(_NOW, models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, second)))
+    watchman.add(_NOW, models.GameAttempt(_GOOD_IP, dt.datetime(2018, 1, 31, 19, 30, 27)))
+    # X-Forwarded-For can contain anything
+    for ip in ['2001:db8::1', 'unknown']:
+        for second in [25, 26, 27, 27]:
+            watchman.add(_NOW, models.GameAttempt(ip, dt.datetime(2018, 1, 31, 19, 30, second)))
+    watchman.save_snapshot(path)
+
+    restored_watchman = _get_watchman()
+    restored_watchman.load_snapshot(path)
+    assert restored_watchman.num_ips == 4
+    assert restored_watchman.is_banned_at('2001:db8::1', _NOW)
+    assert restored_watchman.is_banned_at('unknown', _NOW)
+    assert restored_watchman.is_banned_at(_IP, _NOW)
+    assert not restored_watchman.is_banned_at(_IP, _NOW + dt.timedelta(minutes=31))
+    assert not restored_watchman.is_banned_at(_GOOD_IP, _NOW)
+    # second buckets are restored too, so the rate is still tracked
+    restored_watchman.add(_NOW, models.GameAttempt(_GOOD_IP, dt.datetime(2018, 1, 31, 19, 30, 27)))
+    restored_watchman.add(_NOW, models.GameAttempt(_GOOD_IP, dt.datetime(2018, 1, 31, 19, 30, 28)))
+    restored_watchman.add(_NOW, models.GameAttempt(_GOOD_IP, dt.datetime(2018, 1, 31, 19, 30, 29)))
+    assert restored_watchman.is_banned_at(_GOOD_IP, _NOW)
+
+
+def test_watchman_bad_snapshot(tmpdir):
+    path = tmpdir.join('watchman.snapshot')
+    path.write_binary(b'garbage')
+    with pytest.raises(fraud.SnapshotError):
+        _get_watchman().load_snapshot(str(path))
+
+
+def test_watchman_ipv4_mapped_ipv6():
+    watchman = _get_watchman()
+    for second in [25, 26, 27, 27]:
+        watchman.add(_NOW, models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, second)))
+    assert watchman.is_banned_at('::ffff:127.0.0.1', _NOW)
+    assert watchman.num_ips == 1
+
+
+def test_subnet_watchman():
+    watchman = _get_subnet_watchman()
+    # every ip stays under its own limit, but together they exceed the /24 limit
+    for i, second in enumerate([25, 25, 26, 26, 27, 27]):
+        watchman.add(_NOW, models.GameAttempt(f'10.0.0.{i}', dt.datetime(2018, 1, 31, 19, 30, second)))
+        assert not watchman.is_banned_at('10.0.0.100', _NOW)
+    watchman.add(_NOW, models.GameAttempt('10.0.0.6', dt.datetime(2018, 1, 31, 19, 30, 27)))
+    assert watchman.is_banned_at('10.0.0.100', _NOW)
+    assert not watchman.is_banned_at('10.0.0.100', _NOW + dt.timedelta(minutes=31))
+    assert not watchman.is_banned_at('10.0.1.1', _NOW)
+
+
+def test_subnet_watchman_ip_limit():
+    watchman = _get_subnet_watchman()
+    for ip in [_IP, '2001:db8::1', 'unknown']:
+        for second in [25, 26, 27]:
+            watchman.add(_NOW, models.GameAttempt(ip, dt.datetime(2018, 1, 31, 19, 30, second)))
+            assert not watchman.is_banned_at(ip, _NOW)
+        watchman.add(_NOW, models.GameAttempt(ip, dt.datetime(2018, 1, 31, 19, 30, 27)))
+        assert watchman.is_banned_at(ip, _NOW)
+    assert not watchman.is_banned_at('127.0.0.2', _NOW)
+    assert not watchman.is_banned_at('2001:db8::2', _NOW)
+
+
+def test_subnet_watchman_old_attempts():
+    watchman = _get_subnet_watchman()
+    an_hour_ago = dt.datetime(2018, 1, 31, 18, 30, 27)
+    watchman.add(an_hour_ago, models.GameAttempt(_IP, an_hour_ago))
+    watchman.add(an_hour_ago, models.GameAttempt(_IP, an_hour_ago))
+    # counters of the same second an hour ago are reset, not summed up
+    watchman.add(_NOW, models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 27)))
+    watchman.add(_NOW, models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 27)))
+    assert not watchman.is_banned_at(_IP, _NOW)
+
+
+def test_ban_list_watchman(tmpdir, monkeypatch):
+    monkeypatch.setattr(fraud.BanListWatchman, 'RELOAD_INTERVAL_SECONDS', 0)
+    path = str(tmpdir.join('ban_list'))
+    ban_list_watchman = fraud.BanListWatchman(path)
+    # no ban list yet
+    assert not ban_list_watchman.is_banned_at(_IP, _NOW)
+
+    watchman = _get_watchman()
+    for ip in [_IP, '2001:db8::1', 'unknown']:
+        for second in [25, 26, 27, 27]:
+            watchman.add(_NOW, models.GameAttempt(ip, dt.datetime(2018, 1, 31, 19, 30, second)))
+    watchman.add(_NOW, models.GameAttempt(_GOOD_IP, dt.datetime(2018, 1, 31, 19, 30, 27)))
+    fraud.write_ban_list(path, watchman.get_ban_end_unix_ts_by_ip())
+
+    for ip in [_IP, '2001:db8::1', 'unknown']:
+        assert ban_list_watchman.is_banned_at(ip, _NOW)
+        assert not ban_list_watchman.is_banned_at(ip, _NOW + dt.timedelta(minutes=31))
+    assert not ban_list_watchman.is_banned_at(_GOOD_IP, _NOW)
+    assert not ban_list_watchman.is_banned_at('127.0.0.2', _NOW)
+
+    # the list is reloaded after the worker publishes a new one
+    fraud.write_ban_list(path, {})
+    assert not ban_list_watchman.is_banned_at(_IP, _NOW)
+    ban_list_watchman.close()
+
+
+@pytest.mark.parametrize('corrupted_byte', [b'\xff', b'x'])
+def test_ban_list_watchman_with_corrupted_str_ips(tmpdir, monkeypatch, corrupted_byte):
+    monkeypatch.setattr(fraud.BanListWatchman, 'RELOAD_INTERVAL_SECONDS', 0)
+    path = str(tmpdir.join('ban_list'))
+    fraud.write_ban_list(path, {_IP: 1517430000, 'unknown': 1517430000})
+    # str ips are the json tail of the file
+    with open(path, 'r+b') as fobj:
+        fobj.seek(-1, os.SEEK_END)
+        fobj.write(corrupted_byte)
+    ban_list_watchman = fraud.BanListWatchman(path)
+    # corrupted ban list is ignored
+    assert not ban_list_watchman.is_banned_at(_IP, _NOW)
+    assert not ban_list_watchman.is_banned_at('unknown', _NOW)
+    ban_list_watchman.close()
+
+
 def test_watchman_gc():
     watchman = _get_watchman(max_num_attempts_without_gc=5)
     watchman.add(_NOW, models.GameAttempt(_IP, dt.datetime(2018, 1, 31, 19, 30, 28)))
@@ -47,9 +221,36 @@ def test_kind_watchman():
     assert not watchman.is_banned_at(_IP, _NOW)
 
 
+def _get_game(game_id):
+    return models.Game(game_id=game_id, white_id=666, black_id=777, result=models.WHITE_WINS_RESULT)
+
+
 def _get_watchman(max_num_attempts_without_gc=100):
     return fraud.Watchman(
         rate_limit=1,
         window=dt.timedelta(seconds=3),
         ban_duration=dt.timedelta(minutes=30),
         max_num_attempts_without_gc=max_num_attempts_without_gc)
+
+
+def _get_subnet_watchman():
+    return fraud.SubnetWatchman(
+        levels=[
+            fraud.SubnetLevel('ip', ipv4_prefix_len=32, ipv6_prefix_len=128, rate_limit=1),
+            fraud.SubnetLevel('subnet', ipv4_prefix_len=24, ipv6_prefix_len=64, rate_limit=2),
+        ],
+        window=dt.timedelta(seconds=3),
+        ban_duration=dt.timedelta(minutes=30),
+        sketch_width=1024,
+        sketch_depth=4,
+        max_num_attempts_without_gc=100)
+
+
+def _get_sqlite_watchman(tmpdir):
+    return fraud.SqliteWatchman(
+        directory=str(tmpdir),
+        num_shards=2,
+        rate_limit=1,
+        window=dt.timedelta(seconds=3),
+        ban_duration=dt.timedelta(minutes=30),
+        max_num_attempts_without_gc=100)
@@ -0,0 +1,20 @@
+from pymash import ledger
+from pymash import models
+
+
+def test_games_ledger():
+    games_ledger = ledger.GamesLedger(max_size=2)
+    games_ledger.add(_make_game('first'))
+    games_ledger.add(_make_game('second'))
+    assert games_ledger.get_result('first') == models.WHITE_WINS_RESULT
+    # 'first' is recently used now, so 'second' is evicted
+    games_ledger.add(_make_game('first'))
+    games_ledger.add(_make_game('third'))
+    assert len(games_ledger) == 2
+    assert games_ledger.get_result('second') is None
+    assert games_ledger.get_result('first') == models.WHITE_WINS_RESULT
+    assert games_ledger.get_result('third') == models.WHITE_WINS_RESULT
+
+
+def _make_game(game_id):
+    return models.Game(game_id=game_id, white_id=666, black_id=777, result=models.WHITE_WINS_RESULT)
@@ -1,7 +1,9 @@
+import collections
+import concurrent.futures
 import contextlib
 import io
 import os
-import random
+import time
 import textwrap
 import urllib.request
 from unittest import mock
@@ -20,8 +22,9 @@ from pymash.tables import *
 
 def test_load_most_popular(pymash_engine, github_mock, monkeypatch):
     monkeypatch.setattr(github, 'Github', github_mock)
-    monkeypatch.setattr(random, 'sample', _mock_random_sample)
     monkeypatch.setattr(requests, 'get', _read_file)
+    # the sample is random, so it holds all good functions to keep the test deterministic
+    monkeypatch.setattr(loader.Selector, 'NUM_FUNCTIONS_PER_REPO', 3)
 
     _add_data(pymash_engine)
     loader.load_most_popular(
@@ -34,23 +37,55 @@ def test_load_most_popular(pymash_engine, github_mock, monkeypatch):
     _assert_functions_were_loaded(pymash_engine)
 
 
+def test_deactivate_near_duplicates(pymash_engine):
+    texts = ['def add(x, y):\n    return x + y', 'def sub(x, y):\n    return x - y']
+    _add_repo_with_functions(pymash_engine, repo_id=1, texts=texts)
+    # vendored copy of the first repo
+    _add_repo_with_functions(pymash_engine, repo_id=2, texts=texts)
+    _add_repo_with_functions(pymash_engine, repo_id=3, texts=texts[:1] + ['def mul(x, y):\n    return x * y'])
+    loader._deactivate_near_duplicates(pymash_engine)
+    with pymash_engine.connect() as conn:
+        is_active_by_repo_id = {
+            a_row[Repos.c.repo_id]: a_row[Repos.c.is_active]
+            for a_row in conn.execute(Repos.select())
+        }
+        active_function_ids = {
+            a_row[Functions.c.function_id]
+            for a_row in conn.execute(Functions.select().where(Functions.c.is_active.is_(True)))
+        }
+    assert is_active_by_repo_id == {1: True, 2: False, 3: True}
+    assert active_function_ids == {101, 102, 302}
+
+
+def _add_repo_with_functions(pymash_engine, repo_id, texts):
+    with pymash_engine.connect() as conn:
+        conn.execute(Repos.insert().values({
+            Repos.c.repo_id: repo_id,
+            Repos.c.github_id: 1000 + repo_id,
+            Repos.c.name: f'repo_{repo_id}',
+            Repos.c.url: f'https://github.com/org/repo_{repo_id}',
+            Repos.c.is_active: True,
+            Repos.c.rating: models.Repo.DEFAULT_RATING,
+        }))
+        for i, a_text in enumerate(texts, start=1):
+            conn.execute(Functions.insert().values({
+                Functions.c.function_id: repo_id * 100 + i,
+                Functions.c.repo_id: repo_id,
+                Functions.c.text: a_text,
+                Functions.c.is_active: True,
+                Functions.c.file_name: f'/tmp/repo_{repo_id}/module.py',
+                Functions.c.line_number: i,
+            }))
+
+
 def _read_file(path):
     with contextlib.closing(urllib.request.urlopen(path)) as fileobj:
         return mock.Mock(content=fileobj.read())
 
 
-def _mock_random_sample(population, k):
-    if len(population) == k:
-        return population
-    assert len(population) == k + 1
-    result = [a_function for a_function in population if a_function.name != 'zzz']
-    assert len(result) == len(population) - 1
-    return result
-
-
 @pytest.fixture(name='github_mock')
 def fixture_github_mock():
-    # one function is zzz (ignored by _random_sample_mock)
+    # one function is zzz
     # another function in a test file (ignored by _find_files)
     # remaining functions are okay
     archive_with_four_functions_and_tests = _make_archive_url_mock('repo_with_four_functions_and_tests.py.zip')
@@ -213,6 +248,95 @@ def test_select_good_functions(source_code, expected_names, monkeypatch):
     assert actual_names == set(expected_names)
 
 
+@pytest.mark.parametrize('parse_concurrency', [1, 2])
+def test_get_functions_from_directory(tmpdir, monkeypatch, parse_concurrency):
+    monkeypatch.setattr(loader.Selector, 'NUM_FUNCTIONS_PER_REPO', 3)
+    source_code = ''.join(
+        f'def fn_{i}(x):\n    y = x + {i}\n    return y\n\n\n'
+        for i in range(5))
+    # the same functions in two files are added only once
+    tmpdir.join('first.py').write(source_code)
+    tmpdir.join('second.py').write(source_code)
+    github_repo = mock.Mock(url='https://github.com/some/repo')
+    functions = loader._get_functions_from_directory(str(tmpdir), github_repo, parse_concurrency)
+    assert len(functions) == 3
+    assert len({a_function.name for a_function in functions}) == 3
+
+
+@pytest.mark.parametrize('selector_attr, selector_value, expected_skipped', [
+    ('MAX_FILE_BYTES', 10, 'too_big_files'),
+    ('MAX_FILE_LINES', 2, 'too_long_files'),
+    ('MAX_FILE_PARSE_SECONDS', 0.01, 'timed_out_files'),
+])
+def test_parse_file_limits(tmpdir, monkeypatch, selector_attr, selector_value, expected_skipped):
+    path = tmpdir.join('file.py')
+    path.write('def add(x, y):\n    z = x + y\n    return z\n')
+    parser_options = parser.Options(catch_exceptions=True, verbose=False)
+    counts = collections.Counter()
+    assert len(loader._parse_file(str(path), parser_options, counts)) == 1
+    assert counts == {}
+
+    monkeypatch.setattr(loader.Selector, selector_attr, selector_value)
+    monkeypatch.setattr(parser, 'get_functions_from_fileobj', _slow_get_functions_from_fileobj)
+    assert loader._parse_file(str(path), parser_options, counts) == []
+    assert counts[expected_skipped] == 1
+
+
+def _slow_get_functions_from_fileobj(fileobj, path, options):
+    time.sleep(1)
+    return []
+
+
+def test_make_parse_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr(loader.Selector, 'MAX_PARSE_CHUNK_BYTES', 100)
+    sizes = [300, 10, 60, 50, 40]
+    py_files = []
+    for i, a_size in enumerate(sizes):
+        path = tmpdir.join(f'file_{i}.py')
+        path.write('x' * a_size)
+        py_files.append(str(path))
+    chunks = loader._make_parse_chunks(py_files, parse_concurrency=1)
+    assert [[py_files.index(a_file) for a_file in a_chunk] for a_chunk in chunks] == [[0], [2, 3], [4, 1]]
+
+
+def test_map_with_lookahead():
+    executor = _CountingExecutor()
+    results = loader._map_with_lookahead(executor, lambda x: x * 2, range(10), max_num_pending=3)
+    assert next(results) == 0
+    # the fourth item is submitted only after the first result is taken
+    assert executor.num_submitted == 3
+    assert list(results) == [2 * i for i in range(1, 10)]
+    assert executor.num_submitted == 10
+
+
+class _CountingExecutor(concurrent.futures.Executor):
+    def __init__(self):
+        self.num_submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.num_submitted += 1
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+def test_load_many_github_repos_in_parallel(monkeypatch):
+    monkeypatch.setattr(loader, 'load_github_repo', _load_github_repo_in_child)
+    github_repos = [
+        models.GithubRepo(
+            github_id=i, name=f'repo_{i}', full_name=f'some/repo_{i}', url=f'https://github.com/some/repo_{i}',
+            zipball_url=f'https://github.com/some/repo_{i}/zipball', num_stars=100)
+        for i in range(2)
+    ]
+    # every repo parses its files in processes of its own
+    assert loader._load_many_github_repos(github_repos, concurrency=2, parse_concurrency=2) == [4, 4]
+
+
+def _load_github_repo_in_child(github_repo, parse_concurrency):
+    with concurrent.futures.ProcessPoolExecutor(parse_concurrency) as executor:
+        return sum(executor.map(abs, [-1, 3]))
+
+
 def _add_data(pymash_engine):
     with pymash_engine.connect() as conn:
         conn.execute(Repos.insert().values({
@@ -289,13 +413,15 @@ def _assert_repos_were_loaded(pymash_engine):
         repo_row=flask_row,
         name='flask',
         url='https://github.com/pallets/flask',
-        is_active=True,
+        # all functions are near duplicates of django functions
+        is_active=False,
         rating=1900)
     _expect_repo(
         repo_row=pymash_row,
         name='pymash',
         url='https://github.com/alexandershov/pymash',
-        is_active=True,
+        # all functions are near duplicates of django functions
+        is_active=False,
         rating=1800)
     _expect_repo(
         repo_row=requests_row,
@@ -330,20 +456,25 @@ def _assert_functions_were_loaded(pymash_engine):
         _assert_grouped_functions(conn, 'django', {
             'def add(x, y):\n    return x + y': (True, 'file_with_two_functions.py'),
             'def sub(x, y):\n    return x - y': (True, 'file_with_two_functions.py'),
+            'def zzz():    \n    time.sleep(1)': (True, 'file_with_one_function.py'),
         })
+        # flask and pymash have the same functions as django, which is the oldest repo
         _assert_grouped_functions(conn, 'flask', {
-            'def add(x, y):\n    return x + y': (True, 'file_with_two_functions.py'),
-            'def sub(x, y):\n    return x - y': (True, 'file_with_two_functions.py'),
+            'def add(x, y):\n    return x + y': (False, 'file_with_two_functions.py'),
+            'def sub(x, y):\n    return x - y': (False, 'file_with_two_functions.py'),
             'def mul(x, y):\n    return x * y': (False, 'flask.py'),
         })
         _assert_grouped_functions(conn, 'pymash', {
-            'def add(x, y):\n    return x + y': (True, 'file_with_two_functions.py'),
-            'def sub(x, y):\n    return x - y': (True, 'file_with_two_functions.py'),
+            'def add(x, y):\n    return x + y': (False, 'file_with_two_functions.py'),
+            'def sub(x, y):\n    return x - y': (False, 'file_with_two_functions.py'),
         })
         _assert_grouped_functions(conn, 'requests', {
             'def add(x, y):\n    return x + y': (False, 'requests.py'),
         })
-    assert len(all_rows) == 8
+    assert len(all_rows) == 9
+    active_slots = sorted(a_row[Functions.c.slot] for a_row in all_rows if a_row[Functions.c.is_active])
+    assert active_slots == list(range(len(active_slots)))
+    assert all(a_row[Functions.c.slot] is None for a_row in all_rows if not a_row[Functions.c.is_active])
 
 
 def _assert_grouped_functions(conn, repo_name, _grouped_by_text):
@@ -0,0 +1,45 @@
+import collections
+
+import pytest
+
+from pymash import matchmaking
+from pymash import models
+
+
+def test_pick_two_repo_ids():
+    ratings = [1500, 1550, 1600, 1800, 1810, 2500]
+    matchmaker = matchmaking.Matchmaker(_make_repos(ratings), rating_window=100)
+    rating_by_repo_id = dict(enumerate(ratings))
+    num_picks_by_pair = collections.Counter()
+    for _ in range(2000):
+        white_repo_id, black_repo_id = matchmaker.pick_two_repo_ids()
+        assert white_repo_id != black_repo_id
+        num_picks_by_pair[white_repo_id, black_repo_id] += 1
+    expected_pairs = {
+        (white_repo_id, black_repo_id)
+        for white_repo_id, white_rating in rating_by_repo_id.items()
+        for black_repo_id, black_rating in rating_by_repo_id.items()
+        if white_repo_id != black_repo_id and abs(white_rating - black_rating) <= 100
+    }
+    # the top repo is alone in its window, so it plays with the closest one
+    expected_pairs.add((5, 4))
+    assert set(num_picks_by_pair) == expected_pairs
+
+
+@pytest.mark.parametrize('ratings', [
+    [],
+    [1800],
+])
+def test_pick_two_repo_ids_not_enough_repos(ratings):
+    matchmaker = matchmaking.Matchmaker(_make_repos(ratings))
+    with pytest.raises(matchmaking.NotEnoughRepos):
+        matchmaker.pick_two_repo_ids()
+
+
+def _make_repos(ratings):
+    return [
+        models.Repo(
+            repo_id=i, github_id=1000 + i, name=f'repo_{i}', url=f'https://github.com/repo_{i}',
+            is_active=True, rating=a_rating)
+        for i, a_rating in enumerate(ratings)
+    ]
@@ -0,0 +1,38 @@
+import pytest
+
+from pymash import near_duplicates
+
+_TEXT = '''\
+def parse(path):
+    with open(path) as fileobj:
+        data = json.load(fileobj)
+    result = {}
+    for key, value in data.items():
+        if value is not None:
+            result[key.lower()] = value
+    return result'''
+
+
+@pytest.mark.parametrize('text, is_near_duplicate', [
+    # exact copy
+    (_TEXT, True),
+    # tiny variation
+    (_TEXT.replace('key.lower()', 'key.upper()'), True),
+    # different function
+    ('def add(x, y):\n    return x + y', False),
+    # too short to have shingles
+    ('pass', False),
+])
+def test_near_duplicates_index(text, is_near_duplicate):
+    index = near_duplicates.NearDuplicatesIndex()
+    assert index.find_or_add(1, _TEXT) is None
+    expected_id = 1 if is_near_duplicate else None
+    assert index.find_or_add(2, text) == expected_id
+    assert len(index) == (1 if is_near_duplicate or text == 'pass' else 2)
+
+
+def test_get_signature():
+    signature = near_duplicates.get_signature(_TEXT)
+    assert len(signature) == near_duplicates.NUM_BINS
+    assert near_duplicates.estimate_similarity(signature, near_duplicates.get_signature(_TEXT)) == 1.0
+    assert near_duplicates.get_signature('return x') is None
@@ -12,8 +12,8 @@ def _make_function(text):
     parsed = ast.parse(text)
     assert len(parsed.body) == 1
     fn_node = parsed.body[0]
-    return parser.Function(
-        node=fn_node,
+    return parser.Function.from_node(
+        fn_node,
         text=text,
         file_name='some_file.py')
 
@@ -75,7 +75,7 @@ _EXPECTED_RESULT = [
                 ),
             ]
     ),
-    # we refuse to parse one function
+    # multiline docstring with triple quotes of the other kind
     (
             '''
             def sub(x, y):
@@ -86,7 +86,13 @@ _EXPECTED_RESULT = [
             def add(x, y):
                 return x + y
             ''',
-            _EXPECTED_RESULT
+            [
+                _make_function(
+                    '''\
+                    def sub(x, y):
+                        return x - y'''
+                ),
+            ] + _EXPECTED_RESULT
     ),
     # async function
     (
@@ -184,35 +190,7 @@ _EXPECTED_RESULT = [
                 )
             ]
     ),
-    # nothing to parse
-    (
-            '',
-            [],
-    ),
-    # we catch SyntaxError
-    (
-            'print "test"',
-            [],
-    ),
-])
-def test_get_functions(source_code, expected_functions):
-    fileobj = io.StringIO(textwrap.dedent(source_code))
-    actual_functions = parser.get_functions_from_fileobj(
-        fileobj, 'file.py', parser.Options(True, True))
-    assert actual_functions == expected_functions
-
-
-@pytest.mark.parametrize('source_code, expected_exception', [
-    # we refuse to parse functions with only docstrings
-    (
-            '''
-            def add(x, y):
-                "Add two numbers"
-            ''',
-            parser.EmptyFunctionError,
-    ),
-    # we refuse to parse multiline docstrings with inner triple double quotes:
-    # it's hard to do with regexes and it's very rare case anyway
+    # multiline docstrings with escaped inner triple quotes
     (
             '''
             def add(x, y):
@@ -221,9 +199,8 @@ def test_get_functions(source_code, expected_functions):
                 docstring with inner triple quotes."""
                 return x + y
             ''',
-            parser.TripleQuotesDocstringError,
+            _EXPECTED_RESULT
     ),
-    # we refuse to parse multiline docstrings with quoted inner double quotes: rare case
     (
             '''
             def add(x, y):
@@ -233,10 +210,8 @@ def test_get_functions(source_code, expected_functions):
                 docstring with inner triple quotes ending on newline."""
                 return x + y
             ''',
-            parser.TripleQuotesDocstringError,
+            _EXPECTED_RESULT
     ),
-    # we refuse to parse multiline docstrings with inner triple single quotes:
-    # it's hard to do with regexes and it's very rare case anyway
     (
             """
             def add(x, y):
@@ -245,9 +220,8 @@ def test_get_functions(source_code, expected_functions):
                 docstring with inner triple quotes.'''
                 return x + y
             """,
-            parser.TripleQuotesDocstringError,
+            _EXPECTED_RESULT
     ),
-    # we refuse to parse multiline docstrings with quoted inner single quotes: rare case
     (
             """
             def add(x, y):
@@ -257,7 +231,66 @@ def test_get_functions(source_code, expected_functions):
                 docstring with inner triple quotes ending on newline.'''
                 return x + y
             """,
-            parser.TripleQuotesDocstringError,
+            _EXPECTED_RESULT
+    ),
+    # docstring and a statement on the same line
+    (
+            '''
+            def add(x, y):
+                """some
+                docstring."""; return x + y
+            ''',
+            [
+                _make_function(
+                    '''\
+                    def add(x, y):
+                        return x + y'''
+                ),
+            ]
+    ),
+    # brackets and colons in the header
+    (
+            '''
+            def add(x: int = {'a': 1}['a'], y: tp.Dict[str, int] = None) -> int:
+                """some
+                docstring."""
+                # comment after the docstring
+                return x + y
+            ''',
+            [
+                _make_function(
+                    '''\
+                    def add(x: int = {'a': 1}['a'], y: tp.Dict[str, int] = None) -> int:
+                        return x + y'''
+                ),
+            ]
+    ),
+    # nothing to parse
+    (
+            '',
+            [],
+    ),
+    # we catch SyntaxError
+    (
+            'print "test"',
+            [],
+    ),
+])
+def test_get_functions(source_code, expected_functions):
+    fileobj = io.StringIO(textwrap.dedent(source_code))
+    actual_functions = parser.get_functions_from_fileobj(
+        fileobj, 'file.py', parser.Options(True, True))
+    assert actual_functions == expected_functions
+
+
+@pytest.mark.parametrize('source_code, expected_exception', [
+    # we refuse to parse functions with only docstrings
+    (
+            '''
+            def add(x, y):
+                "Add two numbers"
+            ''',
+            parser.EmptyFunctionError,
     ),
 ])
 def test_get_functions_failure(source_code, expected_exception):
@@ -270,3 +303,21 @@ def test_get_functions_catch_decode_error():
     # noinspection PyTypeChecker
     fileobj = io.TextIOWrapper(io.BytesIO('тест'.encode('cp1251')), encoding='utf-8')
     assert parser.get_functions_from_fileobj(fileobj, 'file.py', parser.Options(True, True)) == []
+
+
+def test_function_features():
+    fn = _make_function(
+        '''\
+        def some_function(x):
+            # some comment
+            if x:
+                raise errors.SomeError('some message')
+            raise NotImplementedError'''
+    )
+    assert fn.name == 'some_function'
+    assert fn.line_number == 1
+    assert fn.num_statements == 2
+    assert fn.num_lines == 5
+    assert fn.max_line_length == len("        raise errors.SomeError('some message')")
+    assert fn.num_comment_lines == 1
+    assert fn.raised_names == {'SomeError', 'NotImplementedError'}
@@ -0,0 +1,45 @@
+import asyncio
+import itertools
+
+from pymash import prefetch
+
+
+async def test_prefetcher(loop):
+    counter = itertools.count()
+
+    async def make_item():
+        return next(counter)
+
+    prefetcher = prefetch.Prefetcher(make_item, max_size=2, name='numbers')
+    assert prefetcher.pop_or_none() is None
+    prefetcher.start(loop)
+    try:
+        while len(prefetcher) < 2:
+            await asyncio.sleep(0)
+        assert [prefetcher.pop_or_none(), prefetcher.pop_or_none(), prefetcher.pop_or_none()] == [0, 1, None]
+        while len(prefetcher) < 2:
+            await asyncio.sleep(0)
+        assert prefetcher.pop_or_none() == 2
+    finally:
+        await prefetcher.close()
+    assert (prefetcher.num_hits, prefetcher.num_misses) == (3, 2)
+    assert prefetcher.miss_rate == 0.4
+
+
+async def test_prefetcher_retries_failures(loop, monkeypatch):
+    monkeypatch.setattr(prefetch.Prefetcher, 'RETRY_DELAY_SECONDS', 0)
+    num_calls = itertools.count()
+
+    async def make_item():
+        if next(num_calls) == 0:
+            raise ValueError('db is down')
+        return 'item'
+
+    prefetcher = prefetch.Prefetcher(make_item, max_size=2, name='flaky')
+    prefetcher.start(loop)
+    try:
+        while not len(prefetcher):
+            await asyncio.sleep(0)
+        assert prefetcher.pop_or_none() == 'item'
+    finally:
+        await prefetcher.close()
@@ -1,4 +1,6 @@
 import json
+import os
+import signal
 import typing as tp
 from unittest import mock
 
@@ -7,6 +9,8 @@ import pytest
 
 from pymash import db
 from pymash import events
+from pymash import fraud
+from pymash import ledger
 from pymash import models
 from pymash.scripts import process_finished_games
 from pymash.tables import *
@@ -82,11 +86,74 @@ def test_process_game_finished_is_banned(pymash_engine, monkeypatch):
     game = _get_game()
     _monkeypatch_boto3(monkeypatch, [game])
     watchman = mock.Mock()
-    watchman.is_banned_at.return_value = True
+    watchman.add_many.return_value = {game.game_id}
     _call_process_finished_games(watchman=watchman)
     _assert_nothing_saved(pymash_engine, game)
 
 
+@pytest.mark.usefixtures('add_functions_and_repos')
+def test_process_game_finished_events_in_batch(pymash_engine, monkeypatch):
+    monkeypatch.setenv('PYMASH_ENABLE_GAMES_COMPACTION', 'true')
+    first_game = _get_game(game_id='first_game_id')
+    second_game = _get_game(game_id='second_game_id', result=models.WHITE_WINS_RESULT)
+    changed_first_game = _get_game(game_id='first_game_id', result=models.WHITE_WINS_RESULT)
+    unknown_game = _get_game(game_id='unknown_game_id', white_id=1000000)
+    _monkeypatch_boto3(monkeypatch, [first_game, second_game, changed_first_game, unknown_game],
+                       num_batches=1)
+    _call_process_finished_games()
+    # ratings are the same as if we processed games one by one
+    _check_game_and_repos(pymash_engine, first_game,
+                          expected_first_rating=1807.27,
+                          expected_second_rating=1892.73)
+    _assert_game_saved(pymash_engine, second_game)
+    _assert_game_not_saved(pymash_engine, unknown_game)
+
+
+@pytest.mark.usefixtures('add_functions_and_repos')
+def test_process_game_finished_events_in_batch_saved_concurrently(pymash_engine, monkeypatch):
+    first_game = _get_game(game_id='first_game_id')
+    second_game = _get_game(game_id='second_game_id', result=models.WHITE_WINS_RESULT)
+    events.process_game_finished_event(pymash_engine, first_game, ledger.GamesLedger(max_size=10))
+    find_many_games_by_ids = db.find_many_games_by_ids
+    num_calls = iter(range(100))
+
+    def find_many_games_by_ids_before_concurrent_save(engine, game_ids):
+        # first game is saved by another worker right after the first lookup
+        if next(num_calls) == 0:
+            return {}
+        return find_many_games_by_ids(engine, game_ids)
+
+    monkeypatch.setattr(db, 'find_many_games_by_ids', find_many_games_by_ids_before_concurrent_save)
+    events.process_many_game_finished_events(
+        pymash_engine, [first_game, second_game], ledger.GamesLedger(max_size=10))
+    # rating change of the first game is applied only once
+    _check_game_and_repos(pymash_engine, first_game,
+                          expected_first_rating=1807.27,
+                          expected_second_rating=1892.73)
+    _assert_game_saved(pymash_engine, second_game)
+
+
+def test_watchman_snapshot_is_saved_on_error(monkeypatch, tmpdir):
+    snapshot_path = str(tmpdir.join('watchman.snapshot'))
+    monkeypatch.setenv('PYMASH_WATCHMAN_SNAPSHOT_PATH', snapshot_path)
+
+    def fail(**kwargs):
+        raise RuntimeError('queue is down')
+
+    monkeypatch.setattr(process_finished_games, '_process_new_messages', fail)
+    watchman = fraud.Watchman(
+        rate_limit=fraud.RATE_LIMIT, window=fraud.WINDOW, ban_duration=fraud.BAN_DURATION,
+        max_num_attempts_without_gc=fraud.MAX_NUM_ATTEMPTS_WITHOUT_GC)
+    with pytest.raises(RuntimeError):
+        process_finished_games.main(iterations=[1], wait_time_seconds=0, watchman=watchman)
+    assert os.path.exists(snapshot_path)
+
+
+def test_exit_on_sigterm():
+    with pytest.raises(SystemExit):
+        process_finished_games._exit_on_sigterm(signal.SIGTERM, None)
+
+
 def _assert_nothing_saved(pymash_engine, game):
     _assert_game_not_saved(pymash_engine, game)
     _assert_repo_has_rating(pymash_engine, repo_id=1, expected_rating=1800)
@@ -99,17 +166,22 @@ def _check_game_and_repos(pymash_engine, expected_game, expected_first_rating, e
     _assert_repo_has_rating(pymash_engine, repo_id=2, expected_rating=expected_second_rating)
 
 
-def _get_game(white_id=666, black_id=777, result=models.BLACK_WINS_RESULT):
+def _get_game(white_id=666, black_id=777, result=models.BLACK_WINS_RESULT, game_id='some_game_id'):
     return models.Game(
-        game_id='some_game_id',
+        game_id=game_id,
         white_id=white_id,
         black_id=black_id,
         result=result)
 
 
-def _monkeypatch_boto3(monkeypatch, games):
+def _monkeypatch_boto3(monkeypatch, games, num_batches=None):
     queue_mock = mock.Mock()
-    queue_mock.receive_messages.return_value = _convert_games_to_messages(games)
+    if num_batches is None:
+        queue_mock.receive_messages.return_value = _convert_games_to_messages(games)
+    else:
+        # batch processing receives messages until the queue is empty
+        queue_mock.receive_messages.side_effect = (
+            [_convert_games_to_messages(games)] * num_batches + [[]])
     resource_mock = mock.Mock()
     resource_mock.return_value.get_queue_by_name.return_value = queue_mock
     monkeypatch.setattr(boto3, 'resource', resource_mock)
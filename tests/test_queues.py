@@ -0,0 +1,49 @@
+from pymash import queues
+
+
+def test_sqlite_games_queue(tmpdir):
+    games_queue = queues.SqliteGamesQueue(str(tmpdir.join('games_queue.sqlite')))
+    games_queue.send('first')
+    games_queue.send('second')
+    games_queue.send('third')
+
+    messages = games_queue.receive(max_num_messages=2, wait_time_seconds=0)
+    assert [a_message.body for a_message in messages] == ['first', 'second']
+    assert all('SentTimestamp' in a_message.attributes for a_message in messages)
+    for a_message in messages:
+        a_message.delete()
+
+    messages = games_queue.receive(max_num_messages=2, wait_time_seconds=0)
+    assert [a_message.body for a_message in messages] == ['third']
+    assert games_queue.receive(max_num_messages=2, wait_time_seconds=0) == []
+
+
+def test_sqlite_games_queue_redelivery(tmpdir, monkeypatch):
+    monkeypatch.setattr(queues.SqliteGamesQueue, 'VISIBILITY_TIMEOUT_SECONDS', 0)
+    path = str(tmpdir.join('games_queue.sqlite'))
+    producer = queues.SqliteGamesQueue(path)
+    consumer = queues.SqliteGamesQueue(path)
+    producer.send('first')
+
+    # not deleted messages are received again after the visibility timeout
+    assert [a_message.body for a_message in consumer.receive(1, wait_time_seconds=0)] == ['first']
+    messages = consumer.receive(1, wait_time_seconds=0)
+    assert [a_message.body for a_message in messages] == ['first']
+    messages[0].delete()
+    assert consumer.receive(1, wait_time_seconds=0) == []
+
+
+def test_postgres_games_queue(pymash_engine):
+    games_queue = queues.PostgresGamesQueue(pymash_engine)
+    games_queue.send('first')
+    games_queue.send('second')
+
+    messages = games_queue.receive(max_num_messages=10, wait_time_seconds=0)
+    assert [a_message.body for a_message in messages] == ['first', 'second']
+    # claimed messages are invisible to other consumers
+    other_games_queue = queues.PostgresGamesQueue(pymash_engine)
+    assert other_games_queue.receive(max_num_messages=10, wait_time_seconds=0) == []
+    for a_message in messages:
+        a_message.delete()
+    games_queue.close()
+    other_games_queue.close()
@@ -0,0 +1,48 @@
+import gzip
+
+import pytest
+
+from pymash import static
+
+
+def test_build_and_load(tmpdir):
+    source_dir = tmpdir.mkdir('source')
+    source_dir.join('pymash.css').write_binary(b'.game { display: flex; }\n' * 100)
+    source_dir.join('pymash.scss').write_binary(b'.game { display: flex; }\n')
+    source_dir.join('pymash.css.map').write_binary(b'{}')
+    build_dir = tmpdir.join('build')
+    hashed_name_by_name = static.build(str(source_dir), str(build_dir))
+    assert list(hashed_name_by_name) == ['pymash.css']
+    hashed_name = hashed_name_by_name['pymash.css']
+    assert hashed_name.startswith('pymash.') and hashed_name.endswith('.css')
+    assets = static.load(str(build_dir))
+    assert assets.get_hashed_name('pymash.css') == hashed_name
+    asset = assets.get_or_none(hashed_name)
+    assert asset.content_type == 'text/css'
+    assert asset.get_body(static.IDENTITY) == b'.game { display: flex; }\n' * 100
+    assert gzip.decompress(asset.get_body(static.GZIP)) == asset.get_body(static.IDENTITY)
+    assert assets.get_or_none('pymash.css') is None
+    with pytest.raises(static.AssetNotFound):
+        assets.get_hashed_name('pymash.scss')
+
+
+def test_build_is_reproducible(tmpdir):
+    source_dir = tmpdir.mkdir('source')
+    source_dir.join('pymash.css').write_binary(b'.game { display: flex; }\n')
+    static.build(str(source_dir), str(tmpdir.join('first')))
+    static.build(str(source_dir), str(tmpdir.join('second')))
+    for a_path in tmpdir.join('first').listdir():
+        assert tmpdir.join('second', a_path.basename).read_binary() == a_path.read_binary()
+
+
+@pytest.mark.parametrize('accept_encoding, encodings, expected', [
+    ('gzip, deflate, br', ['br', 'gzip', 'identity'], 'br'),
+    ('gzip, deflate, br', ['gzip', 'identity'], 'gzip'),
+    ('gzip;q=1.0, br;q=0.5', ['br', 'gzip', 'identity'], 'br'),
+    ('gzip, br;q=0', ['br', 'gzip', 'identity'], 'gzip'),
+    ('GZIP', ['br', 'gzip', 'identity'], 'gzip'),
+    ('', ['br', 'gzip', 'identity'], 'identity'),
+    ('deflate', ['br', 'gzip', 'identity'], 'identity'),
+])
+def test_choose_encoding(accept_encoding, encodings, expected):
+    assert static.choose_encoding(accept_encoding, encodings) == expected
@@ -1,6 +1,7 @@
 import asyncio
 import collections
-import json
+import itertools
+import os
 import random
 from unittest import mock
 
@@ -9,11 +10,21 @@ import bs4
 import pytest
 
 from pymash import cfg
+from pymash import events
 from pymash import main
 from pymash import models
+from pymash import static
+from pymash import views
 from pymash.tables import *
 
 
+@pytest.fixture(autouse=True)
+def _clear_views_caches():
+    # cached views are module level, so they outlive apps of other tests
+    views._cached_make_matchmaker.cache_clear()
+    views._cached_find_active_repos.cache_clear()
+
+
 @pytest.mark.parametrize('random_values, cookies, is_success', [
     # normal case, first visit
     ([0.3, 0.6], {}, True),
@@ -21,7 +32,7 @@ from pymash.tables import *
     ([0.3, 0.6], {'visited': '1'}, True),
     # we don't select deactivated functions (function_id=888)
     ([0.3, 0.5], {}, True),
-    # if random value is too large, then we cut it to the largest possible value in the database
+    # random value close to 1 picks the last slot
     ([0.3, 0.9999], {}, True),
     # first game is with the same repo, second is ok
     ([0.3, 0.3, 0.3, 0.6], {}, True),
@@ -49,6 +60,35 @@ async def test_show_game(random_values, cookies, is_success, test_client, monkey
         assert response.status == 503
 
 
+@pytest.mark.usefixtures('add_functions_and_repos')
+async def test_show_game_stratified_matchmaking(test_client, monkeypatch):
+    monkeypatch.setenv('PYMASH_MATCHMAKING', 'stratified')
+    app = main.create_app()
+    text = await _get_checked_response_text(await _get(app, test_client, '/game'))
+    parsed_html = bs4.BeautifulSoup(text)
+    white_data = _get_game_form_data(parsed_html.find('div', attrs={'class': 'white-player'}))
+    # both repos have one active function, so only the colors are random
+    assert {white_data.white_id, white_data.black_id} == {'666', '777'}
+
+
+@pytest.mark.usefixtures('add_functions_and_repos')
+async def test_show_game_prefetched(test_client, monkeypatch):
+    monkeypatch.setenv('PYMASH_GAMES_PREFETCH_SIZE', '2')
+    # slots of the two active functions in turn
+    monkeypatch.setattr(random, 'random', itertools.cycle([0.3, 0.6]).__next__)
+    app = main.create_app()
+    client = await test_client(app)
+    games_prefetcher = app['games_prefetcher']
+    for _ in range(3):
+        while len(games_prefetcher) < 2:
+            await asyncio.sleep(0.01)
+        # every game is checked as shown to a new visitor
+        client.session.cookie_jar.clear()
+        response = await client.get('/game')
+        _check_game_markup(await _get_checked_response_text(response), cookies={})
+    assert (games_prefetcher.num_hits, games_prefetcher.num_misses) == (3, 0)
+
+
 async def test_show_leaders(pymash_engine, test_client):
     app = main.create_app()
     _add_repos_for_test_show_leaders(pymash_engine)
@@ -56,6 +96,48 @@ async def test_show_leaders(pymash_engine, test_client):
     assert _parse_leaders_ratings(text) == [1901, 1801]
 
 
+async def test_show_leaders_with_templates_bytecode_cache(pymash_engine, test_client, monkeypatch, tmpdir):
+    monkeypatch.setenv('PYMASH_TEMPLATES_AUTO_RELOAD', 'false')
+    monkeypatch.setenv('PYMASH_TEMPLATES_BYTECODE_CACHE_DIR', str(tmpdir))
+    _add_repos_for_test_show_leaders(pymash_engine)
+    # the first app fills the cache, the second one loads templates from it
+    for _ in range(2):
+        text = await _get_text(main.create_app(), test_client, '/leaders')
+        assert _parse_leaders_ratings(text) == [1901, 1801]
+    # base.html, game.html, leaders.html and player.html
+    assert len(tmpdir.listdir()) == 4
+
+
+async def test_show_asset(test_client, monkeypatch, tmpdir):
+    static.build(static.SOURCE_DIR, str(tmpdir))
+    monkeypatch.setenv('PYMASH_STATIC_BUILD_DIR', str(tmpdir))
+    app = main.create_app()
+    client = await test_client(app)
+    text = await _get_checked_response_text(await client.get('/leaders'))
+    css_url = bs4.BeautifulSoup(text).find('link', attrs={'rel': 'stylesheet'})['href']
+    assert css_url.startswith('/assets/pymash.')
+    response = await client.get(css_url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Cache-Control'] == static.CACHE_CONTROL
+    # the client decompresses the body, it's read before the next request reuses the connection
+    with open(os.path.join(static.SOURCE_DIR, 'pymash.css'), 'rb') as fileobj:
+        assert await response.read() == fileobj.read()
+    response = await client.get('/assets/pymash.css')
+    assert response.status == 404
+
+
+async def test_show_leaders_with_stale_static_build(test_client, monkeypatch, tmpdir):
+    static.build(static.SOURCE_DIR, str(tmpdir))
+    # manifest of a build made before pymash.css was added
+    tmpdir.join(static.MANIFEST_FILE_NAME).write('{}')
+    monkeypatch.setenv('PYMASH_STATIC_BUILD_DIR', str(tmpdir))
+    client = await test_client(main.create_app())
+    text = await _get_checked_response_text(await client.get('/leaders'))
+    css_url = bs4.BeautifulSoup(text).find('link', attrs={'rel': 'stylesheet'})['href']
+    assert css_url == cfg.get_config().css_url
+
+
 def _parse_leaders_ratings(html_text):
     parsed_html = bs4.BeautifulSoup(html_text)
     rating_cells = parsed_html.find_all('td', attrs={'class': 'rating-column'})
@@ -170,12 +252,31 @@ async def test_post_game(data, is_success, test_client, monkeypatch):
         calls = games_queue_mock.send_message.mock_calls
         assert len(calls) == 1
         _, _, call_kwargs = calls[0]
-        assert json.loads(call_kwargs['MessageBody'])['ip'] == '192.168.1.1'
+        _, attempt = events.decode_game_finished_event(call_kwargs['MessageBody'])
+        assert attempt.ip == '192.168.1.1'
     else:
         assert response.status == 400
         games_queue_mock.send_message.assert_not_called()
 
 
+async def test_post_game_banned_ip(test_client, monkeypatch):
+    app = main.create_app()
+    games_queue_mock = await _monkeypatch_sqs(app, monkeypatch)
+    watchman_mock = mock.Mock()
+    watchman_mock.is_banned_at.return_value = True
+    app.on_startup.append(lambda an_app: _set_watchman(an_app, watchman_mock))
+    response = await _post(app, test_client, '/game/some_game_id',
+                           allow_redirects=False,
+                           data=_make_post_game_data(),
+                           headers={'X-Forwarded-For': '192.168.1.1, 127.0.0.1'})
+    assert response.status == 429
+    games_queue_mock.send_message.assert_not_called()
+
+
+async def _set_watchman(app, watchman):
+    app['watchman'] = watchman
+
+
 async def _monkeypatch_sqs(app, monkeypatch):
     sqs_resource_mock = _sqs_resource_mock()
     games_queue_mock = await sqs_resource_mock.get_queue_by_name('some_name')